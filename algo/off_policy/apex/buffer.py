@@ -17,6 +17,8 @@ class LocalBuffer(dict):
         self.fake_ids = np.zeros(1, dtype=np.int32)
 
         init_buffer(self, self.capacity, state_shape, action_dim, True, extra_state=1)
+        # one-step rewards, from which replays with an episode index compute episode returns
+        self['raw_reward'] = np.zeros((self.capacity, 1), dtype=np.float32)
 
         self.reward_scale = args['reward_scale'] if 'reward_scale' in args else 1
         self.normalize_reward = args['normalize_reward']
@@ -59,6 +61,7 @@ class LocalBuffer(dict):
         
     def add_data(self, state, action, reward, done):
         """ Add experience to local buffer, return True if local buffer is full, otherwise false """
+        self['raw_reward'][self.idx] = reward
         add_buffer(self, self.idx, state, action, reward, 
                     done, self.n_steps, self.gamma)
         self.idx = self.idx + 1
@@ -49,23 +49,38 @@ def get_learner(BaseClass, *args, **kwargs):
             pwc('Learner: pull weights from the evaluator', 'blue')
             self.variables.set_flat(weights)
 
-        def merge_buffer(self, local_buffer, length):
-            self.buffer.merge(local_buffer, length)
+        def merge_buffer(self, local_buffer, length, partition_no=None):
+            super().merge_buffer(local_buffer, length, partition_no)
+
+        def set_partition_weights(self, weights):
+            """ Set mixing weights of partitions of the partitioned replay at runtime """
+            self.buffer.set_weights(weights)
+
+        def get_buffer_stats(self):
+            """ Return replay statistics, including inserted and sampled transitions
+            if the replay is rate limited, for sizing workers against the learner """
+            return self.buffer.get_stats()
 
         def background_learning(self):
             while not self.buffer.good_to_learn:
                 time.sleep(1)
             pwc('Start Learning...', 'blue')
             
-            t = 0
+            # continue counting from the restored update step, if any
+            t = self.update_step
             while True:
                 t += 1
                 self.learn(t)
 
         def record_stats(self, kwargs):
             assert isinstance(kwargs, dict)
+            # stats of the learner are recorded along with those reported by workers
+            kwargs = dict(kwargs, **self.get_learner_stats())
             super()._record_stats_impl(kwargs)
 
+        def rl_log(self, kwargs):
+            super().rl_log(dict(kwargs, **self.get_learner_stats()))
+
         def print_construction_complete(self):
             pwc('Learner has been constructed.', 'cyan')
 
@@ -0,0 +1,139 @@
+import os
+import itertools
+import threading
+from collections import deque
+import numpy as np
+import ray
+
+from utility.debug_tools import assert_colorize
+from utility.utils import to_int
+from algo.off_policy.apex.replay import get_replay
+
+
+def get_replay_shards(args, state_shape, action_dim):
+    """ Create args['n_replay_shards'] ReplayShard actors, which together hold args['capacity'] transitions """
+    n_shards = args['n_replay_shards']
+    # global indexes assume shards of equal capacity
+    assert_colorize(to_int(args['capacity']) % n_shards == 0, 
+                    f'Capacity {to_int(args["capacity"])} is not a multiple of the number of shards {n_shards}')
+    shard_args = args.copy()
+    shard_args['capacity'] = to_int(args['capacity']) // n_shards
+    shard_args['min_size'] = to_int(args['min_size']) // n_shards
+    # each shard only sees 1/n_shards of the batches the learner samples
+    shard_args['beta_steps'] = float(args['beta_steps']) / n_shards
+    # a blocked merge would hold the actor and thereby block sampling from the shard
+    shard_args.pop('samples_per_insert', None)
+
+    return [get_replay(i, shard_args, state_shape, action_dim) for i in range(n_shards)]
+
+
+class RemoteReplay:
+    """ Learner-side client of replay shards hosted in ReplayShard actors.
+    Batches are requested from shards in a round-robin fashion, and n_prefetch
+    requests are kept in flight so that sampling overlaps with training. Each batch
+    comes from a single shard, with IS ratios normalized within the shard.
+    Priority updates are buffered and sent to shards every priority_batch_size updates.
+    Indexes are global, i.e., shard_no * shard_capacity + index in the shard """
+    """ Interface """
+    def __init__(self, args, shards):
+        self.shards = shards
+        self.n_shards = len(shards)
+        self.capacity = to_int(args['capacity'])
+        self.shard_capacity = self.capacity // self.n_shards
+        self.min_size = to_int(args['min_size'])
+        self.batch_size = args['batch_size']
+
+        self.n_prefetch = args['n_prefetch'] if 'n_prefetch' in args else 2 * self.n_shards
+        self.priority_batch_size = args['priority_batch_size'] if 'priority_batch_size' in args else 8
+
+        self.request_counter = itertools.count()
+        # priority updates not sent yet, for each shard
+        self.pending_priorities = [[] for _ in range(self.n_shards)]
+        self.pending_idxs = [[] for _ in range(self.n_shards)]
+        self.n_pending = 0
+        # locker for pending priority updates, which may come from the agent's updater thread
+        self.locker = threading.Lock()
+
+        self.is_good_to_learn = False
+
+    @property
+    def good_to_learn(self):
+        # every shard should be ready since batches are sampled from each of them
+        if not self.is_good_to_learn:
+            self.is_good_to_learn = all(ray.get([shard.is_good_to_learn.remote() for shard in self.shards]))
+
+        return self.is_good_to_learn
+
+    def __len__(self):
+        return sum(ray.get([shard.size.remote() for shard in self.shards]))
+
+    def __call__(self):
+        assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
+                                            f'transitions in buffer: {len(self)}\t'
+                                            f'minimum required size: {self.min_size}')
+        requests = deque([self._request() for _ in range(self.n_prefetch)])
+        while True:
+            shard_no, samples_id = requests.popleft()
+            requests.append(self._request())
+            yield self._globalize(shard_no, ray.get(samples_id))
+
+    def sample(self):
+        assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
+                                            f'transitions in buffer: {len(self)}\t'
+                                            f'minimum required size: {self.min_size}')
+        shard_no, samples_id = self._request()
+
+        return self._globalize(shard_no, ray.get(samples_id))
+
+    def update_priorities(self, priorities, saved_mem_idxs):
+        priorities = np.reshape(priorities, -1)
+        saved_mem_idxs = np.asarray(saved_mem_idxs)
+        shard_nos = saved_mem_idxs // self.shard_capacity
+        with self.locker:
+            for shard_no in np.unique(shard_nos):
+                mask = shard_nos == shard_no
+                self.pending_priorities[shard_no].append(priorities[mask])
+                self.pending_idxs[shard_no].append(saved_mem_idxs[mask] % self.shard_capacity)
+            self.n_pending += 1
+            if self.n_pending >= self.priority_batch_size:
+                self._flush_priorities()
+
+    def save(self, directory):
+        """ Shards save to directory themselves, so it should be on a file system shared with them """
+        with self.locker:
+            self._flush_priorities()
+        ray.get([shard.save.remote(os.path.join(directory, f'shard{i}'))
+                for i, shard in enumerate(self.shards)])
+
+    def restore(self, directory):
+        ray.get([shard.restore.remote(os.path.join(directory, f'shard{i}'))
+                for i, shard in enumerate(self.shards)])
+
+    def get_stats(self):
+        shard_stats = ray.get([shard.get_stats.remote() for shard in self.shards])
+        stats = dict(Size=sum([s['Size'] for s in shard_stats]))
+        for i, s in enumerate(shard_stats):
+            stats.update(dict([(f'shard{i}_{k}', v) for k, v in s.items()]))
+
+        return stats
+
+    """ Implementation """
+    def _request(self):
+        shard_no = next(self.request_counter) % self.n_shards
+
+        return shard_no, self.shards[shard_no].sample.remote()
+
+    def _globalize(self, shard_no, samples):
+        IS_ratios, indexes, samples = samples
+
+        return IS_ratios, shard_no * self.shard_capacity + indexes, samples
+
+    def _flush_priorities(self):
+        """ Send pending priority updates to shards, the caller should hold self.locker """
+        for shard_no, shard in enumerate(self.shards):
+            if self.pending_priorities[shard_no]:
+                shard.update_priorities.remote(np.concatenate(self.pending_priorities[shard_no]),
+                                               np.concatenate(self.pending_idxs[shard_no]))
+                self.pending_priorities[shard_no] = []
+                self.pending_idxs[shard_no] = []
+        self.n_pending = 0
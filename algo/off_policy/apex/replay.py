@@ -0,0 +1,22 @@
+import ray
+
+from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+
+
+def get_replay(*args, **kwargs):
+    @ray.remote(num_cpus=1)
+    class ReplayShard(ProportionalPrioritizedReplay):
+        """ A shard of the replay hosted in its own actor,
+        to which workers merge their local buffers directly """
+        """ Interface """
+        def __init__(self, shard_no, args, state_shape, action_dim):
+            self.shard_no = shard_no
+            super().__init__(args, state_shape, action_dim)
+
+        def is_good_to_learn(self):
+            return self.good_to_learn
+
+        def size(self):
+            return len(self)
+
+    return ReplayShard.remote(*args, **kwargs)
@@ -25,6 +25,11 @@ def get_worker(BaseClass, *args, **kwargs):
                     device=None):
             self.no = worker_no                             # use 0 worker to evaluate the model
             self.weight_update_freq = weight_update_freq    # update weights 
+            # merge to replay shards directly if replay is hosted in ReplayShard actors
+            self.replay_shards = buffer_args['replay_shards'] if buffer_args['type'] == 'remote' else None
+            self.n_merges = 0
+            # workers are grouped into partitions of the partitioned replay in a round-robin fashion
+            self.partition_no = worker_no % buffer_args['n_partitions'] if buffer_args['type'] == 'partitioned' else None
             buffer_args['type'] = 'local'
             buffer_args['local_capacity'] = 1 if worker_no == 0 else env_args['max_episode_steps'] * weight_update_freq
 
@@ -102,7 +107,13 @@ def get_worker(BaseClass, *args, **kwargs):
                         self.buffer.add_last_state(last_state)
                         self.buffer['priority'][:self.buffer.idx] = self.compute_priorities()
                         # push samples to the central buffer after each episode
-                        learner.merge_buffer.remote(dict(self.buffer), self.buffer.idx)
+                        if self.replay_shards is None:
+                            learner.merge_buffer.remote(dict(self.buffer), self.buffer.idx, self.partition_no)
+                        else:
+                            # workers start from different shards to spread merges evenly
+                            shard = self.replay_shards[(self.no + self.n_merges) % len(self.replay_shards)]
+                            shard.merge.remote(dict(self.buffer), self.buffer.idx)
+                            self.n_merges += 1
                         self.buffer.reset()
 
                     # pull weights from learner
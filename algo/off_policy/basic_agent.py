@@ -1,6 +1,10 @@
 from __future__ import absolute_import, division, print_function, unicode_literals  # provide backward compatibility
 
+import os, pickle, shutil
 import time
+import threading
+import queue
+from collections import deque
 from abc import ABC, abstractmethod
 import numpy as np
 import tensorflow as tf
@@ -9,11 +13,19 @@ from ray.experimental.tf_utils import TensorFlowVariables
 from utility.logger import Logger
 from utility.display import pwc
 from utility.debug_tools import assert_colorize
+from utility.utils import to_int
+from utility.tf_utils import target_update_op
 from basic_model.model import Model
 from env.gym_env import create_gym_env
 from algo.off_policy.apex.buffer import LocalBuffer
+from algo.off_policy.apex.remote_replay import RemoteReplay
 from algo.off_policy.replay.uniform_replay import UniformReplay
 from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+from algo.off_policy.replay.rank_based_replay import RankBasedPrioritizedReplay
+from algo.off_policy.replay.sharded_replay import ShardedReplay
+from algo.off_policy.replay.partitioned_replay import PartitionedReplay
+from algo.off_policy.replay.process_sampler import ProcessSampler
+from algo.off_policy.replay.utils import get_dtypes
 
 
 class OffPolicyOperation(Model, ABC):
@@ -38,7 +50,13 @@ class OffPolicyOperation(Model, ABC):
         self.algo = args['algorithm']
         self.gamma = args.setdefault('gamma', .99)
         self.update_step = 0
+        # save a snapshot of the full training state every snapshot_interval updates, 0 for never
+        self.snapshot_interval = args['snapshot_interval'] if 'snapshot_interval' in args else 0
         self.max_action_repetitions = args.setdefault('max_action_repetitions', 1)
+        # target networks track main networks by a Polyak update after each gradient step if
+        # target_update_freq is 0, otherwise they copy main networks every target_update_freq steps
+        self.polyak = args['polyak'] if 'polyak' in args else .995
+        self.target_update_freq = args['target_update_freq'] if 'target_update_freq' in args else 0
 
         # environment info
         env_args['gamma'] = self.gamma
@@ -55,18 +73,78 @@ class OffPolicyOperation(Model, ABC):
         buffer_args['gamma'] = args['gamma']
         buffer_args['batch_size'] = args['batch_size']
         self.buffer_type = buffer_args['type']
+        n_samplers = buffer_args['n_samplers'] if 'n_samplers' in buffer_args else 0
+        if 'preallocate_samples' in buffer_args and buffer_args['preallocate_samples']:
+            # TF may keep yielded arrays without copying them, so preallocated outputs must outlive 
+            # the prefetched batches, the batch in use, and the one passing through from_generator
+            assert_colorize('prefetch' in buffer_args and buffer_args['prefetch'] > 0, 
+                            'Preallocated samples require an explicit prefetch size')
+            buffer_args['n_sample_slots'] = buffer_args['prefetch'] + 3
+        if n_samplers:
+            # sampler processes require the replay memory to be in shared memory
+            buffer_args['storage'] = 'shared'
         if self.buffer_type == 'proportional':
             self.buffer = ProportionalPrioritizedReplay(buffer_args, self.state_shape, self.action_dim)
+        elif self.buffer_type == 'rank':
+            self.buffer = RankBasedPrioritizedReplay(buffer_args, self.state_shape, self.action_dim)
+        elif self.buffer_type == 'sharded':
+            assert_colorize(self.train_env.n_envs == 1, 
+                            'Sharded replay does not support interleaved transitions of multiple environments')
+            self.buffer = ShardedReplay(buffer_args, self.state_shape, self.action_dim)
+        elif self.buffer_type == 'partitioned':
+            self.buffer = PartitionedReplay(buffer_args, self.state_shape, self.action_dim)
         elif self.buffer_type == 'uniform':
             self.buffer = UniformReplay(buffer_args, self.state_shape, self.action_dim)
+        elif self.buffer_type == 'remote':
+            # replay shards are actors created by distributed_train
+            self.buffer = RemoteReplay(buffer_args, buffer_args['replay_shards'])
         elif self.buffer_type == 'local':
             self.buffer = LocalBuffer(buffer_args, self.state_shape, self.action_dim)
         else:
             raise NotImplementedError('No buffer is constructed')
+        if n_samplers:
+            # as for preallocated samples, yielded ring slots must outlive the prefetched batches,
+            # the batch in use, and the one passing through from_generator
+            assert_colorize('prefetch' in buffer_args and buffer_args['prefetch'] > 0, 
+                            'Sampler processes require an explicit prefetch size')
+            n_held = buffer_args['prefetch'] + 3
+            # sampler processes are forked here, before the session is created in Model.__init__
+            ring_size = buffer_args['ring_size'] if 'ring_size' in buffer_args else n_held + 2 * n_samplers
+            self.buffer = ProcessSampler(self.buffer, n_samplers, ring_size, n_held)
         
+        # the number of batches sampled by each call to the replay in the input pipeline
+        self.n_batches_per_sample = buffer_args['sample_many'] if 'sample_many' in buffer_args else 1
+        if self.n_batches_per_sample > 1:
+            assert_colorize(self.buffer_type in ['proportional', 'rank', 'uniform', 'sharded'] and not n_samplers,
+                            f'{type(self.buffer).__name__} does not support sample_many')
+        # generator: a single generator yields batches in float32
+        # parallel: n_pipeline_samplers generators are interleaved in parallel, and yield batches 
+        # in the dtypes in which fields are stored, which are cast to float32 in the graph
+        self.pipeline = buffer_args['pipeline'] if 'pipeline' in buffer_args and self.buffer_type != 'local' else 'generator'
+        self.n_pipeline_samplers = buffer_args['n_pipeline_samplers'] if 'n_pipeline_samplers' in buffer_args else 4
+        # the number of batches prefetched by the input pipeline, AUTOTUNE if not specified
+        self.prefetch = buffer_args['prefetch'] if 'prefetch' in buffer_args else tf.data.experimental.AUTOTUNE
+        if self.pipeline == 'parallel':
+            assert_colorize(not n_samplers, 'Sampler processes only support a single consumer')
+            assert_colorize(not ('preallocate_samples' in buffer_args and buffer_args['preallocate_samples']), 
+                            'Preallocated samples are in float32 and reused by each consumer')
+        elif self.pipeline != 'generator':
+            raise NotImplementedError(f'Invalid pipeline: {self.pipeline}')
+        # recent time spent waiting for input batches by learning steps, in seconds
+        self.input_wait_times = deque(maxlen=1000)
+
         # arguments for prioritized replay
         self.prio_alpha = float(buffer_args['alpha'])
         self.prio_epsilon = float(buffer_args['epsilon'])
+        # recompute priorities of refresh_chunk_size transitions at a time in the background, 
+        # at most refresh_rate transitions per second, 0 for no limit
+        self.refresh_chunk_size = to_int(buffer_args['refresh_chunk_size']) if 'refresh_chunk_size' in buffer_args else 0
+        self.refresh_rate = float(buffer_args['refresh_rate']) if 'refresh_rate' in buffer_args else 0
+        # priorities are applied by an updater thread, lagging behind by at most 
+        # max_priority_lag calls to learn, 0 for applying them in learn
+        self.max_priority_lag = buffer_args['max_priority_lag'] if 'max_priority_lag' in buffer_args else 0
+        # recent depths of the priority queue when priorities are pushed
+        self.priority_queue_depths = deque(maxlen=1000)
 
         super().__init__(name, args, 
                          sess_config=sess_config, 
@@ -81,20 +159,51 @@ class OffPolicyOperation(Model, ABC):
 
         with self.graph.as_default():
             self.variables = TensorFlowVariables(self.loss, self.sess)
+
+        # fetches of a learning step, which is run through a callable made on the first step
+        self._learn_fetches = [self.priority, self.data['saved_mem_idxs']] if self.prioritized else []
+        if self.input_wait is not None:
+            self._learn_fetches = [self._learn_fetches, self.input_wait]
+        self._learn_fn = None
+
+        if self.refresh_chunk_size and self.buffer_type != 'local':
+            assert_colorize(self.buffer_type == 'proportional', 
+                            'Refreshing priorities requires proportional prioritized replay')
+            self.refresh_thread = threading.Thread(target=self._refresh_priorities, daemon=True)
+            self.refresh_thread.start()
+
+        if self.max_priority_lag and self.prioritized:
+            self.priority_queue = queue.Queue(maxsize=self.max_priority_lag)
+            # an exception raised by the updater thread, re-raised in the main thread
+            self.priority_error = None
+            self.priority_thread = threading.Thread(target=self._apply_priorities, daemon=True)
+            self.priority_thread.start()
+        else:
+            self.priority_queue = None
         
     @property
     def max_path_length(self):
         return self.train_env.max_episode_steps
     
+    @property
+    def prioritized(self):
+        return self.buffer_type in ['proportional', 'rank', 'sharded', 'remote', 'partitioned']
+
     @property
     def good_to_learn(self):
         return self.buffer.good_to_learn
 
     def add_data(self, state, action_repr, reward, done):
-        self.buffer.add(state, action_repr, reward, done)
+        if self.train_env.n_envs > 1:
+            self.buffer.add_batch(state, action_repr, reward, done)
+        else:
+            self.buffer.add(state, action_repr, reward, done)
         
-    def merge_buffer(self, buffer, length):
-        self.buffer.merge(buffer, length)
+    def merge_buffer(self, buffer, length, partition_no=None):
+        if partition_no is None:
+            self.buffer.merge(buffer, length)
+        else:
+            self.buffer.merge(buffer, length, partition_no)
 
     def act(self, state, deterministic=False):
         state = state.reshape((-1, *self.state_shape))
@@ -125,23 +234,98 @@ class OffPolicyOperation(Model, ABC):
 
     def learn(self, t=None):
         feed_dict = self._get_feeddict(t) if self.schedule_lr else None
-    
-        fetches = [self.priority, self.data['saved_mem_idxs']] if self.buffer_type == 'proportional' else []
-        
-        if self.log_tensorboard:
-            results, _, summary = self.sess.run([fetches, self.opt_op, self.graph_summary], feed_dict=feed_dict)
-            if self.update_step % 1000 == 0:
-                self.writer.add_summary(summary, self.update_step)
+
+        if self.log_tensorboard and self.update_step % 1000 == 0:
+            results, _, summary = self.sess.run([self._learn_fetches, self.opt_op, self.graph_summary], 
+                                                feed_dict=feed_dict)
+            self.writer.add_summary(summary, self.update_step)
         else:
-            results, _ = self.sess.run([fetches, self.opt_op], feed_dict=feed_dict)
+            results = self._learn_step(feed_dict)
+        if self.input_wait is not None:
+            results, input_wait = results
+            self.input_wait_times.append(input_wait)
 
+        self.update_step += 1
         # update the target networks
         self._update_target_net()
+        if self.prioritized:
+            priorities, saved_mem_idxs = np.reshape(results[0], -1), results[1]
+            if self.priority_queue is None:
+                self.buffer.update_priorities(priorities, saved_mem_idxs)
+            else:
+                self._check_priority_error()
+                self.priority_queue_depths.append(self.priority_queue.qsize())
+                # block if the updater thread lags behind by max_priority_lag calls
+                self.priority_queue.put((priorities, saved_mem_idxs))
 
-        self.update_step += 1
-        if self.buffer_type == 'proportional':
-            priority, saved_mem_idxs = results
-            self.buffer.update_priorities(priority, saved_mem_idxs)
+        if self.snapshot_interval and self.update_step % self.snapshot_interval == 0:
+            self.save_snapshot()
+
+    def get_pipeline_stats(self):
+        """ Return statistics of time spent waiting for input batches by recent learning steps, in milliseconds """
+        if not self.input_wait_times:
+            return {}
+        input_wait_times = np.array(self.input_wait_times) * 1e3
+        return dict(InputWaitMean=np.mean(input_wait_times), 
+                    InputWaitMax=np.max(input_wait_times))
+
+    def get_priority_queue_stats(self):
+        """ Return statistics of the depth of the priority queue when priorities are pushed """
+        if not self.priority_queue_depths:
+            return {}
+        return dict(PriorityQueueDepthMean=np.mean(self.priority_queue_depths),
+                    PriorityQueueDepthMax=np.max(self.priority_queue_depths))
+
+    def get_learner_stats(self):
+        """ Return the statistics of the input pipeline, the priority queue and priority refreshing 
+        that are enabled, with the same keys on every call so that they can be logged along with other stats """
+        stats = {}
+        if self.input_wait is not None:
+            stats.update(dict(InputWaitMean=0., InputWaitMax=0.))
+            stats.update(self.get_pipeline_stats())
+        if self.priority_queue is not None:
+            stats.update(dict(PriorityQueueDepthMean=0., PriorityQueueDepthMax=0.))
+            stats.update(self.get_priority_queue_stats())
+        if self.refresh_chunk_size and self.buffer_type != 'local':
+            buffer_stats = self.buffer.get_stats()
+            for k in ['RefreshedTransitions', 'RefreshCoverage']:
+                stats[k] = buffer_stats[k] if k in buffer_stats else 0.
+
+        # tensorboard only records python scalars
+        return dict([(k, float(v)) for k, v in stats.items()])
+
+    def save_snapshot(self):
+        """ Save the full training state, i.e., network and optimizer variables, 
+        the replay buffer and counters, so that training can resume from where it stops """
+        assert_colorize(hasattr(self, 'model_file'), 'Snapshots require the model to be constructed with save=True')
+        snapshot_dir = self._snapshot_dir
+        tmp_dir = f'{snapshot_dir}_tmp'
+        checkpoint = self.save(self.update_step)
+        if self.priority_queue is not None:
+            # save the replay with all priorities computed so far
+            self.priority_queue.join()
+            self._check_priority_error()
+        self.buffer.save(tmp_dir)
+        with open(os.path.join(tmp_dir, 'agent.pkl'), 'wb') as f:
+            pickle.dump(dict(update_step=self.update_step, 
+                             checkpoint=os.path.basename(checkpoint)), f)
+        # replace the previous snapshot only after the new one is complete
+        if os.path.exists(snapshot_dir):
+            shutil.rmtree(snapshot_dir)
+        os.rename(tmp_dir, snapshot_dir)
+
+    def restore_snapshot(self):
+        """ Restore the training state saved by save_snapshot """
+        snapshot_dir = self._snapshot_dir
+        assert_colorize(os.path.exists(snapshot_dir), f'No snapshot is found at "{snapshot_dir}"')
+        with open(os.path.join(snapshot_dir, 'agent.pkl'), 'rb') as f:
+            state = pickle.load(f)
+        # restore the checkpoint saved along with the replay, which may not be the latest one
+        self.saver.restore(self.sess, os.path.join(os.path.dirname(self.model_file), state['checkpoint']))
+        self.update_step = state['update_step']
+        self.buffer.restore(snapshot_dir)
+        pwc(f'Model {self.model_name}: training state is restored from "{snapshot_dir}" '
+            f'at update step {self.update_step}', 'magenta')
     
     def rl_log(self, kwargs):
         assert isinstance(kwargs, dict)
@@ -159,29 +343,84 @@ class OffPolicyOperation(Model, ABC):
         self.dump_tabular()
 
     """ Implementation """
+    @property
+    def _snapshot_dir(self):
+        return os.path.join(os.path.dirname(self.model_file), 'snapshot')
+
     @abstractmethod
     def _build_graph(self):
         raise NotImplementedError
 
+    def _learn_step(self, feed_dict):
+        """ Run a learning step through a callable, which saves the cost of 
+        processing fetches and feeds in each session call """
+        if self._learn_fn is None:
+            self._learn_feeds = list(feed_dict) if feed_dict else []
+            self._learn_fn = self.sess.make_callable([self._learn_fetches, self.opt_op], 
+                                                     feed_list=self._learn_feeds)
+        results, _ = self._learn_fn(*[feed_dict[k] for k in self._learn_feeds])
+
+        return results
+
     def _prepare_data(self, buffer):
         with tf.name_scope('data'):
-            sample_types = (tf.float32, tf.float32, tf.float32, tf.float32, tf.float32, tf.float32)
+            n_batches = self.n_batches_per_sample
+            # batches sampled together are stacked along a new leading axis
+            prefix = (None, ) if n_batches > 1 else ()
+            if self.pipeline == 'parallel':
+                dtypes = get_dtypes(self.action_dim)
+                action_shape = (*prefix, None) if self.action_dim == 1 else (*prefix, None, self.action_dim)
+                sample_types = (dtypes['state'], dtypes['action'], tf.float32, dtypes['state'], dtypes['done'], dtypes['steps'])
+            else:
+                action_shape = (*prefix, None, self.action_dim)
+                sample_types = (tf.float32, tf.float32, tf.float32, tf.float32, tf.float32, tf.float32)
             sample_shapes = (
-                (None, *self.state_shape),
-                (None, self.action_dim),
-                (None, 1),
-                (None, *self.state_shape),
-                (None, 1),
-                (None, 1)
+                (*prefix, None, *self.state_shape),
+                action_shape,
+                (*prefix, None, 1),
+                (*prefix, None, *self.state_shape),
+                (*prefix, None, 1),
+                (*prefix, None, 1)
             )
             if self.buffer_type != 'uniform':
-                sample_types = (tf.float32, tf.int32, sample_types)
-                sample_shapes =((None), (None), sample_shapes)
+                if self.pipeline == 'parallel':
+                    sample_types = (tf.float64, tf.int64, sample_types)
+                else:
+                    sample_types = (tf.float32, tf.int32, sample_types)
+                sample_shapes =((*prefix, None), (*prefix, None), sample_shapes)
 
-            ds = tf.data.Dataset.from_generator(buffer, sample_types, sample_shapes)
-            ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
+            if n_batches > 1:
+                def generator():
+                    while True:
+                        yield buffer.sample_many(n_batches)
+            else:
+                generator = buffer
+            if self.pipeline == 'parallel':
+                # each generator runs in its own thread, so sampling and conversion of batches overlap
+                ds = tf.data.Dataset.range(self.n_pipeline_samplers)
+                ds = ds.apply(tf.data.experimental.parallel_interleave(
+                    lambda _: tf.data.Dataset.from_generator(generator, sample_types, sample_shapes),
+                    cycle_length=self.n_pipeline_samplers, sloppy=True))
+            else:
+                ds = tf.data.Dataset.from_generator(generator, sample_types, sample_shapes)
+            if n_batches > 1:
+                # split stacked batches on the TF side
+                ds = ds.apply(tf.data.experimental.unbatch())
+            ds = ds.prefetch(self.prefetch)
             iterator = ds.make_one_shot_iterator()
-            samples = iterator.get_next(name='samples')
+            if self.pipeline == 'parallel':
+                # time spent waiting for the batch, i.e., between the start of a step and the arrival of the batch
+                start_time = tf.timestamp()
+                with tf.control_dependencies([start_time]):
+                    samples = iterator.get_next(name='samples')
+                with tf.control_dependencies(tf.nest.flatten(samples)):
+                    self.input_wait = tf.timestamp() - start_time
+                if self.log_tensorboard:
+                    tf.summary.scalar('input_wait', self.input_wait)
+                samples = self._cast_samples(samples)
+            else:
+                self.input_wait = None
+                samples = iterator.get_next(name='samples')
 
         # prepare data
         data = {}
@@ -203,6 +442,65 @@ class OffPolicyOperation(Model, ABC):
 
         return data
 
+    def _cast_samples(self, samples):
+        """ Cast samples in stored dtypes to those of the generator pipeline """
+        transitions = samples[2] if self.buffer_type != 'uniform' else samples
+        transitions = [tf.cast(x, tf.float32) for x in transitions]
+        if self.action_dim == 1:
+            # actions are stored without the last dimension
+            transitions[1] = transitions[1][:, None]
+        transitions = tuple(transitions)
+
+        if self.buffer_type != 'uniform':
+            IS_ratio, saved_mem_idxs, _ = samples
+            return tf.cast(IS_ratio, tf.float32), tf.cast(saved_mem_idxs, tf.int32), transitions
+        else:
+            return transitions
+
+    def _refresh_priorities(self):
+        """ Walk through the replay and recompute priorities with the current networks """
+        while not self.buffer.good_to_learn:
+            time.sleep(1)
+        while True:
+            start = time.time()
+            chunk, (state, action, reward, next_state, done, steps) = self.buffer.get_refresh_chunk(self.refresh_chunk_size)
+            priority = self.sess.run(self.priority, feed_dict={
+                self.data['state']: state,
+                self.data['action']: action,
+                self.data['reward']: reward,
+                self.data['next_state']: next_state,
+                self.data['done']: done,
+                self.data['steps']: steps
+            })
+            self.buffer.refresh_priorities(priority, chunk)
+            if self.refresh_rate:
+                time.sleep(max(0, len(state) / self.refresh_rate - (time.time() - start)))
+
+    def _apply_priorities(self):
+        """ Apply priorities in the priority queue, merging those pushed while the previous update is applied.
+        The thread keeps draining the queue after an exception, so that put and join never block forever """
+        while True:
+            items = [self.priority_queue.get()]
+            while True:
+                try:
+                    items.append(self.priority_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if self.priority_error is None:
+                    priorities, saved_mem_idxs = zip(*items)
+                    self.buffer.update_priorities(np.concatenate(priorities), np.concatenate(saved_mem_idxs))
+            except Exception as e:
+                self.priority_error = e
+            finally:
+                for _ in items:
+                    self.priority_queue.task_done()
+
+    def _check_priority_error(self):
+        """ Re-raise the exception raised by the updater thread, if any """
+        if self.priority_error is not None:
+            raise RuntimeError('Failed to update priorities in the background') from self.priority_error
+
     def _compute_priority(self, priority):
         with tf.name_scope('priority'):
             priority += self.prio_epsilon
@@ -210,11 +508,26 @@ class OffPolicyOperation(Model, ABC):
         
         return priority
 
+    def _target_net_ops(self, target_variables, main_variables):
+        """ Build ops initializing and updating target variables. A Polyak update 
+        runs after the optimizer as part of opt_op, so it takes no extra session call """
+        with tf.name_scope('target_net_op'):
+            self.init_target_op = target_update_op(target_variables, main_variables, 0, name='init_target_op')
+            if self.target_update_freq:
+                self.update_target_op = self.init_target_op
+            else:
+                self.update_target_op = target_update_op(target_variables, main_variables, self.polyak,
+                                                         dependencies=[self.opt_op], name='update_target_op')
+                self.opt_op = tf.group(self.opt_op, self.update_target_op)
+
     def _initialize_target_net(self):
-        raise NotImplementedError
+        self.sess.run(self.init_target_op)
     
     def _update_target_net(self):
-        raise NotImplementedError
+        """ Copy main networks to target networks every target_update_freq steps,
+        Polyak updates are done with opt_op """
+        if self.target_update_freq and self.update_step % self.target_update_freq == 0:
+            self.sess.run(self.update_target_op)
 
     def _get_feeddict(self, t):
         raise NotImplementedError
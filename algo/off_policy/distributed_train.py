@@ -7,10 +7,12 @@ import numpy as np
 import tensorflow as tf
 import ray
 
-from utility.tf_utils import get_sess_config
+from utility.tf_utils import get_sess_config, enable_cpu_jit
+from env.gym_env import create_gym_env
 from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
 from algo.off_policy.apex.worker import get_worker
 from algo.off_policy.apex.learner import get_learner
+from algo.off_policy.apex.remote_replay import get_replay_shards
 from algo.off_policy.apex.evaluator import get_evaluator
 
 
@@ -30,14 +32,31 @@ def main(env_args, agent_args, buffer_args, render=False):
         n_workers = agent_args['n_workers']
     # agent_args['env_stats']['times'] = n_workers
 
+    if 'graph_optimization' in agent_args and agent_args['graph_optimization'] == 'xla':
+        # set before ray starts, so that the learner process inherits the XLA flags
+        enable_cpu_jit()
     ray.init()
 
+    if buffer_args['type'] == 'remote':
+        # host replay in dedicated actors, to which workers merge directly
+        buffer_args['n_steps'] = agent_args['n_steps']
+        buffer_args['gamma'] = agent_args.setdefault('gamma', .99)
+        buffer_args['batch_size'] = agent_args['batch_size']
+        env = create_gym_env(dict(env_args, n_envs=1, log_video=False))
+        buffer_args['replay_shards'] = get_replay_shards(buffer_args, env.state_shape, env.action_dim)
+
     agent_name = 'Agent'
     sess_config = get_sess_config(2)
+    restore = agent_args['restore'] if 'restore' in agent_args else False
     learner = get_learner(Agent, agent_name, agent_args, env_args, buffer_args, 
+                            save=restore or 'snapshot_interval' in agent_args,
                             log=True, log_tensorboard=True, log_stats=True, 
                             sess_config=sess_config, device='/GPU: 0')
+    if restore:
+        ray.get(learner.restore_snapshot.remote())
     env_args['seed'] = 0
+    # only the learner session is compiled, workers and the evaluator mostly run small acting graphs
+    agent_args.pop('graph_optimization', None)
     agent_args['model_name'] = 'evaluator'
     evaluator = get_evaluator(Agent, agent_name, agent_args, env_args, buffer_args,
                             sess_config=sess_config, device='/CPU: 0')
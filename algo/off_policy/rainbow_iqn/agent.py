@@ -24,7 +24,6 @@ class Agent(OffPolicyOperation):
         # optional improvements
         self.n_steps = args['n_steps']
         self.critic_loss_type = args['loss_type']
-        self.polyak = args['polyak'] if 'polyak' in args else .995
         self.algo = args['Qnets']['algo']
 
         super().__init__(name,
@@ -53,7 +52,7 @@ class Agent(OffPolicyOperation):
                                                                           opt_step=True)
 
         # target net operations
-        self.init_target_op, self.update_target_op = self._target_net_ops()
+        self._target_net_ops(self.Qnets.target_variables, self.Qnets.main_variables)
 
         self._log_loss()
 
@@ -129,20 +128,6 @@ class Agent(OffPolicyOperation):
 
         return priority, loss
 
-    def _target_net_ops(self):
-        with tf.name_scope('target_net_op'):
-            target_main_var_pairs = list(zip(self.Qnets.target_variables, self.Qnets.main_variables))
-            init_target_op = list(map(lambda v: tf.assign(v[0], v[1], name='init_target_op'), target_main_var_pairs))
-            update_target_op = list(map(lambda v: tf.assign(v[0], self.polyak * v[0] + (1. - self.polyak) * v[1], name='update_target_op'), target_main_var_pairs))
-
-        return init_target_op, update_target_op
-
-    def _initialize_target_net(self):
-        self.sess.run(self.init_target_op)
-
-    def _update_target_net(self):
-        self.sess.run(self.update_target_op)
-
     def _log_loss(self):
         if self.log_tensorboard:
             with tf.name_scope('loss'):
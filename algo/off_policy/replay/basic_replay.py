@@ -1,3 +1,4 @@
+import os, pickle
 from abc import ABC
 import threading
 import numpy as np
@@ -7,6 +8,22 @@ from utility.display import pwc
 from utility.utils import to_int
 from utility.run_avg import RunningMeanStd
 from algo.off_policy.replay.utils import add_buffer, copy_buffer
+from algo.off_policy.replay.storage import get_allocator, RecordAllocator
+from algo.off_policy.replay.batch_buffer import BatchBuffer
+from algo.off_policy.replay.rate_limiter import get_rate_limiter
+from algo.off_policy.replay.ds.episode_index import EpisodeIndex
+
+# memory fields are saved and restored this many bytes at a time, 
+# so that storage larger than RAM is never loaded as a whole
+COPY_CHUNK_BYTES = 1 << 26
+
+def copy_rows(dst, src):
+    """ Copy src to dst, both with the same shape, in chunks of rows """
+    row_bytes = max(1, src.dtype.itemsize * int(np.prod(src.shape[1:])))
+    chunk_rows = max(1, COPY_CHUNK_BYTES // row_bytes)
+    for start in range(0, len(src), chunk_rows):
+        end = min(start + chunk_rows, len(src))
+        dst[start:end] = src[start:end]
 
 class Replay(ABC):
     """ Interface """
@@ -25,9 +42,36 @@ class Replay(ABC):
 
         self.n_steps = args['n_steps']
         self.gamma = args['gamma']
+        # store raw one-step transitions and compute n-step returns at sample time,
+        # so that n_steps and gamma can be changed without re-storing transitions
+        self.lazy_n_steps = args['lazy_n_steps'] if 'lazy_n_steps' in args else False
         
         self.is_full = False
         self.mem_idx = 0
+
+        # transitions added by add_batch from n_envs environments are stored n_envs rows apart
+        self.stride = 1
+        # blocks of transitions from add_batch whose n-step returns are not completed yet
+        self.pending = []
+
+        # assemble sampled batches into arrays preallocated for each consumer thread
+        self.preallocate_samples = args['preallocate_samples'] if 'preallocate_samples' in args else False
+        # the number of batches a consumer may hold at once, e.g., those queued in its input pipeline
+        self.n_sample_slots = args['n_sample_slots'] if 'n_sample_slots' in args else 2
+        self.batch_buffers = {}             # thread id     -->     BatchBuffer
+
+        # allocator for self.memory, which decides where transitions are stored
+        self.allocator = get_allocator(args)
+
+        # index of episodes stored in memory, which is maintained as transitions are written
+        self.episode_index = EpisodeIndex(self.capacity) if 'episode_index' in args and args['episode_index'] else None
+        # evict whole episodes: the rest of a partially overwritten episode is no longer sampled
+        self.evict_episodes = args['evict_episodes'] if 'evict_episodes' in args else False
+        assert_colorize(self.episode_index is not None or not self.evict_episodes, 
+                        'Evicting whole episodes requires episode_index')
+
+        # optional limiter holding the ratio of sampled to inserted transitions
+        self.rate_limiter = get_rate_limiter(args)
         
         # locker used to avoid conflict introduced by tf.data.Dataset and multi-agent
         self.locker = threading.Lock()
@@ -39,6 +83,11 @@ class Replay(ABC):
     def __len__(self):
         return self.capacity if self.is_full else self.mem_idx
 
+    @property
+    def records(self):
+        """ The structured array memory fields are views of, if memory is allocated as records """
+        return self.allocator.records if isinstance(self.allocator, RecordAllocator) else None
+
     def __call__(self):
         while True:
             yield self.sample()
@@ -47,15 +96,30 @@ class Replay(ABC):
         assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
                                             f'transitions in buffer: {len(self)}\t'
                                             f'minimum required size: {self.min_size}')
+        self._await_sample(self.batch_size)
         with self.locker:
             samples = self._sample()
 
         return samples
 
+    def sample_many(self, n_batches):
+        """ Sample n_batches batches in a single locked pass, stacked along a new leading axis """
+        assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
+                                            f'transitions in buffer: {len(self)}\t'
+                                            f'minimum required size: {self.min_size}')
+        self._await_sample(n_batches * self.batch_size)
+        with self.locker:
+            samples = self._sample_many(n_batches)
+
+        return samples
+
     def merge(self, local_buffer, length):
         """ Merge a local buffer to the replay buffer, useful for distributed algorithms """
         assert_colorize(length < self.capacity, 
                     f'Local buffer cannot be largeer than the replay: {length} vs. {self.capacity}')
+        # local buffers carry n-step rewards, which lazy replays would sum once more at sample time
+        assert_colorize(not self.lazy_n_steps, 'Lazy n-step replay does not support merging local buffers')
+        self._await_insert(length)
         with self.locker:
             self._merge(local_buffer, length)
 
@@ -63,11 +127,142 @@ class Replay(ABC):
         """ Add a single transition to the replay buffer """
         raise NotImplementedError
 
+    def add_batch(self, states, actions, rewards, dones):
+        """ Add a transition from each of n_envs environments at once. Transitions
+        of the same environment are stored n_envs rows apart, so n_envs cannot be 
+        changed once transitions are added, nor can add_batch be mixed with add """
+        n_envs = len(states)
+        assert_colorize(self.episode_index is None or n_envs == 1, 
+                        'Episode index does not support interleaved transitions of multiple environments')
+        self._await_insert(n_envs)
+        with self.locker:
+            if self.stride != n_envs:
+                assert_colorize(len(self) == 0 and not self.pending, 
+                                f'The number of environments cannot be changed from {self.stride} to {n_envs}')
+                self.stride = n_envs
+            if self.records is None:
+                block = dict(
+                    state=np.asarray(states),
+                    action=np.asarray(actions),
+                    reward=np.reshape(rewards, (n_envs, 1)).astype(np.float32),
+                    done=np.reshape(dones, (n_envs, 1)).astype(np.bool),
+                    steps=np.ones((n_envs, 1), dtype=np.uint8),
+                )
+            else:
+                # build the block as records so that it's written to memory by a single copy
+                records = np.zeros(n_envs, dtype=self.records.dtype)
+                block = dict([(k, records[k]) for k in records.dtype.names])
+                block['state'][:] = states
+                block['action'][:] = np.reshape(actions, block['action'].shape)
+                block['reward'][:] = np.reshape(rewards, (n_envs, 1))
+                block['done'][:] = np.reshape(dones, (n_envs, 1))
+                block['steps'][:] = 1
+            if self.n_steps > 1 and not self.lazy_n_steps:
+                if self.episode_index is not None:
+                    block['raw_reward'] = np.copy(block['reward'])
+                block = self._update_pending(block)
+            if block is not None:
+                self._add_rows(block, n_envs)
+
+    def find_episode(self, mem_idx):
+        """ Return the id of the episode containing transition mem_idx, -1 if there is none """
+        return self.episode_index.find(mem_idx)
+
+    def get_episode(self, episode_id):
+        """ Return the transitions of the episode in order. Fields are views 
+        of memory if the episode does not wrap around the end of memory """
+        with self.locker:
+            slices = self.episode_index.slices(episode_id)
+            fields = ['state', 'action', 'reward', 'done', 'steps']
+            if len(slices) == 1:
+                return dict([(k, self.memory[k][slices[0]]) for k in fields])
+            else:
+                return dict([(k, np.concatenate([self.memory[k][s] for s in slices])) for k in fields])
+
+    def evict_episode(self, episode_id):
+        """ Stop sampling the remaining transitions of the episode, and remove it from the index """
+        with self.locker:
+            self._evict_episode(episode_id)
+
+    def get_stats(self):
+        """ Return statistics of the replay buffer, including those of the storage back end """
+        stats = dict(Size=len(self))
+        if self.episode_index is not None:
+            stats['Episodes'] = self.episode_index.n_episodes
+        if self.rate_limiter is not None:
+            stats.update(self.rate_limiter.get_stats())
+        for k, v in self.memory.items():
+            if hasattr(v, 'get_stats'):
+                stats.update(dict([(f'{k}_{stat_k}', stat_v) for stat_k, stat_v in v.get_stats().items()]))
+
+        return stats
+
+    def save(self, directory):
+        """ Save the replay to directory. Memory fields are saved as .npy files
+        so that restore can memory-map them instead of reading them up front """
+        os.makedirs(directory, exist_ok=True)
+        with self.locker:
+            for k, v in self.memory.items():
+                x = np.lib.format.open_memmap(os.path.join(directory, f'{k}.npy'), 
+                                              mode='w+', dtype=v.dtype, shape=v.shape)
+                copy_rows(x, v)
+                x.flush()
+                del x
+            with open(os.path.join(directory, 'state.pkl'), 'wb') as f:
+                pickle.dump(self._get_state(), f, protocol=4)
+
+    def restore(self, directory):
+        """ Restore the replay saved by save. With the default in-memory storage, memory fields
+        are mapped copy-on-write: pages are read lazily and writes never touch the saved files """
+        with self.locker:
+            for k, v in self.memory.items():
+                x = np.load(os.path.join(directory, f'{k}.npy'), mmap_mode='c')
+                assert_colorize(x.shape == v.shape, f'Shape of {k} mismatches: {x.shape} vs. {v.shape}')
+                if self.allocator is None:
+                    self.memory[k] = x
+                else:
+                    # copy into the storage back end, which others (e.g., sampler processes) may rely on
+                    copy_rows(v, x)
+            with open(os.path.join(directory, 'state.pkl'), 'rb') as f:
+                self._set_state(pickle.load(f))
+
     """ Implementation """
+    def _get_state(self):
+        """ Return everything other than self.memory needed to restore the replay """
+        state = dict(mem_idx=self.mem_idx, is_full=self.is_full)
+        if self.normalize_reward:
+            state['running_reward_stats'] = self.running_reward_stats
+        if self.n_steps > 1 and not self.lazy_n_steps:
+            state.update(dict(tb=self.tb, tb_idx=self.tb_idx, tb_full=self.tb_full))
+        state.update(dict(stride=self.stride, pending=self.pending))
+        if self.episode_index is not None:
+            state['episode_index'] = self.episode_index
+        if self.rate_limiter is not None:
+            state['rate_limiter'] = self.rate_limiter.get_state()
+
+        return state
+
+    def _set_state(self, state):
+        state = state.copy()
+        if 'rate_limiter' in state:
+            rate_limiter_state = state.pop('rate_limiter')
+            if self.rate_limiter is not None:
+                self.rate_limiter.set_state(rate_limiter_state)
+        for k, v in state.items():
+            setattr(self, k, v)
+
     def _add(self, state, action, reward, done):
         """ add is only used for single agent, no multiple adds are expected to run at the same time
             but it may fight for resource with self.sample if background learning is enabled """
-        if self.n_steps > 1:
+        assert_colorize(self.stride == 1, 'add cannot be mixed with add_batch of multiple environments')
+        if self.lazy_n_steps:
+            self.add_batch([state], [action], [reward], [done])
+        elif self.n_steps > 1:
+            if self.episode_index is not None:
+                # keep one-step rewards for episode returns, they are shifted along with the rest of tb
+                if 'raw_reward' not in self.tb:
+                    self.tb['raw_reward'] = np.zeros((self.tb_capacity, 1), dtype=np.float32)
+                self.tb['raw_reward'][self.tb_idx] = reward
             add_buffer(self.tb, self.tb_idx, state, action, reward, 
                         done, self.n_steps, self.gamma)
             
@@ -91,59 +286,240 @@ class Replay(ABC):
                 self.tb_idx = n_not_ready
                 self.tb_full = False
         else:
+            self._await_insert(1)
             with self.locker:
+                if self.episode_index is not None:
+                    self._index_episodes(np.array([self.mem_idx]), np.array([reward]), 
+                                         np.array([done]), np.ones(1, dtype=np.uint8))
                 add_buffer(self.memory, self.mem_idx, state, action, reward,
                             done, self.n_steps, self.gamma)
                 self.mem_idx = (self.mem_idx + 1) % self.capacity
 
+    def _await_insert(self, n):
+        """ Wait for the rate limiter, if any, before inserting n transitions. 
+        This must be called without holding self.locker, which samples need """
+        if self.rate_limiter is not None:
+            self.rate_limiter.await_insert(n)
+
+    def _await_sample(self, n):
+        """ Wait for the rate limiter, if any, before sampling n transitions """
+        if self.rate_limiter is not None:
+            self.rate_limiter.await_sample(n)
+
+    def _index_episodes(self, mem_idxs, rewards, dones, steps):
+        """ Update the episode index before rows at mem_idxs are overwritten """
+        partial_ids = self.episode_index.evict(mem_idxs)
+        if self.evict_episodes:
+            for episode_id in partial_ids:
+                self._evict_episode(episode_id)
+        terminals = np.reshape(dones, -1) & (np.reshape(steps, -1) == 1)
+        self.episode_index.add(mem_idxs, rewards, terminals)
+
+    def _evict_episode(self, episode_id):
+        self._invalidate_rows(self.episode_index.rows(episode_id))
+        self.episode_index.remove(episode_id)
+
+    def _invalidate_rows(self, mem_idxs):
+        """ Exclude rows at mem_idxs from sampling until they are overwritten """
+        raise NotImplementedError(f'{type(self).__name__} does not support evicting episodes')
+
+    def _update_pending(self, block):
+        """ Propagate the reward and done flag of the new block to pending blocks 
+        as add_buffer does for each environment, and return the block whose n-step 
+        return is completed, if any """
+        # stop propagating at the first done encountered backward
+        is_alive = np.ones_like(block['done'])
+        for i, pending in enumerate(reversed(self.pending), 1):
+            is_alive &= ~pending['done']
+            pending['reward'] += np.where(is_alive, self.gamma**i * block['reward'], 0)
+            np.copyto(pending['done'], block['done'], where=is_alive)
+            pending['steps'] += is_alive.astype(np.uint8)
+        self.pending.append(block)
+
+        return self.pending.pop(0) if len(self.pending) == self.n_steps else None
+
+    def _add_rows(self, rows, length):
+        """ Write consecutive rows to memory, as a merge from a local buffer """
+        self._merge(rows, length)
+
     def _sample(self):
         raise NotImplementedError
 
+    def _sample_many(self, n_batches):
+        raise NotImplementedError
+
+    def _get_samples_many(self, indexes):
+        """ Gather samples for indexes of shape [n_batches, batch_size] in one pass """
+        samples = self._get_samples(np.reshape(indexes, -1))
+
+        return tuple([np.reshape(v, (*indexes.shape, *v.shape[1:])) for v in samples])
+
     def _merge(self, local_buffer, length):
-        end_idx = self.mem_idx + length
+        self._write_rows(local_buffer, length, self._allocate_rows(length))
 
+    def _allocate_rows(self, length):
+        """ Return runs of consecutive memory rows, as (start, end) pairs, 
+        to which length rows are written in order. Memory is recycled via FIFO """
+        end_idx = self.mem_idx + length
         if end_idx > self.capacity:
-            first_part = self.capacity - self.mem_idx
-            second_part = length - first_part
-            
-            copy_buffer(self.memory, self.mem_idx, self.capacity, local_buffer, 0, first_part)
-            copy_buffer(self.memory, 0, second_part, local_buffer, first_part, length)
+            return [(self.mem_idx, self.capacity), (0, end_idx - self.capacity)]
         else:
-            copy_buffer(self.memory, self.mem_idx, end_idx, local_buffer, 0, length)
+            return [(self.mem_idx, end_idx)]
+
+    def _run_indexes(self, runs):
+        return np.concatenate([np.arange(start, end) for start, end in runs])
+
+    def _write_rows(self, local_buffer, length, runs):
+        local_records = self._get_local_records(local_buffer)
+        if self.episode_index is not None:
+            # episode returns sum one-step rewards, which stored rewards are only if n_steps == 1
+            if 'raw_reward' in local_buffer:
+                rewards = local_buffer['raw_reward'][:length]
+            else:
+                assert_colorize(self.n_steps == 1 or self.lazy_n_steps, 
+                                'Episode index requires raw_reward of local buffers with n-step rewards')
+                rewards = local_buffer['reward'][:length]
+            self._index_episodes(self._run_indexes(runs), rewards,
+                                 local_buffer['done'][:length], local_buffer['steps'][:length])
+
+        orig_start = 0
+        for start, end in runs:
+            orig_end = orig_start + end - start
+            self._copy_rows(start, end, local_buffer, local_records, orig_start, orig_end)
+            orig_start = orig_end
             
         if self.normalize_reward:
             # compute running reward statistics
             self.running_reward_stats.update(local_buffer['reward'][:length])
 
-        # memory is full, recycle buffer via FIFO
-        if not self.is_full and end_idx >= self.capacity:
+        # memory is full once its last row is written
+        if not self.is_full and any([end == self.capacity for _, end in runs]):
             pwc('Memory is full', 'green')
             self.is_full = True
         
-        self.mem_idx = end_idx % self.capacity
+        self.mem_idx = runs[-1][1] % self.capacity
+
+    def _get_local_records(self, local_buffer):
+        """ Return the records the fields of local_buffer are views of, 
+        if they are in the same layout as self.records """
+        if self.records is None:
+            return None
+        records = local_buffer['state'].base
+        if (records is not None and records.dtype == self.records.dtype 
+                and all([local_buffer[k].base is records for k in records.dtype.names])):
+            return records
+        
+        return None
+
+    def _copy_rows(self, dest_start, dest_end, local_buffer, local_records, orig_start, orig_end):
+        if local_records is None:
+            copy_buffer(self.memory, dest_start, dest_end, local_buffer, orig_start, orig_end)
+        else:
+            # copy raw bytes, which is much faster than copying structured arrays field by field
+            local_bytes = local_records.view(np.uint8).reshape(len(local_records), -1)
+            self.allocator.bytes[dest_start: dest_end] = local_bytes[orig_start: orig_end]
 
     def _get_samples(self, indexes):
         indexes = np.asarray(indexes) # convert tuple to array
-        
-        done = self.memory['done'][indexes]
-        state = self.memory['state'][indexes] 
+
+        if self.preallocate_samples and not self.lazy_n_steps:
+            return self._assemble_samples(indexes)
+
+        if self.records is not None and not self.lazy_n_steps:
+            # gather whole rows as raw bytes at once, fields are views of the gathered rows
+            memory = np.take(self.allocator.bytes, indexes, axis=0).view(self.records.dtype)[:, 0]
+            idxes = slice(None)
+        else:
+            memory = self.memory
+            idxes = indexes
+
+        if self.lazy_n_steps:
+            reward, done, steps = self._compute_n_steps(indexes)
+        else:
+            done = memory['done'][idxes]
+            steps = memory['steps'][idxes]
+            reward = np.copy(memory['reward'][idxes])
+            if self.normalize_reward:
+                reward = self.running_reward_stats.normalize(reward)
+        state = memory['state'][idxes] 
         # squeeze steps since it is of shape [None, 1]
-        next_indexes = (indexes + np.squeeze(self.memory['steps'][indexes])) % self.capacity
+        next_indexes = (indexes + np.squeeze(steps) * self.stride) % self.capacity
         assert indexes.shape == next_indexes.shape
         # using zero state as the terminal state
         next_state = np.where(done, np.zeros_like(state), self.memory['state'][next_indexes])
 
         # process rewards
-        reward = np.copy(self.memory['reward'][indexes])
-        if self.normalize_reward:
-            reward = self.running_reward_stats.normalize(reward)
         reward *= np.where(done, 1, self.reward_scale)
         
         return (
             state,
-            self.memory['action'][indexes],
+            memory['action'][idxes],
             reward,
             next_state,
             done,
-            self.memory['steps'][indexes],
+            steps,
         )
+
+    def _assemble_samples(self, indexes):
+        """ Same as _get_samples, but gathers into the BatchBuffer of the calling thread
+        without allocating batch-sized arrays. All returned arrays are float32 """
+        n = len(indexes)
+        thread_id = threading.get_ident()
+        if thread_id not in self.batch_buffers or self.batch_buffers[thread_id].batch_size < n:
+            assert_colorize(all([isinstance(v, np.ndarray) for v in self.memory.values()]),
+                            'Preallocated samples require memory to be np.ndarray')
+            self.batch_buffers[thread_id] = BatchBuffer(self.memory, n, self.n_sample_slots)
+        scratch, next_indexes, not_done, out = self.batch_buffers[thread_id].get(n)
+
+        # indexes are in range, mode='wrap' saves np.take from buffering out
+        for k in ['state', 'action', 'reward', 'done', 'steps']:
+            np.take(self.memory[k], indexes, axis=0, out=scratch[k], mode='wrap')
+            np.copyto(out[k], scratch[k])
+
+        # next states wrap around the end of memory
+        np.multiply(scratch['steps'][:, 0], self.stride, out=next_indexes)
+        next_indexes += indexes
+        np.take(self.memory['state'], next_indexes, axis=0, out=scratch['state'], mode='wrap')
+        np.copyto(out['next_state'], scratch['state'])
+        # using zero state as the terminal state, only terminal rows are touched
+        out['next_state'][np.flatnonzero(scratch['done'])] = 0
+
+        # process rewards
+        reward = out['reward']
+        if self.normalize_reward:
+            reward -= self.running_reward_stats.mean
+            reward /= self.running_reward_stats.var + self.running_reward_stats.epsilon
+        np.logical_not(scratch['done'], out=not_done)
+        np.multiply(reward, self.reward_scale, out=reward, where=not_done)
+
+        return (
+            out['state'],
+            out['action'],
+            reward,
+            out['next_state'],
+            out['done'],
+            out['steps'],
+        )
+
+    def _compute_n_steps(self, indexes):
+        """ Compute n-step rewards, done flags and steps from one-step transitions,
+        stopping at the end of the episode and at the newest transition in memory """
+        offsets = np.arange(self.n_steps)
+        window = (indexes[:, None] + offsets * self.stride) % self.capacity
+        # the number of transitions of the same environment stored from each index on
+        n_stored = ((self.mem_idx - 1 - indexes) % self.capacity) // self.stride + 1
+        is_stored = offsets < n_stored[:, None]
+
+        flat_window = np.reshape(window, -1)
+        dones = np.reshape(self.memory['done'][flat_window], window.shape) & is_stored
+        rewards = np.reshape(self.memory['reward'][flat_window], window.shape).astype(np.float32)
+        if self.normalize_reward:
+            rewards = self.running_reward_stats.normalize(rewards)
+
+        # transitions after the first done belong to the next episode
+        done = np.any(dones, axis=1)
+        # the next state of the newest transition is not stored yet
+        steps = np.where(done, np.argmax(dones, axis=1) + 1, np.minimum(self.n_steps, n_stored - 1))
+        reward = np.sum(rewards * self.gamma**offsets * (offsets < steps[:, None]), axis=1)
+
+        return reward[:, None], done[:, None], steps[:, None].astype(np.uint8)
@@ -0,0 +1,31 @@
+import numpy as np
+
+
+class BatchBuffer:
+    """ Preallocated arrays into which a consumer assembles sampled batches.
+    Gathers go to scratch arrays in the dtypes of memory, and are then converted
+    to float32 outputs. Outputs rotate through a ring of n_slots sets of arrays: 
+    arrays returned by a call remain valid for the next n_slots - 1 calls """
+    """ Interface """
+    def __init__(self, memory, batch_size, n_slots=2):
+        self.batch_size = batch_size
+        fields = ['state', 'action', 'reward', 'done', 'steps']
+
+        self.scratch = dict([(k, np.empty((batch_size, *memory[k].shape[1:]), dtype=memory[k].dtype))
+                            for k in fields])
+        self.next_indexes = np.empty(batch_size, dtype=np.int64)
+        self.not_done = np.empty((batch_size, 1), dtype=np.bool)
+
+        fields.append('next_state')
+        self.outputs = [dict([(k, np.empty(self.scratch['state' if k == 'next_state' else k].shape,
+                                           dtype=np.float32)) for k in fields])
+                        for _ in range(n_slots)]
+        self.slot = 0
+
+    def get(self, n):
+        """ Return scratch arrays and the next set of outputs for a batch of size n <= batch_size """
+        self.slot = (self.slot + 1) % len(self.outputs)
+        scratch = dict([(k, v[:n]) for k, v in self.scratch.items()])
+        outputs = dict([(k, v[:n]) for k, v in self.outputs[self.slot].items()])
+
+        return scratch, self.next_indexes[:n], self.not_done[:n], outputs
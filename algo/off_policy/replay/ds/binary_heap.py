@@ -0,0 +1,94 @@
+import numpy as np
+from algo.off_policy.replay.ds.container import Container
+
+class BinaryHeap(Container):
+    """ Array-backed max-heap over priorities. positions maps mem_idx to its position
+    in the heap so that the priority of any transition can be updated in O(log n).
+    A heap sorted in descending order is still a valid heap, so heap positions
+    approximate ranks, and sort re-establishes exact ranks """
+    """ Interface """
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.size = 0
+
+        self.container = np.zeros(capacity)                     # heap_idx  -->     priority
+        self.mem_idxs = np.zeros(capacity, dtype=np.int64)      # heap_idx  -->     mem_idx
+        self.positions = -np.ones(capacity, dtype=np.int64)     # mem_idx   -->     heap_idx
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def top_priority(self):
+        return self.container[0]
+
+    def find(self, rank):
+        return self.container[rank], self.mem_idxs[rank]
+
+    def find_batch(self, ranks):
+        return self.container[ranks], self.mem_idxs[ranks]
+
+    def update(self, priority, mem_idx):
+        idx = self.positions[mem_idx]
+        if idx == -1:
+            # insert a new transition at the end of the heap
+            idx = self.size
+            self.size += 1
+            self.mem_idxs[idx] = mem_idx
+            self.positions[mem_idx] = idx
+        self.container[idx] = priority
+
+        if not self._sift_up(idx):
+            self._sift_down(idx)
+
+    def update_batch(self, priorities, mem_idxs):
+        for priority, mem_idx in zip(np.reshape(priorities, -1), mem_idxs):
+            self.update(priority, mem_idx)
+
+    def rebuild(self, priorities):
+        priorities = np.reshape(priorities, -1)
+        self.size = priorities.size
+        self.container[:self.size] = priorities
+        self.mem_idxs[:self.size] = np.arange(self.size)
+        self.positions[:] = -1
+        self.sort()
+
+    def sort(self):
+        """ Sort the heap in descending order, so that the heap_idx of each transition is its rank """
+        order = np.argsort(-self.container[:self.size], kind='stable')
+        self.container[:self.size] = self.container[order]
+        self.mem_idxs[:self.size] = self.mem_idxs[order]
+        self.positions[self.mem_idxs[:self.size]] = np.arange(self.size)
+
+    """ Implementation """
+    def _swap(self, i, j):
+        self.container[i], self.container[j] = self.container[j], self.container[i]
+        self.mem_idxs[i], self.mem_idxs[j] = self.mem_idxs[j], self.mem_idxs[i]
+        self.positions[self.mem_idxs[i]] = i
+        self.positions[self.mem_idxs[j]] = j
+
+    def _sift_up(self, idx):
+        """ Return True if the node has been moved """
+        moved = False
+        while idx > 0:
+            parent = (idx - 1) // 2
+            if self.container[parent] >= self.container[idx]:
+                break
+            self._swap(idx, parent)
+            idx = parent
+            moved = True
+
+        return moved
+
+    def _sift_down(self, idx):
+        while True:
+            left, right = 2 * idx + 1, 2 * idx + 2
+            largest = idx
+            if left < self.size and self.container[left] > self.container[largest]:
+                largest = left
+            if right < self.size and self.container[right] > self.container[largest]:
+                largest = right
+            if largest == idx:
+                break
+            self._swap(idx, largest)
+            idx = largest
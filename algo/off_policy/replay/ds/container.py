@@ -1,4 +1,5 @@
 from collections import namedtuple
+import numpy as np
 
 class Container():
     """ Interface """
@@ -12,5 +13,30 @@ class Container():
     def update(self, priority, mem_idx):
         raise NotImplementedError
 
+    def update_batch(self, priorities, mem_idxs):
+        raise NotImplementedError
+
+    def rebuild(self, priorities):
+        raise NotImplementedError
+
+    def get_batch(self, mem_idxs):
+        """ Return priorities at mem_idxs """
+        raise NotImplementedError
+
     def find(self, value):
         raise NotImplementedError
+
+    def find_batch(self, values):
+        raise NotImplementedError
+
+    def get_state(self):
+        """ Return the arrays and scalars that describe the data structure, lists are views and are skipped """
+        return dict([(k, v) for k, v in vars(self).items() if not isinstance(v, list)])
+
+    def set_state(self, state):
+        for k, v in state.items():
+            if isinstance(v, np.ndarray):
+                # copy in place to keep views (and shared memory) valid
+                getattr(self, k)[...] = v
+            else:
+                setattr(self, k, v)
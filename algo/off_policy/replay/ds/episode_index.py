@@ -0,0 +1,107 @@
+import numpy as np
+
+
+class EpisodeIndex:
+    """ Incremental index of the episodes stored in a replay of capacity rows.
+    An episode is a contiguous run of rows ending with a terminal row, i.e., a row
+    with done set and steps == 1 (done flags of the preceding n-step rows are set too).
+    Rows are written in FIFO order, so evicted rows are always at the head of their episodes.
+    Episode i is kept in slot i % capacity of start, length and ret; live episodes never
+    share a slot since each holds at least one row. The newest episode is open until
+    its terminal row is added """
+    """ Interface """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.episode_ids = np.full(capacity, -1, dtype=np.int64)    # mem_idx   -->     episode id
+        # slot      -->     start mem_idx, length and (undiscounted) return of the episode
+        self.start = np.zeros(capacity, dtype=np.int64)
+        self.length = np.zeros(capacity, dtype=np.int64)
+        self.ret = np.zeros(capacity, dtype=np.float64)
+        # mem_idx   -->     one-step reward of the row, which stored rewards are not if n_steps > 1
+        self.rewards = np.zeros(capacity, dtype=np.float64)
+
+        self.next_id = 0        # id of the next new episode
+        self.is_open = False    # whether episode next_id - 1 is still open
+        self.n_episodes = 0     # the number of live episodes, including the open one
+
+    def find(self, mem_idx):
+        """ Return the id of the episode containing mem_idx, -1 if there is none """
+        return self.episode_ids[mem_idx]
+
+    def get(self, episode_id):
+        """ Return start, length and return of the episode """
+        slot = episode_id % self.capacity
+
+        return self.start[slot], self.length[slot], self.ret[slot]
+
+    def slices(self, episode_id):
+        """ Return one or two slices of memory rows holding the episode, in order """
+        start, length, _ = self.get(episode_id)
+        end = start + length
+        if end <= self.capacity:
+            return [slice(start, end)]
+        else:
+            return [slice(start, self.capacity), slice(0, end - self.capacity)]
+
+    def rows(self, episode_id):
+        start, length, _ = self.get(episode_id)
+
+        return (start + np.arange(length)) % self.capacity
+
+    def live_episodes(self):
+        """ Return ids of live episodes from the oldest to the newest """
+        ids = np.arange(max(self.next_id - self.capacity, 0), self.next_id)
+
+        return ids[self.length[ids % self.capacity] > 0]
+
+    def evict(self, mem_idxs):
+        """ Remove rows at mem_idxs, which are about to be overwritten, from their episodes.
+        Return ids of episodes, other than the open one, that are only partially evicted """
+        ids = self.episode_ids[mem_idxs]
+        valid = ids >= 0
+        if not np.any(valid):
+            return ids[:0]
+        ids, inverse, counts = np.unique(ids[valid], return_inverse=True, return_counts=True)
+        slots = ids % self.capacity
+        self.length[slots] -= counts
+        self.start[slots] = (self.start[slots] + counts) % self.capacity
+        self.ret[slots] -= np.bincount(inverse, weights=self.rewards[mem_idxs][valid])
+        self.episode_ids[mem_idxs] = -1
+
+        closed = ids != self.next_id - 1 if self.is_open else np.ones_like(ids, dtype=np.bool)
+        self.n_episodes -= np.sum(closed & (self.length[slots] == 0))
+
+        return ids[closed & (self.length[slots] > 0)]
+
+    def add(self, mem_idxs, rewards, terminals):
+        """ Append rows at mem_idxs, with one-step rewards, to the open episode, closing it at terminal rows """
+        terminals = np.reshape(terminals, -1)
+        rewards = np.reshape(rewards, -1)
+        self.rewards[mem_idxs] = rewards
+        # a row starts a new episode if it follows a terminal row, or if no episode is open
+        starts = np.empty(terminals.shape, dtype=np.bool)
+        starts[0] = not self.is_open
+        starts[1:] = terminals[:-1]
+        ids = self.next_id - 1 + np.cumsum(starts)
+        self.episode_ids[mem_idxs] = ids
+
+        new_slots = ids[starts] % self.capacity
+        self.start[new_slots] = mem_idxs[starts]
+        self.length[new_slots] = 0
+        self.ret[new_slots] = 0
+        ids, inverse, counts = np.unique(ids, return_inverse=True, return_counts=True)
+        slots = ids % self.capacity
+        self.length[slots] += counts
+        self.ret[slots] += np.bincount(inverse, weights=rewards)
+
+        self.n_episodes += np.sum(starts)
+        self.next_id = ids[-1] + 1
+        self.is_open = not terminals[-1]
+
+    def remove(self, episode_id):
+        """ Remove the episode from the index, its rows no longer belong to any episode """
+        self.episode_ids[self.rows(episode_id)] = -1
+        self.length[episode_id % self.capacity] = 0
+        self.n_episodes -= 1
+        if self.is_open and episode_id == self.next_id - 1:
+            self.is_open = False
@@ -0,0 +1,88 @@
+import numpy as np
+from algo.off_policy.replay.ds.container import Container
+
+class KarySumTree(Container):
+    """ Sum tree with fanout k. Each level is stored contiguously
+    and is padded to a multiple of k, so that the children of a node
+    occupy a single k-block, which fits in a cache line when k * itemsize == 64 """
+    """ Interface """
+    def __init__(self, capacity, fanout=16, leaf_dtype=np.float64):
+        super().__init__(capacity)
+        self.fanout = fanout
+
+        # the number of nodes at each level, from the leaves up to the root
+        sizes = [int(np.ceil(capacity / fanout)) * fanout]
+        while sizes[-1] > 1:
+            n = int(np.ceil(sizes[-1] / fanout))
+            sizes.append(n if n == 1 else int(np.ceil(n / fanout)) * fanout)
+        sizes = sizes[::-1]
+
+        # internal nodes are kept in float64 to avoid accumulating rounding errors in sums
+        self.container = np.zeros(sum(sizes[:-1]))
+        offsets = np.cumsum([0] + sizes[:-1])
+        self.levels = [self.container[s: e] for s, e in zip(offsets[:-1], offsets[1:])]
+        self.leaves = np.zeros(sizes[-1], dtype=leaf_dtype)
+        self.levels.append(self.leaves)
+
+    @property
+    def total_priorities(self):
+        return self.container[0]
+
+    def find(self, value):
+        idx = 0                 # start from the root
+
+        for level in self.levels[1:]:
+            block = level[idx * self.fanout: (idx + 1) * self.fanout]
+            cumsum = np.cumsum(block)
+            # clip value to avoid descending into zero-priority children due to rounding errors
+            value = min(value, cumsum[-1])
+            child = np.searchsorted(cumsum, value)
+            if child > 0:
+                value -= cumsum[child - 1]
+            idx = idx * self.fanout + child
+
+        return self.leaves[idx], idx
+
+    def find_batch(self, values):
+        values = np.array(values, dtype=np.float64)
+        idxes = np.zeros(values.shape, dtype=np.int64)
+
+        for level in self.levels[1:]:
+            blocks = level.reshape(-1, self.fanout)[idxes]
+            cumsum = np.cumsum(blocks, axis=1)
+            values = np.minimum(values, cumsum[:, -1])
+            children = np.sum(cumsum < values[:, None], axis=1)
+            values -= np.where(children > 0, cumsum[np.arange(children.size), children - 1], 0)
+            idxes = idxes * self.fanout + children
+
+        return self.leaves[idxes], idxes
+
+    def update(self, priority, mem_idx):
+        self.leaves[mem_idx] = priority
+
+        idx = mem_idx
+        for parent_level, level in zip(self.levels[-2::-1], self.levels[:0:-1]):
+            idx //= self.fanout
+            parent_level[idx] = np.sum(level[idx * self.fanout: (idx + 1) * self.fanout])
+
+    def update_batch(self, priorities, mem_idxs):
+        mem_idxs = np.asarray(mem_idxs)
+        self.leaves[mem_idxs] = np.reshape(priorities, -1)
+
+        idxes = np.unique(mem_idxs)
+        for parent_level, level in zip(self.levels[-2::-1], self.levels[:0:-1]):
+            idxes = np.unique(idxes // self.fanout)
+            parent_level[idxes] = np.sum(level.reshape(-1, self.fanout)[idxes], axis=1)
+
+    def get_batch(self, mem_idxs):
+        return self.leaves[mem_idxs]
+
+    def rebuild(self, priorities):
+        priorities = np.reshape(priorities, -1)
+        self.leaves[:] = 0
+        self.leaves[:priorities.size] = priorities
+
+        for parent_level, level in zip(self.levels[-2::-1], self.levels[:0:-1]):
+            sums = np.sum(level.reshape(-1, self.fanout), axis=1)
+            parent_level[:] = 0
+            parent_level[:sums.size] = sums
@@ -0,0 +1,40 @@
+import numpy as np
+from algo.off_policy.replay.ds.container import Container
+
+class MinTree(Container):
+    """ Binary tree whose internal nodes hold the minimum of their children,
+    laid out as SumTree. Leaves are initialized to inf """
+    """ Interface """
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.tree_size = capacity - 1
+
+        self.container = np.full(self.tree_size + self.capacity, np.inf)
+
+    @property
+    def min_value(self):
+        return self.container[0]
+
+    def find_min(self):
+        """ Return the minimum leaf and its index """
+        idx = 0                 # start from the root
+
+        while idx < self.tree_size:
+            left = 2 * idx + 1
+            idx = left if self.container[left] <= self.container[left + 1] else left + 1
+
+        return self.container[idx], idx - self.tree_size
+
+    def update(self, value, mem_idx):
+        self.update_batch([value], [mem_idx])
+
+    def update_batch(self, values, mem_idxs):
+        idxes = np.asarray(mem_idxs) + self.tree_size
+        self.container[idxes] = np.reshape(values, -1)
+
+        idxes = np.unique(idxes)
+        while True:
+            idxes = np.unique((idxes[idxes > 0] - 1) // 2)  # update idxes to their parent idxes
+            if idxes.size == 0:
+                break
+            self.container[idxes] = np.minimum(self.container[2 * idxes + 1], self.container[2 * idxes + 2])
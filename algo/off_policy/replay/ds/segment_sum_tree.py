@@ -0,0 +1,75 @@
+import numpy as np
+from algo.off_policy.replay.ds.sum_tree import SumTree
+from algo.off_policy.replay.ds.min_tree import MinTree
+
+class SegmentSumTree(SumTree):
+    """ SumTree that also keeps the total priority of each segment of segment_size
+    consecutive leaves, and a MinTree over segments keyed by their eviction scores.
+    The score of a segment is log(total priority) + write_time / age_scale,
+    i.e., the log of its total priority decayed by exp(-age / age_scale),
+    which orders segments the same no matter when it's evaluated.
+    Segments are not evictable until they are completely written """
+    """ Interface """
+    def __init__(self, capacity, segment_size, age_scale=None):
+        super().__init__(capacity)
+        self.segment_size = segment_size
+        self.n_segments = capacity // segment_size
+        self.age_scale = age_scale
+
+        self.segment_priorities = np.zeros(self.n_segments)
+        self.write_time = np.zeros(self.n_segments)
+        self.evictable = np.zeros(self.n_segments, dtype=np.bool)
+        self.scores = MinTree(self.n_segments)
+
+    def update(self, priority, mem_idx):
+        segment = mem_idx // self.segment_size
+        self.segment_priorities[segment] += priority - self.container[self.tree_size + mem_idx]
+        super().update(priority, mem_idx)
+        self._update_scores(np.array([segment]))
+
+    def update_batch(self, priorities, mem_idxs):
+        priorities = np.reshape(priorities, -1)
+        mem_idxs = np.asarray(mem_idxs)
+        # as in SumTree, the last priority takes effect if a leaf is updated more than once
+        _, last = np.unique(mem_idxs[::-1], return_index=True)
+        last = mem_idxs.size - 1 - last
+        segments = mem_idxs[last] // self.segment_size
+        np.add.at(self.segment_priorities, segments,
+                  priorities[last] - self.container[self.tree_size + mem_idxs[last]])
+        super().update_batch(priorities, mem_idxs)
+        self._update_scores(np.unique(segments))
+
+    def rebuild(self, priorities):
+        super().rebuild(priorities)
+        leaves = self.container[self.tree_size:]
+        self.segment_priorities[:] = np.sum(np.reshape(leaves, (self.n_segments, -1)), axis=1)
+        self._update_scores(np.arange(self.n_segments))
+
+    def start_segment(self, segment, write_time):
+        """ Record that the segment is being written at write_time.
+        It's not evictable until finish_segment is called """
+        self.write_time[segment] = write_time
+        self.evictable[segment] = False
+        self._update_scores(np.array([segment]))
+
+    def finish_segment(self, segment):
+        """ Make the segment evictable, as it's completely written and its priorities are set """
+        self.evictable[segment] = True
+        self._update_scores(np.array([segment]))
+
+    def pop_min_segment(self):
+        """ Return the evictable segment with the lowest score, which is no longer evictable """
+        score, segment = self.scores.find_min()
+        assert score < np.inf, 'No segment is evictable'
+        self.evictable[segment] = False
+        self._update_scores(np.array([segment]))
+
+        return segment
+
+    """ Implementation """
+    def _update_scores(self, segments):
+        # segments of zero priority come first
+        scores = np.log(np.maximum(self.segment_priorities[segments], np.finfo(np.float64).tiny))
+        if self.age_scale:
+            scores += self.write_time[segments] / self.age_scale
+        self.scores.update_batch(np.where(self.evictable[segments], scores, np.inf), segments)
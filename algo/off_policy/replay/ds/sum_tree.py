@@ -26,12 +26,65 @@ class SumTree(Container):
 
         return self.container[idx], idx - self.tree_size
 
+    def find_batch(self, values, return_residuals=False):
+        """ Vectorized version of find, descending all values level by level.
+        If return_residuals, also return the values remaining at the leaves found """
+        values = np.array(values, dtype=np.float64)     # copy since values are modified in place
+        idxes = np.zeros(values.shape, dtype=np.int64)  # start from the root
+
+        # leaves of a non-power-of-two tree may sit at different depths, 
+        # so we only keep descending those values that have not yet reached a leaf
+        active = np.flatnonzero(idxes < self.tree_size)
+        while active.size > 0:
+            left = 2 * idxes[active] + 1
+            left_values = self.container[left]
+            go_left = values[active] <= left_values
+            idxes[active] = np.where(go_left, left, left + 1)
+            values[active] -= np.where(go_left, 0, left_values)
+            active = active[idxes[active] < self.tree_size]
+
+        if return_residuals:
+            return self.container[idxes], idxes - self.tree_size, values
+
+        return self.container[idxes], idxes - self.tree_size
+
     def update(self, priority, mem_idx):
         idx = mem_idx + self.tree_size
         self.container[idx] = priority
 
         self._propagate(idx)
 
+    def update_batch(self, priorities, mem_idxs):
+        """ Vectorized version of update, recomputing each affected ancestor once per level """
+        idxes = np.asarray(mem_idxs) + self.tree_size
+        self.container[idxes] = np.reshape(priorities, -1)
+
+        # a node is recomputed in the last iteration in which it appears, 
+        # which always comes after its children have been recomputed
+        idxes = np.unique(idxes)
+        while True:
+            idxes = np.unique((idxes[idxes > 0] - 1) // 2)  # update idxes to their parent idxes
+            if idxes.size == 0:
+                break
+            self.container[idxes] = self.container[2 * idxes + 1] + self.container[2 * idxes + 2]
+
+    def get_batch(self, mem_idxs):
+        return self.container[self.tree_size + np.asarray(mem_idxs)]
+
+    def rebuild(self, priorities):
+        """ Rebuild the whole tree from priorities in O(n), leaves beyond len(priorities) are zeroed """
+        priorities = np.reshape(priorities, -1)
+        self.container[self.tree_size:] = 0
+        self.container[self.tree_size: self.tree_size + priorities.size] = priorities
+
+        # recompute internal nodes level by level from bottom to top
+        depth = int(np.ceil(np.log2(self.capacity))) if self.capacity > 1 else 0
+        for level in reversed(range(depth)):
+            start = 2**level - 1
+            end = min(2**(level + 1) - 1, self.tree_size)
+            idxes = np.arange(start, end)
+            self.container[idxes] = self.container[2 * idxes + 1] + self.container[2 * idxes + 2]
+
     def _propagate(self, idx):
         while idx > 0:
             idx = (idx - 1) // 2    # update idx to its parent idx
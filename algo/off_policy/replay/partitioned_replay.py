@@ -0,0 +1,177 @@
+import os, pickle
+import threading
+import numpy as np
+
+from utility.debug_tools import assert_colorize
+from utility.utils import to_int
+from utility.schedule import PiecewiseSchedule
+from algo.off_policy.replay.rate_limiter import get_rate_limiter
+from algo.off_policy.replay.ds.sum_tree import SumTree
+from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+
+
+class PartitionedReplay:
+    """ Prioritized replay split into n_partitions ProportionalPrioritizedReplays,
+    one for each task or group of workers, each with its own region and sum tree.
+    A top-level sum tree stores the total priority of each partition times its weight,
+    so a transition is sampled with probability weight * priority / total of the top tree.
+    Sampling descends the top tree, and then continues with the remaining value,
+    scaled by the inverse weight, in the tree of the partition found """
+    """ Interface """
+    def __init__(self, args, state_shape, action_dim):
+        self.n_partitions = args['n_partitions']
+        self.capacity = to_int(args['capacity'])
+        self.min_size = to_int(args['min_size'])
+        self.batch_size = args['batch_size']
+
+        # global indexes assume partitions of equal capacity
+        assert_colorize(self.capacity % self.n_partitions == 0, 
+                        f'Capacity {self.capacity} is not a multiple of the number of partitions {self.n_partitions}')
+        partition_args = args.copy()
+        partition_args['capacity'] = self.partition_capacity = self.capacity // self.n_partitions
+        partition_args['min_size'] = self.min_size // self.n_partitions
+        # partitions are sampled through the top tree, the rate is limited here instead of per partition
+        partition_args.pop('samples_per_insert', None)
+        self.partitions = [ProportionalPrioritizedReplay(partition_args, state_shape, action_dim)
+                            for _ in range(self.n_partitions)]
+
+        self.weights = np.ones(self.n_partitions)
+        if 'partition_weights' in args:
+            self.weights[:] = args['partition_weights']
+        self.top_tree = SumTree(self.n_partitions)          # partition     -->     weight * total priority
+
+        # params for prioritized replay
+        self.beta = float(args['beta0']) if 'beta0' in args else .4
+        self.beta_schedule = PiecewiseSchedule([(0, args['beta0']), (float(args['beta_steps']), 1.)],
+                                                outside_value=1.)
+        self.sample_i = 0   # count how many times self.sample is called
+
+        self.rate_limiter = get_rate_limiter(args)
+        # locker for the top tree and weights
+        self.locker = threading.Lock()
+
+    @property
+    def good_to_learn(self):
+        return len(self) >= self.min_size
+
+    @property
+    def top_priority(self):
+        return max([partition.top_priority for partition in self.partitions])
+
+    def __len__(self):
+        return sum([len(partition) for partition in self.partitions])
+
+    def __call__(self):
+        while True:
+            yield self.sample()
+
+    def sample(self):
+        assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
+                                            f'transitions in buffer: {len(self)}\t'
+                                            f'minimum required size: {self.min_size}')
+        if self.rate_limiter is not None:
+            self.rate_limiter.await_sample(self.batch_size)
+        with self.locker:
+            total_priorities = self.top_tree.total_priorities
+            # stratified sampling over the top tree
+            bounds = np.arange(self.batch_size + 1) * total_priorities / self.batch_size
+            values = np.random.uniform(bounds[:-1], bounds[1:])
+            # values are what remain after descending the top tree
+            _, partition_nos, values = self.top_tree.find_batch(values, return_residuals=True)
+            weights = self.weights[partition_nos]
+            self.sample_i += 1
+            self.beta = self.beta_schedule.value(self.sample_i)
+
+        priorities = np.zeros(self.batch_size)
+        indexes = np.zeros(self.batch_size, dtype=np.int64)
+        for partition_no in np.unique(partition_nos):
+            partition = self.partitions[partition_no]
+            mask = partition_nos == partition_no
+            with partition.locker:
+                tree = partition.data_structure
+                partition_values = np.clip(values[mask] / self.weights[partition_no], 0, tree.total_priorities)
+                priorities[mask], indexes[mask] = tree.find_batch(partition_values)
+
+        # gather transitions outside the critical section
+        fields = None
+        for partition_no in np.unique(partition_nos):
+            mask = partition_nos == partition_no
+            partition_samples = self.partitions[partition_no]._get_samples(indexes[mask])
+            if fields is None:
+                fields = [np.zeros((self.batch_size, *v.shape[1:]), dtype=v.dtype) for v in partition_samples]
+            for field, v in zip(fields, partition_samples):
+                field[mask] = v
+        samples = tuple(fields)
+
+        probabilities = weights * priorities / total_priorities
+        IS_ratios = (np.min(probabilities) / probabilities)**self.beta
+        indexes = partition_nos * self.partition_capacity + indexes
+
+        return IS_ratios, indexes, samples
+
+    def add(self, state, action, reward, done, partition_no=0):
+        if self.rate_limiter is not None:
+            self.rate_limiter.await_insert(1)
+        self.partitions[partition_no].add(state, action, reward, done)
+        self._update_top([partition_no])
+
+    def merge(self, local_buffer, length, partition_no=0):
+        if self.rate_limiter is not None:
+            self.rate_limiter.await_insert(length)
+        partition = self.partitions[partition_no]
+        partition.merge(local_buffer, length)
+        self._update_top([partition_no])
+
+    def update_priorities(self, priorities, saved_mem_idxs):
+        priorities = np.reshape(priorities, -1)
+        saved_mem_idxs = np.asarray(saved_mem_idxs)
+        partition_nos = saved_mem_idxs // self.partition_capacity
+        unique_nos = np.unique(partition_nos)
+        for partition_no in unique_nos:
+            mask = partition_nos == partition_no
+            self.partitions[partition_no].update_priorities(priorities[mask],
+                                                            saved_mem_idxs[mask] % self.partition_capacity)
+        self._update_top(unique_nos)
+
+    def set_weights(self, weights):
+        """ Set mixing weights of partitions, which take effect from the next batch """
+        with self.locker:
+            self.weights[:] = weights
+        self._update_top(np.arange(self.n_partitions))
+
+    def save(self, directory):
+        for i, partition in enumerate(self.partitions):
+            partition.save(os.path.join(directory, f'partition{i}'))
+        with open(os.path.join(directory, 'state.pkl'), 'wb') as f:
+            state = dict(sample_i=self.sample_i, beta=self.beta, weights=self.weights)
+            if self.rate_limiter is not None:
+                state['rate_limiter'] = self.rate_limiter.get_state()
+            pickle.dump(state, f)
+
+    def restore(self, directory):
+        for i, partition in enumerate(self.partitions):
+            partition.restore(os.path.join(directory, f'partition{i}'))
+        with open(os.path.join(directory, 'state.pkl'), 'rb') as f:
+            state = pickle.load(f)
+        self.sample_i = state['sample_i']
+        self.beta = state['beta']
+        self.set_weights(state['weights'])
+        if self.rate_limiter is not None and 'rate_limiter' in state:
+            self.rate_limiter.set_state(state['rate_limiter'])
+
+    def get_stats(self):
+        stats = dict(Size=len(self))
+        if self.rate_limiter is not None:
+            stats.update(self.rate_limiter.get_stats())
+        for i, partition in enumerate(self.partitions):
+            stats[f'partition{i}_Weight'] = self.weights[i]
+            stats.update(dict([(f'partition{i}_{k}', v) for k, v in partition.get_stats().items()]))
+
+        return stats
+
+    """ Implementation """
+    def _update_top(self, partition_nos):
+        """ Update the top tree with the current totals of partitions """
+        totals = np.array([self.partitions[i].data_structure.total_priorities for i in partition_nos])
+        with self.locker:
+            self.top_tree.update_batch(totals * self.weights[partition_nos], partition_nos)
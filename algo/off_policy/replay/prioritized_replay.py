@@ -25,10 +25,11 @@ class PrioritizedReplay(Replay):
 
         self.sample_i = 0   # count how many times self.sample is called
 
-        init_buffer(self.memory, self.capacity, state_shape, action_dim, self.n_steps == 1)
+        init_buffer(self.memory, self.capacity, state_shape, action_dim, 
+                    self.n_steps == 1 or self.lazy_n_steps, allocator=self.allocator)
 
         # Code for single agent
-        if self.n_steps > 1:
+        if self.n_steps > 1 and not self.lazy_n_steps:
             self.tb_capacity = args['tb_capacity']
             self.tb_idx = 0
             self.tb_full = False
@@ -40,6 +41,7 @@ class PrioritizedReplay(Replay):
         assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
                                             f'transitions in buffer: {len(self)}\t'
                                             f'minimum required size: {self.min_size}')
+        self._await_sample(self.batch_size)
         with self.locker:        
             samples = self._sample()
             self.sample_i += 1
@@ -47,36 +49,89 @@ class PrioritizedReplay(Replay):
 
         return samples
 
+    @override(Replay)
+    def sample_many(self, n_batches):
+        assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
+                                            f'transitions in buffer: {len(self)}\t'
+                                            f'minimum required size: {self.min_size}')
+        self._await_sample(n_batches * self.batch_size)
+        with self.locker:
+            # all batches share the same beta
+            samples = self._sample_many(n_batches)
+            self.sample_i += n_batches
+            self._update_beta()
+
+        return samples
+
     @override(Replay)
     def add(self, state, action, reward, done):
-        if self.n_steps > 1:
-            self.tb['priority'][self.tb_idx] = self.top_priority
-        else:
-            self.memory['priority'][self.mem_idx] = self.top_priority
-            self.data_structure.update(self.top_priority, self.mem_idx)
+        # priorities of lazy n-step transitions are assigned in self._add_rows
+        if not self.lazy_n_steps:
+            if self.n_steps > 1:
+                self.tb['priority'][self.tb_idx] = self.top_priority
+            else:
+                self.memory['priority'][self.mem_idx] = self.top_priority
+                self.data_structure.update(self.top_priority, self.mem_idx)
         super()._add(state, action, reward, done)
 
     def update_priorities(self, priorities, saved_mem_idxs):
         with self.locker:
-            if self.to_update_priority:
-                self.top_priority = max(self.top_priority, np.max(priorities))
-            for priority, mem_idx in zip(priorities, saved_mem_idxs):
-                self.data_structure.update(priority, mem_idx)
+            self._update_priorities(priorities, saved_mem_idxs)
 
     """ Implementation """
+    def _update_priorities(self, priorities, saved_mem_idxs):
+        """ Apply priorities computed by the learner, which is called with self.locker held """
+        if self.to_update_priority:
+            self.top_priority = max(self.top_priority, np.max(priorities))
+        self.data_structure.update_batch(priorities, saved_mem_idxs)
+
     def _update_beta(self):
         self.beta = self.beta_schedule.value(self.sample_i)
 
+    @override(Replay)
+    def _add_rows(self, rows, length):
+        if 'priority' in rows:
+            rows['priority'][:] = self.top_priority
+        else:
+            rows['priority'] = np.full((length, 1), self.top_priority)
+        if not self.lazy_n_steps:
+            super()._add_rows(rows, length)
+            return
+
+        # a lazy n-step transition is not sampled until its next state is stored,
+        # i.e., until the next block is added, unless it's done
+        prev_idxs = (self.mem_idx - self.stride + np.arange(self.stride)) % self.capacity
+        prev_idxs = prev_idxs[~self.memory['done'][prev_idxs][:, 0]] if len(self) else prev_idxs[:0]
+        mem_idxs = (self.mem_idx + np.arange(length)) % self.capacity
+        super()._add_rows(rows, length)
+        self.data_structure.update_batch(np.full(prev_idxs.shape, self.top_priority), prev_idxs)
+        not_done_idxs = mem_idxs[~rows['done'][:, 0]]
+        self.data_structure.update_batch(np.zeros(not_done_idxs.shape), not_done_idxs)
+
     @override(Replay)
     def _merge(self, local_buffer, length):
-        end_idx = self.mem_idx + length
+        runs = self._allocate_rows(length)
         assert np.all(local_buffer['priority'][: length])
-        for idx, mem_idx in enumerate(range(self.mem_idx, end_idx)):
-            self.data_structure.update(local_buffer['priority'][idx], mem_idx % self.capacity)
+        self.data_structure.update_batch(local_buffer['priority'][: length], self._run_indexes(runs))
             
-        super()._merge(local_buffer, length)
+        self._write_rows(local_buffer, length, runs)
         
+    @override(Replay)
+    def _get_state(self):
+        state = super()._get_state()
+        state.update(dict(top_priority=self.top_priority, sample_i=self.sample_i, beta=self.beta,
+                          data_structure=self.data_structure.get_state()))
+
+        return state
+
+    @override(Replay)
+    def _set_state(self, state):
+        state = state.copy()
+        self.data_structure.set_state(state.pop('data_structure'))
+        super()._set_state(state)
+
     def _compute_IS_ratios(self, probabilities):
-        IS_ratios = (np.min(probabilities) / probabilities)**self.beta
+        # normalize within each batch
+        IS_ratios = (np.min(probabilities, axis=-1, keepdims=True) / probabilities)**self.beta
 
         return IS_ratios
@@ -0,0 +1,128 @@
+from collections import deque
+import multiprocessing
+import numpy as np
+
+from utility.debug_tools import assert_colorize
+from algo.off_policy.replay.ds.sum_tree import SumTree
+from algo.off_policy.replay.storage import shared_array, share_array
+
+
+class ProcessSampler:
+    """ Sample from a ProportionalPrioritizedReplay in n_processes background processes.
+    The replay memory and its sum tree live in shared memory, and sampler processes
+    write ready batches into a preallocated shared-memory ring of ring_size slots,
+    which the learner dequeues without copying; a dequeued batch remains valid until
+    n_held more are requested. Priority updates are sent to sampler processes
+    through a queue, and are applied before the next batch is sampled.
+
+    Sampler processes are forked at construction, so it should be constructed before
+    any tf.Session. Attributes not defined here are forwarded to the replay """
+    """ Interface """
+    def __init__(self, replay, n_processes, ring_size, n_held=1):
+        assert_colorize(isinstance(replay.data_structure, SumTree),
+                        'ProcessSampler only supports replay backed by SumTree')
+        assert_colorize(not replay.normalize_reward,
+                        'Running reward statistics are not shared with sampler processes')
+        assert_colorize(replay.eviction == 'fifo',
+                        'Segment priorities are not shared with sampler processes')
+        assert_colorize(replay.rate_limiter is None,
+                        'Rate limiting is not supported by sampler processes')
+        assert_colorize(ring_size > n_held, 
+                        f'Ring size({ring_size}) must be larger than the number of held batches({n_held})')
+        self.replay = replay
+        self.ring_size = ring_size
+        self.n_held = n_held
+        ctx = multiprocessing.get_context('fork')
+
+        # share the sum tree and the lock with sampler processes
+        replay.data_structure.container = share_array(replay.data_structure.container)
+        replay.locker = ctx.Lock()
+        self.sample_i = ctx.Value('l', 0, lock=False)   # count how many batches are sampled, used for beta
+
+        # preallocate the ring buffer according to the structure of a sampled batch
+        indexes = np.zeros(replay.batch_size, dtype=np.int64)
+        self.ring_IS_ratios = shared_array((ring_size, replay.batch_size), np.float64)
+        self.ring_indexes = shared_array((ring_size, replay.batch_size), np.int64)
+        self.ring_samples = tuple([shared_array((ring_size, *v.shape), v.dtype)
+                                    for v in replay._get_samples(indexes)])
+
+        self.free_slots = ctx.Queue()
+        self.ready_slots = ctx.Queue()
+        for slot in range(ring_size):
+            self.free_slots.put(slot)
+        self.priority_queue = ctx.Queue()
+        # queued updates may not be readable yet, so processes count those sent and applied
+        self.n_updates_sent = ctx.Value('l', 0, lock=False)
+        self.n_updates_applied = ctx.Value('l', 0, lock=False)
+        self.start_event = ctx.Event()
+
+        self.processes = [ctx.Process(target=self._sample_loop, daemon=True) for _ in range(n_processes)]
+        for p in self.processes:
+            p.start()
+
+    def __getattr__(self, name):
+        return getattr(self.replay, name)
+
+    def __call__(self):
+        assert_colorize(self.replay.good_to_learn, 'There are not sufficient transitions to start learning --- '
+                                                   f'transitions in buffer: {len(self.replay)}\t'
+                                                   f'minimum required size: {self.replay.min_size}')
+        self.start_event.set()
+        held = deque()
+        while True:
+            # the consumer may still hold the last n_held batches, e.g., tensors 
+            # prefetched by tf.data that alias the ring, so only older ones are freed
+            if len(held) == self.n_held:
+                self.free_slots.put(held.popleft())
+            slot = self.ready_slots.get()
+            held.append(slot)
+            yield (self.ring_IS_ratios[slot],
+                   self.ring_indexes[slot],
+                   tuple([v[slot] for v in self.ring_samples]))
+
+    def __len__(self):
+        return len(self.replay)
+
+    def sample(self):
+        """ Sample a batch in the current process, returned arrays are not views of the ring """
+        return self.replay.sample()
+
+    def update_priorities(self, priorities, saved_mem_idxs):
+        if self.replay.to_update_priority:
+            self.replay.top_priority = max(self.replay.top_priority, np.max(priorities))
+        self.priority_queue.put((np.copy(priorities), np.copy(saved_mem_idxs)))
+        self.n_updates_sent.value += 1
+
+    def save(self, directory):
+        self.replay.sample_i = self.sample_i.value
+        self.replay.save(directory)
+
+    def restore(self, directory):
+        self.replay.restore(directory)
+        self.sample_i.value = self.replay.sample_i
+
+    """ Implementation """
+    def _sample_loop(self):
+        np.random.seed()    # forked processes share the random state of the parent
+        self.start_event.wait()
+        while True:
+            slot = self.free_slots.get()
+            with self.replay.locker:
+                self._apply_priority_updates()
+                self.replay.beta = self.replay.beta_schedule.value(self.sample_i.value)
+                self.sample_i.value += 1
+                IS_ratios, indexes, samples = self.replay._sample()
+
+            self.ring_IS_ratios[slot] = IS_ratios
+            self.ring_indexes[slot] = indexes
+            for ring, v in zip(self.ring_samples, samples):
+                ring[slot] = v
+            self.ready_slots.put(slot)
+
+    def _apply_priority_updates(self):
+        """ Apply all priority updates sent so far, with self.replay.locker held """
+        while self.n_updates_applied.value < self.n_updates_sent.value:
+            # wait for updates that are sent but not yet flushed to the queue
+            priorities, saved_mem_idxs = self.priority_queue.get()
+            self.replay._update_priorities(priorities, saved_mem_idxs)
+            self.n_updates_applied.value += 1
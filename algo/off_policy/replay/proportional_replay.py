@@ -1,8 +1,12 @@
+from collections import deque
 import numpy as np
-import ray
 
 from utility.decorators import override
+from utility.debug_tools import assert_colorize
+from utility.utils import to_int
 from algo.off_policy.replay.ds.sum_tree import SumTree
+from algo.off_policy.replay.ds.segment_sum_tree import SegmentSumTree
+from algo.off_policy.replay.ds.kary_sum_tree import KarySumTree
 from algo.off_policy.replay.prioritized_replay import PrioritizedReplay
 
 
@@ -10,19 +14,207 @@ class ProportionalPrioritizedReplay(PrioritizedReplay):
     """ Interface """
     def __init__(self, args, state_shape, action_dim):
         super().__init__(args, state_shape, action_dim)
-        self.data_structure = SumTree(self.capacity)        # mem_idx    -->     priority
+        tree_type = args['tree_type'] if 'tree_type' in args else 'binary'
+        # fifo, priority or age_priority. The latter two evict the segment of segment_size rows
+        # with the lowest total priority, weighted by exp(-age / eviction_age_scale) for age_priority
+        self.eviction = args['eviction'] if 'eviction' in args else 'fifo'
+        if self.eviction != 'fifo':
+            assert_colorize(tree_type == 'binary', 'Eviction by priority requires the binary sum tree')
+            assert_colorize(not self.lazy_n_steps and self.episode_index is None,
+                            'Eviction by priority requires transitions written in FIFO order')
+            self.segment_size = to_int(args['segment_size']) if 'segment_size' in args else 1000
+            assert_colorize(self.capacity % self.segment_size == 0, 
+                            f'Capacity {self.capacity} is not a multiple of segment size {self.segment_size}')
+            # the number of segments evicted at once when no segment is free
+            self.n_evictions = args['n_evictions'] if 'n_evictions' in args else 1
+            age_scale = None
+            if self.eviction == 'age_priority':
+                # in the number of segments written
+                age_scale = float(args['eviction_age_scale']) if 'eviction_age_scale' in args else self.capacity // self.segment_size
+            elif self.eviction != 'priority':
+                raise NotImplementedError(f'Invalid eviction: {self.eviction}')
+            self.data_structure = SegmentSumTree(self.capacity, self.segment_size, age_scale)
+            self.free_segments = deque()
+            self.segment = -1               # the segment being written
+            # rows that lose their next states to rows being written, invalidated once the rows are written
+            self.stale_rows = []
+            self.n_segments_written = 0
+        elif tree_type == 'binary':
+            self.data_structure = SumTree(self.capacity)        # mem_idx    -->     priority
+        elif tree_type == 'kary':
+            fanout = args['tree_fanout'] if 'tree_fanout' in args else 16
+            leaf_dtype = args['tree_leaf_dtype'] if 'tree_leaf_dtype' in args else 'float32'
+            self.data_structure = KarySumTree(self.capacity, fanout, leaf_dtype)
+        else:
+            raise NotImplementedError(f'Invalid tree type: {tree_type}')
+
+        # state for refreshing stale priorities in the background
+        self.n_written = 0                  # the number of transitions written so far
+        self.refresh_idx = 0                # the first row of the next chunk to refresh
+        self.n_refreshed = 0                # the number of transitions refreshed so far
+        self.refreshed = np.zeros(self.capacity, dtype=np.bool)     # whether a row is refreshed since written
+
+    @override(PrioritizedReplay)
+    def add(self, state, action, reward, done):
+        assert_colorize(self.eviction == 'fifo' or self.n_steps > 1, 
+                        'Single-step add writes in FIFO order, use add_batch instead')
+        if self.n_steps == 1 and not self.lazy_n_steps:
+            # single-step transitions are written without self._write_rows
+            with self.locker:
+                self.n_written += 1
+                self.refreshed[self.mem_idx] = False
+        super().add(state, action, reward, done)
+
+    def get_refresh_chunk(self, chunk_size):
+        """ Return the next chunk of at most chunk_size rows whose priorities are to be refreshed,
+        and their transitions. Chunks walk through memory from the start, and wrap around its end """
+        with self.locker:
+            size = len(self)
+            start = self.refresh_idx if self.refresh_idx < size else 0
+            end = min(start + chunk_size, size)
+            self.refresh_idx = end
+            mem_idxs = np.arange(start, end)
+            samples = self._get_samples(mem_idxs)
+
+            return (mem_idxs, self.n_written), samples
+
+    def refresh_priorities(self, priorities, chunk):
+        """ Apply priorities recomputed for chunk returned by get_refresh_chunk, except for those 
+        rows that have been overwritten since, and those of zero priority, which are not to be sampled """
+        mem_idxs, n_written = chunk
+        with self.locker:
+            n_new = self.n_written - n_written
+            if n_new == 0:
+                keep = np.ones(mem_idxs.shape, dtype=np.bool)
+            elif self.eviction == 'fifo' and n_new < self.capacity:
+                # rows written since are the n_new rows before self.mem_idx
+                keep = (mem_idxs - self.mem_idx + n_new) % self.capacity >= n_new
+            else:
+                keep = np.zeros(mem_idxs.shape, dtype=np.bool)
+            keep &= self.data_structure.get_batch(mem_idxs) > 0
+            mem_idxs = mem_idxs[keep]
+            priorities = np.reshape(priorities, -1)[keep]
+            if priorities.size == 0:
+                return
+            if self.to_update_priority:
+                self.top_priority = max(self.top_priority, np.max(priorities))
+            self.data_structure.update_batch(priorities, mem_idxs)
+            self.refreshed[mem_idxs] = True
+            self.n_refreshed += priorities.size
+
+    @override(PrioritizedReplay)
+    def get_stats(self):
+        stats = super().get_stats()
+        if self.n_refreshed:
+            stats['RefreshedTransitions'] = self.n_refreshed
+            # the fraction of transitions in memory whose priorities are refreshed since written
+            stats['RefreshCoverage'] = np.mean(self.refreshed[:len(self)])
+
+        return stats
 
     """ Implementation """
+    @override(PrioritizedReplay)
+    def _write_rows(self, local_buffer, length, runs):
+        self.n_written += length
+        for start, end in runs:
+            self.refreshed[start: end] = False
+        super()._write_rows(local_buffer, length, runs)
+        if self.eviction != 'fifo':
+            # the priorities of the rows just written are set before they're written,
+            # so stale rows among them are invalidated only now
+            if self.stale_rows:
+                self._invalidate_rows(np.concatenate(self.stale_rows))
+                self.stale_rows = []
+            # a segment is evictable only once it's filled and the priorities of its rows are set,
+            # so that the segment being written is never evicted
+            for _, end in runs:
+                if end % self.segment_size == 0:
+                    self.data_structure.finish_segment(end // self.segment_size - 1)
+
+    @override(PrioritizedReplay)
+    def _allocate_rows(self, length):
+        if self.eviction == 'fifo':
+            return super()._allocate_rows(length)
+
+        # fill a segment before moving to another one
+        runs = []
+        mem_idx = self.mem_idx
+        is_full = self.is_full
+        while length > 0:
+            if mem_idx == self.capacity:
+                mem_idx = 0
+                is_full = True
+            if mem_idx % self.segment_size == 0:
+                mem_idx = self._start_segment(mem_idx // self.segment_size if not is_full else None)
+            n = min(length, self.segment_size - mem_idx % self.segment_size)
+            runs.append((mem_idx, mem_idx + n))
+            mem_idx += n
+            length -= n
+
+        return runs
+
+    def _start_segment(self, segment=None):
+        """ Start writing to segment, or to a free one if segment is None, 
+        in which case segments are evicted if none is free. Return its first row """
+        if segment is None:
+            if not self.free_segments:
+                for _ in range(self.n_evictions):
+                    free_segment = self.data_structure.pop_min_segment()
+                    # rows of free segments are not sampled
+                    self._invalidate_rows(self._segment_rows(free_segment, self.segment_size))
+                    self.free_segments.append(free_segment)
+            segment = self.free_segments.popleft()
+            n_segments = self.capacity // self.segment_size
+            if segment != (self.segment + 1) % n_segments:
+                # the tails of the segment just written and the segment before the new one
+                # lose their next states, which are in the following segments
+                tail_size = min(self.n_steps * self.stride, self.segment_size)
+                self.stale_rows.append(self._segment_rows(self.segment, tail_size))
+                self.stale_rows.append(self._segment_rows((segment - 1) % n_segments, tail_size))
+        self.data_structure.start_segment(segment, self.n_segments_written)
+        self.n_segments_written += 1
+        self.segment = segment
+
+        return segment * self.segment_size
+
+    def _segment_rows(self, segment, tail_size):
+        """ Return the last tail_size rows of segment """
+        end = (segment + 1) * self.segment_size
+
+        return np.arange(end - tail_size, end)
+
+    @override(PrioritizedReplay)
+    def _get_state(self):
+        state = super()._get_state()
+        state.update(dict(n_written=self.n_written, refresh_idx=self.refresh_idx, 
+                          n_refreshed=self.n_refreshed, refreshed=self.refreshed))
+        if self.eviction != 'fifo':
+            state.update(dict(free_segments=self.free_segments, segment=self.segment, 
+                              n_segments_written=self.n_segments_written))
+
+        return state
+
+    @override(PrioritizedReplay)
+    def _update_priorities(self, priorities, saved_mem_idxs):
+        # rows evicted since they were sampled have zero priority, and stay unsampled until overwritten
+        saved_mem_idxs = np.asarray(saved_mem_idxs)
+        keep = self.data_structure.get_batch(saved_mem_idxs) > 0
+        priorities = np.reshape(priorities, -1)[keep]
+        if priorities.size == 0:
+            return
+        super()._update_priorities(priorities, saved_mem_idxs[keep])
+
+    @override(PrioritizedReplay)
+    def _invalidate_rows(self, mem_idxs):
+        # rows with zero priority are never sampled
+        self.data_structure.update_batch(np.zeros(mem_idxs.shape), mem_idxs)
+
     @override(PrioritizedReplay)
     def _sample(self):
         total_priorities = self.data_structure.total_priorities
         
-        segment = total_priorities / self.batch_size
-
-        priorities, indexes = list(zip(*[self.data_structure.find(np.random.uniform(i * segment, (i+1) * segment))
-                                        for i in range(self.batch_size)]))
+        priorities, indexes = self._sample_indexes(self.batch_size)
 
-        priorities = np.array(priorities)
         probabilities = priorities / total_priorities
 
         # compute importance sampling ratios
@@ -30,3 +222,31 @@ class ProportionalPrioritizedReplay(PrioritizedReplay):
         samples = self._get_samples(indexes)
         
         return IS_ratios, indexes, samples
+
+    @override(PrioritizedReplay)
+    def _sample_many(self, n_batches):
+        total_priorities = self.data_structure.total_priorities
+
+        priorities, indexes = self._sample_indexes(self.batch_size, n_batches)
+
+        probabilities = priorities / total_priorities
+
+        IS_ratios = self._compute_IS_ratios(probabilities)
+        samples = self._get_samples_many(indexes)
+
+        return IS_ratios, indexes, samples
+
+    def _sample_indexes(self, batch_size, n_batches=None):
+        """ Return priorities and indexes of shape [batch_size], 
+        or of shape [n_batches, batch_size] if n_batches is specified """
+        total_priorities = self.data_structure.total_priorities
+
+        segment = total_priorities / batch_size
+
+        # stratified sampling: draw one value uniformly from each segment
+        bounds = np.arange(batch_size + 1) * segment
+        shape = (batch_size, ) if n_batches is None else (n_batches, batch_size)
+        values = np.random.uniform(bounds[:-1], bounds[1:], size=shape)
+        priorities, indexes = self.data_structure.find_batch(np.reshape(values, -1))
+        
+        return np.reshape(priorities, shape), np.reshape(indexes, shape)
@@ -0,0 +1,83 @@
+import numpy as np
+
+from utility.decorators import override
+from utility.utils import to_int
+from utility.debug_tools import assert_colorize
+from algo.off_policy.replay.ds.binary_heap import BinaryHeap
+from algo.off_policy.replay.prioritized_replay import PrioritizedReplay
+
+
+class RankBasedPrioritizedReplay(PrioritizedReplay):
+    """ Interface """
+    def __init__(self, args, state_shape, action_dim):
+        super().__init__(args, state_shape, action_dim)
+        # each of the batch_size segments must hold at least one rank
+        assert_colorize(self.min_size >= self.batch_size, 
+                        f'Rank-based replay requires min_size({self.min_size}) >= batch_size({self.batch_size})')
+        # lazy n-step transitions are hidden by zero priorities, which ranks ignore
+        assert_colorize(not self.lazy_n_steps, 'Rank-based replay does not support lazy n-step returns')
+        self.data_structure = BinaryHeap(self.capacity)     # rank       -->     (priority, mem_idx)
+
+        # re-sort the heap every sort_freq samples to keep heap positions close to ranks
+        self.sort_freq = to_int(args['sort_freq']) if 'sort_freq' in args else 1000
+
+        # segment boundaries are recomputed only when the buffer has grown by more than segment_growth
+        self.segment_growth = float(args['segment_growth']) if 'segment_growth' in args else 1.01
+        self.segment_size = 0
+        self.boundaries = None
+        self.segment_probabilities = None
+
+    """ Implementation """
+    @override(PrioritizedReplay)
+    def _sample(self):
+        self._prepare_segments(1)
+
+        # stratified sampling: draw one rank uniformly from each segment
+        ranks = np.random.randint(self.boundaries[:-1], self.boundaries[1:])
+        _, indexes = self.data_structure.find_batch(ranks)
+        probabilities = self.segment_probabilities
+
+        # compute importance sampling ratios
+        IS_ratios = self._compute_IS_ratios(probabilities)
+        samples = self._get_samples(indexes)
+
+        return IS_ratios, indexes, samples
+
+    @override(PrioritizedReplay)
+    def _sample_many(self, n_batches):
+        self._prepare_segments(n_batches)
+
+        ranks = np.random.randint(self.boundaries[:-1], self.boundaries[1:], size=(n_batches, self.batch_size))
+        _, indexes = self.data_structure.find_batch(ranks)
+        probabilities = np.tile(self.segment_probabilities, (n_batches, 1))
+
+        IS_ratios = self._compute_IS_ratios(probabilities)
+        samples = self._get_samples_many(indexes)
+
+        return IS_ratios, indexes, samples
+
+    def _prepare_segments(self, n_batches):
+        """ Sort the heap every sort_freq samples, and recompute segments if necessary """
+        if (self.sample_i - 1) // self.sort_freq != (self.sample_i + n_batches - 1) // self.sort_freq:
+            self.data_structure.sort()
+
+        size = len(self.data_structure)
+        if (size == self.capacity and self.segment_size != size) or size > self.segment_size * self.segment_growth:
+            self._compute_segments(size)
+
+    def _compute_segments(self, size):
+        """ Split ranks [0, size) into batch_size segments of (roughly) equal probability mass
+        under the power-law distribution P(rank) ∝ (1 / rank)^alpha """
+        pdf = (1. / np.arange(1, size + 1))**self.alpha
+        cdf = np.cumsum(pdf) / np.sum(pdf)
+        boundaries = np.searchsorted(cdf, np.arange(1, self.batch_size) / self.batch_size)
+        boundaries = np.concatenate([[0], boundaries, [size]])
+        # the top ranks may take up more mass than a segment, make sure no segment is empty
+        offsets = np.arange(self.batch_size + 1)
+        boundaries = np.maximum.accumulate(boundaries - offsets) + offsets
+        boundaries[-1] = size
+
+        self.segment_size = size
+        self.boundaries = boundaries
+        # each transition is sampled with probability 1 / (batch_size * segment_length)
+        self.segment_probabilities = 1. / (self.batch_size * np.diff(boundaries))
@@ -0,0 +1,88 @@
+import time
+import threading
+
+from utility.utils import to_int
+
+
+class RateLimiter:
+    """ Hold the ratio of sampled to inserted transitions around samples_per_insert.
+    With diff = inserted * samples_per_insert - sampled, a sample waits while
+    diff < -tolerance, and an insert waits while diff > tolerance once min_size
+    transitions are inserted. Both conditions are checked before the operation,
+    so a sample and an insert never wait for each other at the same time.
+    A wait gives up after timeout seconds, if specified, so that rate limiting
+    degrades to throttling rather than stalling a stuck learner or worker """
+    """ Interface """
+    def __init__(self, samples_per_insert, tolerance, min_size, timeout=None):
+        self.samples_per_insert = float(samples_per_insert)
+        self.tolerance = float(tolerance)
+        self.min_size = min_size
+        self.timeout = timeout
+
+        # live counters, in transitions
+        self.inserted = 0
+        self.sampled = 0
+        # time spent waiting, in seconds
+        self.insert_wait_time = 0.
+        self.sample_wait_time = 0.
+
+        self.cond = threading.Condition()
+
+    @property
+    def diff(self):
+        return self.inserted * self.samples_per_insert - self.sampled
+
+    def await_insert(self, n):
+        """ Wait until inserting is allowed, and count n inserted transitions """
+        with self.cond:
+            self.insert_wait_time += self._wait(
+                lambda: self.inserted < self.min_size or self.diff <= self.tolerance)
+            self.inserted += n
+            self.cond.notify_all()
+
+    def await_sample(self, n):
+        """ Wait until sampling is allowed, and count n sampled transitions """
+        with self.cond:
+            self.sample_wait_time += self._wait(lambda: self.diff >= -self.tolerance)
+            self.sampled += n
+            self.cond.notify_all()
+
+    def get_stats(self):
+        return dict(
+            Inserted=self.inserted,
+            Sampled=self.sampled,
+            SamplesPerInsert=self.sampled / max(self.inserted, 1),
+            InsertWaitTime=self.insert_wait_time,
+            SampleWaitTime=self.sample_wait_time,
+        )
+
+    def get_state(self):
+        return dict(inserted=self.inserted, sampled=self.sampled)
+
+    def set_state(self, state):
+        with self.cond:
+            self.inserted = state['inserted']
+            self.sampled = state['sampled']
+            self.cond.notify_all()
+
+    """ Implementation """
+    def _wait(self, predicate):
+        """ Wait for predicate and return the time spent waiting """
+        if predicate():
+            return 0.
+        start = time.time()
+        self.cond.wait_for(predicate, timeout=self.timeout)
+
+        return time.time() - start
+
+
+def get_rate_limiter(args):
+    """ Return a RateLimiter if args specify samples_per_insert, otherwise None """
+    if 'samples_per_insert' not in args or not args['samples_per_insert']:
+        return None
+    samples_per_insert = float(args['samples_per_insert'])
+    # by default, tolerate a deviation of ten batches
+    tolerance = float(args['spi_tolerance']) if 'spi_tolerance' in args else 10 * args['batch_size']
+    timeout = args['spi_timeout'] if 'spi_timeout' in args else None
+
+    return RateLimiter(samples_per_insert, tolerance, to_int(args['min_size']), timeout)
@@ -0,0 +1,190 @@
+import os, pickle
+import itertools
+import threading
+import numpy as np
+
+from utility.debug_tools import assert_colorize
+from utility.utils import to_int
+from utility.schedule import PiecewiseSchedule
+from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+from algo.off_policy.replay.rate_limiter import get_rate_limiter
+
+
+class ShardedReplay:
+    """ Prioritized replay split into n_shards independent ProportionalPrioritizedReplays,
+    each with its own lock and sum tree. Merges go to shards in a round-robin fashion,
+    so that concurrent merges and sampling rarely contend for the same lock.
+    Sampling picks shards proportional to their total priorities, and only holds
+    the lock of a shard while descending its tree; the gather copy happens outside
+    any lock, so rows may rarely be overwritten between the descent and the copy.
+    Single transitions are added to one shard per episode, so that n-step returns 
+    never cross shards """
+    """ Interface """
+    def __init__(self, args, state_shape, action_dim):
+        self.n_shards = args['n_shards'] if 'n_shards' in args else 4
+        self.capacity = to_int(args['capacity'])
+        self.min_size = to_int(args['min_size'])
+        self.batch_size = args['batch_size']
+        self.reward_scale = args['reward_scale'] if 'reward_scale' in args else 1
+
+        # global indexes assume shards of equal capacity
+        assert_colorize(self.capacity % self.n_shards == 0, 
+                        f'Capacity {self.capacity} is not a multiple of the number of shards {self.n_shards}')
+        shard_args = args.copy()
+        shard_args['capacity'] = self.shard_capacity = self.capacity // self.n_shards
+        shard_args['min_size'] = self.min_size // self.n_shards
+        # shards are sampled without their sample methods, the rate is limited here instead
+        shard_args.pop('samples_per_insert', None)
+        self.shards = [ProportionalPrioritizedReplay(shard_args, state_shape, action_dim)
+                        for _ in range(self.n_shards)]
+        self.merge_counter = itertools.count()
+        self.add_shard = 0  # the shard to which transitions of the current episode are added
+
+        # params for prioritized replay
+        self.beta = float(args['beta0']) if 'beta0' in args else .4
+        self.beta_schedule = PiecewiseSchedule([(0, args['beta0']), (float(args['beta_steps']), 1.)],
+                                                outside_value=1.)
+        self.sample_i = 0   # count how many times self.sample is called
+
+        self.rate_limiter = get_rate_limiter(args)
+        # locker for sample_i and beta, which are updated by concurrent samplers
+        self.locker = threading.Lock()
+
+    @property
+    def good_to_learn(self):
+        return len(self) >= self.min_size
+
+    @property
+    def top_priority(self):
+        return max([shard.top_priority for shard in self.shards])
+
+    def __len__(self):
+        return sum([len(shard) for shard in self.shards])
+
+    def __call__(self):
+        while True:
+            yield self.sample()
+
+    def sample(self):
+        assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
+                                            f'transitions in buffer: {len(self)}\t'
+                                            f'minimum required size: {self.min_size}')
+        if self.rate_limiter is not None:
+            self.rate_limiter.await_sample(self.batch_size)
+        probabilities, indexes, samples = self._sample(self.batch_size)
+        with self.locker:
+            beta = self.beta
+            self.sample_i += 1
+            self.beta = self.beta_schedule.value(self.sample_i)
+        IS_ratios = (np.min(probabilities) / probabilities)**beta
+
+        return IS_ratios, indexes, samples
+
+    def sample_many(self, n_batches):
+        """ Sample n_batches batches at once, stacked along a new leading axis """
+        assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
+                                            f'transitions in buffer: {len(self)}\t'
+                                            f'minimum required size: {self.min_size}')
+        if self.rate_limiter is not None:
+            self.rate_limiter.await_sample(n_batches * self.batch_size)
+        probabilities, indexes, samples = self._sample(n_batches * self.batch_size)
+        # transitions are grouped by shards, shuffle them before splitting batches
+        order = np.random.permutation(n_batches * self.batch_size)
+        shape = (n_batches, self.batch_size)
+        probabilities = np.reshape(probabilities[order], shape)
+        indexes = np.reshape(indexes[order], shape)
+        samples = tuple([np.reshape(v[order], (*shape, *v.shape[1:])) for v in samples])
+        with self.locker:
+            # all batches share the same beta
+            beta = self.beta
+            self.sample_i += n_batches
+            self.beta = self.beta_schedule.value(self.sample_i)
+        IS_ratios = (np.min(probabilities, axis=1, keepdims=True) / probabilities)**beta
+
+        return IS_ratios, indexes, samples
+
+    def add(self, state, action, reward, done):
+        if self.rate_limiter is not None:
+            self.rate_limiter.await_insert(1)
+        self.shards[self.add_shard].add(state, action, reward, done)
+        if done:
+            self.add_shard = (self.add_shard + 1) % self.n_shards
+
+    def add_batch(self, states, actions, rewards, dones):
+        raise NotImplementedError('Sharded replay does not support interleaved transitions of multiple environments')
+
+    def merge(self, local_buffer, length):
+        if self.rate_limiter is not None:
+            self.rate_limiter.await_insert(length)
+        shard = self.shards[next(self.merge_counter) % self.n_shards]
+        shard.merge(local_buffer, length)
+
+    def update_priorities(self, priorities, saved_mem_idxs):
+        priorities = np.reshape(priorities, -1)
+        saved_mem_idxs = np.asarray(saved_mem_idxs)
+        shard_nos = saved_mem_idxs // self.shard_capacity
+        for shard_no in np.unique(shard_nos):
+            mask = shard_nos == shard_no
+            self.shards[shard_no].update_priorities(priorities[mask],
+                                                    saved_mem_idxs[mask] % self.shard_capacity)
+
+    def save(self, directory):
+        for i, shard in enumerate(self.shards):
+            shard.save(os.path.join(directory, f'shard{i}'))
+        with open(os.path.join(directory, 'state.pkl'), 'wb') as f:
+            state = dict(sample_i=self.sample_i, beta=self.beta, add_shard=self.add_shard)
+            if self.rate_limiter is not None:
+                state['rate_limiter'] = self.rate_limiter.get_state()
+            pickle.dump(state, f)
+
+    def restore(self, directory):
+        for i, shard in enumerate(self.shards):
+            shard.restore(os.path.join(directory, f'shard{i}'))
+        with open(os.path.join(directory, 'state.pkl'), 'rb') as f:
+            state = pickle.load(f)
+        self.sample_i = state['sample_i']
+        self.beta = state['beta']
+        self.add_shard = state['add_shard'] if 'add_shard' in state else 0
+        if self.rate_limiter is not None and 'rate_limiter' in state:
+            self.rate_limiter.set_state(state['rate_limiter'])
+
+    def get_stats(self):
+        stats = dict(Size=len(self))
+        if self.rate_limiter is not None:
+            stats.update(self.rate_limiter.get_stats())
+        for i, shard in enumerate(self.shards):
+            stats.update(dict([(f'shard{i}_{k}', v) for k, v in shard.get_stats().items()]))
+
+        return stats
+
+    """ Implementation """
+    def _sample(self, n):
+        """ Return probabilities, global indexes and samples of n transitions, grouped by shards """
+        # reading totals without locks is fine since they are only used to split the batch
+        total_priorities = np.array([shard.data_structure.total_priorities for shard in self.shards])
+        total = np.sum(total_priorities)
+        counts = np.random.multinomial(n, total_priorities / total)
+
+        shard_indexes = []
+        priorities = []
+        for shard, count in zip(self.shards, counts):
+            if count == 0:
+                shard_indexes.append(None)
+                continue
+            with shard.locker:
+                shard_priorities, indexes = shard._sample_indexes(count)
+            shard_indexes.append(indexes)
+            priorities.append(shard_priorities)
+
+        # gather transitions outside the critical section
+        samples = []
+        indexes = []
+        for shard_no, (shard, shard_idxes) in enumerate(zip(self.shards, shard_indexes)):
+            if shard_idxes is not None:
+                samples.append(shard._get_samples(shard_idxes))
+                indexes.append(shard_no * self.shard_capacity + shard_idxes)
+        samples = tuple([np.concatenate(field) for field in zip(*samples)])
+        indexes = np.concatenate(indexes)
+        probabilities = np.concatenate(priorities) / total
+
+        return probabilities, indexes, samples
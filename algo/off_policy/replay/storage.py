@@ -0,0 +1,428 @@
+import os, atexit, shutil, tempfile
+import mmap
+import resource
+import zlib, lzma
+from time import time
+from collections import OrderedDict
+import numpy as np
+
+from utility.debug_tools import assert_colorize
+from utility.utils import to_int
+
+
+class TieredArray:
+    """ Array whose most recently written chunks are kept in RAM,
+    while older chunks spill to a np.memmap file. It supports the subset
+    of ndarray indexing used by replay buffers: integer and slice writes,
+    integer, slice and fancy reads """
+    """ Interface """
+    def __init__(self, path, shape, dtype, hot_capacity, chunk_size):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.n_chunks = int(np.ceil(self.shape[0] / chunk_size))
+        self.n_hot_chunks = min(max(1, hot_capacity // chunk_size), self.n_chunks)
+
+        self.cold = np.memmap(path, dtype=self.dtype, mode='w+', shape=self.shape)
+        self.hot = np.zeros((self.n_hot_chunks * chunk_size, *self.shape[1:]), dtype=self.dtype)
+        self.slot_chunks = -np.ones(self.n_hot_chunks, dtype=np.int64)     # slot     -->     chunk
+        self.chunk_slots = -np.ones(self.n_chunks, dtype=np.int64)         # chunk    -->     slot
+
+        # stats for the disk tier
+        self.hot_reads = 0
+        self.cold_reads = 0
+        self.cold_read_bytes = 0
+        self.cold_read_time = 0.
+        self.page_faults = 0
+        self.flushed_bytes = 0
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._get(np.arange(*key.indices(len(self))))
+        elif np.ndim(key) == 0:
+            return self._get(np.array([key]))[0]
+        else:
+            return self._get(np.asarray(key))
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            assert_colorize(step == 1, 'TieredArray only supports contiguous writes')
+        else:
+            start = int(key) % len(self)
+            stop = start + 1
+        value = np.asarray(value, dtype=self.dtype)
+        # a value that does not cover the whole range is broadcast to each row
+        is_rows = value.ndim == self.ndim and value.shape[0] == stop - start and stop - start > 1
+
+        pos = start
+        while pos < stop:
+            chunk = pos // self.chunk_size
+            end = min(stop, (chunk + 1) * self.chunk_size)
+            hot_start = self._activate(chunk) * self.chunk_size + pos - chunk * self.chunk_size
+            self.hot[hot_start: hot_start + end - pos] = value[pos - start: end - start] if is_rows else value
+            pos = end
+
+    def flush(self):
+        """ Write all hot chunks to disk, the hot tier remains valid """
+        for slot, chunk in enumerate(self.slot_chunks):
+            if chunk >= 0:
+                self._flush(slot, chunk)
+        self.cold.flush()
+
+    def get_stats(self):
+        return dict(
+            HotReadRatio=self.hot_reads / max(1, self.hot_reads + self.cold_reads),
+            ColdReads=self.cold_reads,
+            ColdReadMBps=self.cold_read_bytes / max(1e-8, self.cold_read_time) / 2**20,
+            MajorPageFaults=self.page_faults,
+            FlushedMB=self.flushed_bytes / 2**20,
+        )
+
+    """ Implementation """
+    def _get(self, idxes):
+        idxes = np.where(idxes < 0, idxes + len(self), idxes)
+        chunks = idxes // self.chunk_size
+        slots = self.chunk_slots[chunks]
+        is_hot = slots >= 0
+        is_cold = ~is_hot
+
+        values = np.empty((*idxes.shape, *self.shape[1:]), dtype=self.dtype)
+        values[is_hot] = self.hot[slots[is_hot] * self.chunk_size + idxes[is_hot] - chunks[is_hot] * self.chunk_size]
+        n_hot = np.sum(is_hot)
+        self.hot_reads += n_hot
+        if n_hot < idxes.size:
+            page_faults = resource.getrusage(resource.RUSAGE_SELF).ru_majflt
+            start = time()
+            values[is_cold] = self.cold[idxes[is_cold]]
+            self.cold_read_time += time() - start
+            self.page_faults += resource.getrusage(resource.RUSAGE_SELF).ru_majflt - page_faults
+            self.cold_reads += idxes.size - n_hot
+            self.cold_read_bytes += values[is_cold].nbytes
+
+        return values
+
+    def _activate(self, chunk):
+        """ Make chunk hot and return its slot, evicting the chunk previously held by the slot """
+        slot = self.chunk_slots[chunk]
+        if slot >= 0:
+            return slot
+
+        slot = chunk % self.n_hot_chunks
+        old_chunk = self.slot_chunks[slot]
+        if old_chunk >= 0:
+            self._flush(slot, old_chunk)
+            self.chunk_slots[old_chunk] = -1
+
+        start, end = chunk * self.chunk_size, min(len(self), (chunk + 1) * self.chunk_size)
+        hot_start = slot * self.chunk_size
+        self.hot[hot_start: hot_start + end - start] = self.cold[start: end]
+        self.slot_chunks[slot] = chunk
+        self.chunk_slots[chunk] = slot
+
+        return slot
+
+    def _flush(self, slot, chunk):
+        start, end = chunk * self.chunk_size, min(len(self), (chunk + 1) * self.chunk_size)
+        hot_start = slot * self.chunk_size
+        self.cold[start: end] = self.hot[hot_start: hot_start + end - start]
+        self.flushed_bytes += self.cold[start: end].nbytes
+
+
+def shared_array(shape, dtype):
+    """ Zero-initialized array backed by an anonymous shared mmap, 
+    which is shared with processes forked afterwards """
+    dtype = np.dtype(dtype)
+    nbytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+    buffer = mmap.mmap(-1, nbytes)
+
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def share_array(x):
+    """ Copy x to shared memory """
+    y = shared_array(x.shape, x.dtype)
+    y[...] = x
+
+    return y
+
+
+def delta_bitpack_encode(x):
+    """ Encode rows of x by their bitwise differences from the previous rows,
+    zigzag the signed differences and pack them bit plane by bit plane 
+    with the minimal number of bits """
+    itemsize = x.dtype.itemsize
+    assert_colorize(itemsize <= 4, f'delta codec does not support dtype {x.dtype}')
+    n_bits = 8 * itemsize
+    x = x.view(f'u{itemsize}')
+    delta = np.diff(x, axis=0, prepend=np.zeros_like(x[:1]))
+    delta = delta.view(f'i{itemsize}').astype(np.int64).reshape(-1)
+    zigzag = (((delta << 1) ^ (delta >> (n_bits - 1))) & ((1 << n_bits) - 1)).astype(np.uint32)
+    width = int(np.max(zigzag)).bit_length() if zigzag.size else 0
+    planes = [np.packbits(((zigzag >> b) & 1).astype(np.uint8)) for b in range(width)]
+
+    return bytes([width]) + b''.join([p.tobytes() for p in planes])
+
+def delta_bitpack_decode(data, shape, dtype):
+    dtype = np.dtype(dtype)
+    itemsize = dtype.itemsize
+    width = data[0]
+    size = int(np.prod(shape))
+    plane_bytes = (size + 7) // 8
+    zigzag = np.zeros(size, dtype=np.int64)
+    for b in range(width):
+        plane = np.frombuffer(data, dtype=np.uint8, count=plane_bytes, offset=1 + b * plane_bytes)
+        zigzag |= np.unpackbits(plane, count=size).astype(np.int64) << b
+    delta = (zigzag >> 1) ^ -(zigzag & 1)
+    delta = delta.astype(f'i{itemsize}').view(f'u{itemsize}').reshape(shape)
+    x = np.cumsum(delta, axis=0, dtype=f'u{itemsize}')
+
+    return x.view(dtype)
+
+
+class CompressedArray:
+    """ Array stored as compressed chunks of chunk_size rows. The chunk being written 
+    is kept uncompressed and is compressed as soon as it is completed or another chunk 
+    is written; decompressed chunks are cached in a small LRU for reads """
+    """ Interface """
+    def __init__(self, shape, dtype, codec, chunk_size, lru_size):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self.n_chunks = int(np.ceil(self.shape[0] / chunk_size))
+        self.lru_size = lru_size
+
+        self.chunks = [None] * self.n_chunks
+        self.open_chunk = -1
+        self.open_values = np.zeros((chunk_size, *self.shape[1:]), dtype=self.dtype)
+        self.lru = OrderedDict()
+
+        # stats
+        self.compressed_bytes = 0
+        self.compressed_rows = 0
+        self.reads = 0
+        self.read_time = 0.
+        self.lru_hits = 0
+        self.lru_misses = 0
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def row_bytes(self):
+        return self.dtype.itemsize * int(np.prod(self.shape[1:]))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._get(np.arange(*key.indices(len(self))))
+        elif np.ndim(key) == 0:
+            return self._get(np.array([key]))[0]
+        else:
+            return self._get(np.asarray(key))
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            assert_colorize(step == 1, 'CompressedArray only supports contiguous writes')
+        else:
+            start = int(key) % len(self)
+            stop = start + 1
+        value = np.asarray(value, dtype=self.dtype)
+        is_rows = value.ndim == self.ndim and value.shape[0] == stop - start and stop - start > 1
+
+        pos = start
+        while pos < stop:
+            chunk = pos // self.chunk_size
+            chunk_start = chunk * self.chunk_size
+            end = min(stop, chunk_start + self.chunk_size)
+            if end - pos == self._chunk_length(chunk):
+                # the whole chunk is overwritten, compress it right away
+                self._close()
+                self._compress(chunk, value[pos - start: end - start] if is_rows 
+                                    else np.broadcast_to(value, (end - pos, *self.shape[1:])))
+            else:
+                self._open(chunk)
+                self.open_values[pos - chunk_start: end - chunk_start] = value[pos - start: end - start] if is_rows else value
+                if end == chunk_start + self._chunk_length(chunk):
+                    # the chunk is completed
+                    self._close()
+            pos = end
+
+    def get_stats(self):
+        compression_ratio = (self.compressed_rows * self.row_bytes / self.compressed_bytes 
+                            if self.compressed_bytes else 1.)
+        return dict(
+            CompressionRatio=compression_ratio,
+            TransitionsPerGB=2**30 / self.row_bytes * compression_ratio,
+            LRUHitRate=self.lru_hits / max(1, self.lru_hits + self.lru_misses),
+            ReadLatencyMs=self.read_time / max(1, self.reads) * 1e3,
+        )
+
+    """ Implementation """
+    def _chunk_length(self, chunk):
+        return min(len(self), (chunk + 1) * self.chunk_size) - chunk * self.chunk_size
+
+    def _get(self, idxes):
+        start = time()
+        idxes = np.where(idxes < 0, idxes + len(self), idxes)
+        values = np.empty((*idxes.shape, *self.shape[1:]), dtype=self.dtype)
+        chunks, inverse = np.unique(idxes // self.chunk_size, return_inverse=True)
+        offsets = idxes % self.chunk_size
+        for i, chunk in enumerate(chunks):
+            mask = inverse == i
+            values[mask] = self._chunk_values(chunk)[offsets[mask]]
+        self.reads += 1
+        self.read_time += time() - start
+
+        return values
+
+    def _chunk_values(self, chunk):
+        if chunk == self.open_chunk:
+            return self.open_values
+        if chunk in self.lru:
+            self.lru_hits += 1
+            self.lru.move_to_end(chunk)
+            return self.lru[chunk]
+
+        self.lru_misses += 1
+        values = self._decompress(chunk)
+        self.lru[chunk] = values
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+        return values
+
+    def _open(self, chunk):
+        if chunk == self.open_chunk:
+            return
+        self._close()
+        length = self._chunk_length(chunk)
+        self.open_values[:length] = self._decompress(chunk)
+        self.open_chunk = chunk
+        self.lru.pop(chunk, None)
+
+    def _close(self):
+        if self.open_chunk >= 0:
+            chunk = self.open_chunk
+            self.open_chunk = -1
+            self._compress(chunk, self.open_values[:self._chunk_length(chunk)])
+
+    def _compress(self, chunk, values):
+        values = np.ascontiguousarray(values)
+        if self.codec == 'zlib':
+            data = zlib.compress(values.tobytes(), 1)
+        elif self.codec == 'lzma':
+            data = lzma.compress(values.tobytes())
+        elif self.codec == 'delta':
+            data = delta_bitpack_encode(values)
+        else:
+            raise NotImplementedError(f'Invalid codec: {self.codec}')
+
+        if self.chunks[chunk] is not None:
+            self.compressed_bytes -= len(self.chunks[chunk])
+            self.compressed_rows -= len(values)
+        self.chunks[chunk] = data
+        self.compressed_bytes += len(data)
+        self.compressed_rows += len(values)
+        self.lru.pop(chunk, None)
+
+    def _decompress(self, chunk):
+        shape = (self._chunk_length(chunk), *self.shape[1:])
+        data = self.chunks[chunk]
+        if data is None:
+            return np.zeros(shape, dtype=self.dtype)
+        if self.codec == 'zlib':
+            return np.frombuffer(zlib.decompress(data), dtype=self.dtype).reshape(shape)
+        elif self.codec == 'lzma':
+            return np.frombuffer(lzma.decompress(data), dtype=self.dtype).reshape(shape)
+        elif self.codec == 'delta':
+            return delta_bitpack_decode(data, shape, self.dtype)
+        else:
+            raise NotImplementedError(f'Invalid codec: {self.codec}')
+
+
+class TieredAllocator:
+    """ Allocate TieredArrays backed by files in a fresh directory under storage_dir,
+    the directory is removed when the process exits """
+    def __init__(self, storage_dir, hot_capacity, chunk_size):
+        os.makedirs(storage_dir, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='replay_', dir=storage_dir)
+        atexit.register(shutil.rmtree, self.directory, ignore_errors=True)
+        self.hot_capacity = hot_capacity
+        self.chunk_size = chunk_size
+
+    def __call__(self, name, shape, dtype):
+        path = os.path.join(self.directory, f'{name}.dat')
+        return TieredArray(path, shape, dtype, self.hot_capacity, self.chunk_size)
+
+
+class CompressedAllocator:
+    """ Allocate CompressedArrays for fields in compressed_fields and plain arrays for the others """
+    def __init__(self, codec, chunk_size, lru_size, compressed_fields):
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self.lru_size = lru_size
+        self.compressed_fields = compressed_fields
+
+    def __call__(self, name, shape, dtype):
+        if name in self.compressed_fields:
+            return CompressedArray(shape, dtype, self.codec, self.chunk_size, self.lru_size)
+        else:
+            return np.zeros(shape, dtype=dtype)
+
+
+class RecordAllocator:
+    """ Allocate all fields as views of a single structured array, self.records, 
+    so that each transition occupies one contiguous row. self.bytes views records 
+    as a byte matrix, through which rows are copied and gathered by memcpy """
+    def __init__(self):
+        self.records = None
+        self.bytes = None
+
+    def __call__(self, name, shape, dtype):
+        raise NotImplementedError('RecordAllocator allocates all fields at once by allocate')
+
+    def allocate(self, specs):
+        lengths = set([shape[0] for shape, _ in specs.values()])
+        assert_colorize(len(lengths) == 1, f'Fields of records should be of the same length: {lengths}')
+        assert_colorize(self.records is None, 'RecordAllocator only allocates one buffer')
+        dtype = np.dtype([(k, dtype, shape[1:]) for k, (shape, dtype) in specs.items()])
+        self.records = np.zeros(lengths.pop(), dtype=dtype)
+        self.bytes = self.records.view(np.uint8).reshape(len(self.records), dtype.itemsize)
+
+        return dict([(k, self.records[k]) for k in specs])
+
+
+def get_allocator(args):
+    """ Return the allocator specified by args['storage'], None stands for plain np.zeros """
+    storage = args['storage'] if 'storage' in args else 'memory'
+    if storage == 'memory':
+        return None
+    elif storage == 'tiered':
+        storage_dir = args['storage_dir'] if 'storage_dir' in args else 'replay_storage'
+        hot_capacity = to_int(args['hot_capacity']) if 'hot_capacity' in args else to_int(1e5)
+        chunk_size = to_int(args['chunk_size']) if 'chunk_size' in args else to_int(1e4)
+        return TieredAllocator(storage_dir, hot_capacity, chunk_size)
+    elif storage == 'compressed':
+        codec = args['codec'] if 'codec' in args else 'zlib'
+        chunk_size = to_int(args['chunk_size']) if 'chunk_size' in args else 32
+        lru_size = to_int(args['lru_size']) if 'lru_size' in args else 512
+        compressed_fields = args['compressed_fields'] if 'compressed_fields' in args else ['state']
+        return CompressedAllocator(codec, chunk_size, lru_size, compressed_fields)
+    elif storage == 'record':
+        return RecordAllocator()
+    elif storage == 'shared':
+        return lambda name, shape, dtype: shared_array(shape, dtype)
+    else:
+        raise NotImplementedError(f'Invalid storage: {storage}')
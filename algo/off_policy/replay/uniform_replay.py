@@ -10,10 +10,11 @@ class UniformReplay(Replay):
     def __init__(self, args, state_shape, action_dim):
         super().__init__(args, state_shape, action_dim)
 
-        init_buffer(self.memory, self.capacity, state_shape, action_dim, False)
+        init_buffer(self.memory, self.capacity, state_shape, action_dim, False, 
+                    allocator=self.allocator)
 
         # Code for single agent
-        if self.n_steps > 1:
+        if self.n_steps > 1 and not self.lazy_n_steps:
             self.tb_capacity = args['tb_capacity']
             self.tb_idx = 0
             self.tb_full = False
@@ -27,9 +28,27 @@ class UniformReplay(Replay):
     """ Implementation """
     @override(Replay)
     def _sample(self):
-        size = self.capacity if self.is_full else self.mem_idx
-        indexes = np.random.randint(0, size, self.batch_size)
+        indexes = self._sample_indexes(self.batch_size)
         
         samples = self._get_samples(indexes)
 
         return samples
+
+    @override(Replay)
+    def _sample_many(self, n_batches):
+        indexes = self._sample_indexes((n_batches, self.batch_size))
+
+        samples = self._get_samples_many(indexes)
+
+        return samples
+
+    def _sample_indexes(self, shape):
+        size = self.capacity if self.is_full else self.mem_idx
+        if self.lazy_n_steps:
+            # count back from the newest transitions, which are skipped until their next states are stored
+            offsets = np.random.randint(self.stride, size, shape)
+            indexes = (self.mem_idx - 1 - offsets) % self.capacity
+        else:
+            indexes = np.random.randint(0, size, shape)
+
+        return indexes
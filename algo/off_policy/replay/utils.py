@@ -3,20 +3,40 @@ import numpy as np
 from utility.debug_tools import assert_colorize
 
 
-def init_buffer(buffer, capacity, state_shape, action_dim, has_priority, extra_state=0):
-    state_dtype = np.float16
+def get_dtypes(action_dim):
+    """ Return dtypes in which fields are stored """
+    return dict(
+        priority=np.float64,
+        state=np.float16,
+        action=np.int8 if action_dim == 1 else np.float16,
+        reward=np.float16,
+        done=np.bool,
+        steps=np.uint8,
+    )
+
+def init_buffer(buffer, capacity, state_shape, action_dim, has_priority, extra_state=0, allocator=None):
+    """ allocator(name, shape, dtype) allocates the array for each field, np.zeros is used if it's None.
+    If allocator defines allocate(specs), all fields are allocated at once by allocate """
+    dtypes = get_dtypes(action_dim)
     action_shape = (capacity, ) if action_dim == 1 else (capacity, action_dim)
-    action_dtype = np.int8 if action_dim == 1 else np.float16
-
-    target_buffer = {'priority': np.zeros((capacity, 1))} if has_priority else {}
-    target_buffer.update({
-        'state': np.zeros((capacity + extra_state, *state_shape), dtype=state_dtype),
-        'action': np.zeros(action_shape, dtype=action_dtype),
-        'reward': np.zeros((capacity, 1), dtype=np.float16),
-        'done': np.zeros((capacity, 1), dtype=np.bool),
-        'steps': np.zeros((capacity, 1), dtype=np.uint8)
+
+    specs = {'priority': ((capacity, 1), dtypes['priority'])} if has_priority else {}
+    specs.update({
+        'state': ((capacity + extra_state, *state_shape), dtypes['state']),
+        'action': (action_shape, dtypes['action']),
+        'reward': ((capacity, 1), dtypes['reward']),
+        'done': ((capacity, 1), dtypes['done']),
+        'steps': ((capacity, 1), dtypes['steps'])
     })
 
+    if allocator is None:
+        allocator = lambda name, shape, dtype: np.zeros(shape, dtype=dtype)
+    if hasattr(allocator, 'allocate'):
+        # allocators that lay out all fields together
+        target_buffer = allocator.allocate(specs)
+    else:
+        target_buffer = dict([(k, allocator(k, shape, dtype)) for k, (shape, dtype) in specs.items()])
+
     buffer.update(target_buffer)
 
 def reset_buffer(buffer):
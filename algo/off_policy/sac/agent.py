@@ -78,7 +78,6 @@ class Agent(OffPolicyOperation):
     def _actor(self):
         policy_args = self.args['Policy']
         policy_args['max_action_repetitions'] = self.max_action_repetitions
-        policy_args['polyak'] = self.args['polyak']
         return SoftPolicy('SoftPolicy',
                             policy_args,
                             self.graph,
@@ -98,7 +97,6 @@ class Agent(OffPolicyOperation):
         
     def _critic(self):
         q_args = self.args['Q']
-        q_args['polyak'] = self.args['polyak']
         return SoftQ('SoftQ',
                     q_args,
                     self.graph,
@@ -172,13 +170,12 @@ class Agent(OffPolicyOperation):
             opt_ops += [actor_opt_op, Q_opt_op]
             self.opt_op = tf.group(*opt_ops)
 
-    @override(OffPolicyOperation)
-    def _initialize_target_net(self):
-        self.sess.run(self.actor.init_target_op + self.critic.init_target_op)
-
-    @override(OffPolicyOperation)
-    def _update_target_net(self):
-        self.sess.run(self.actor.update_target_op + self.critic.update_target_op)
+        target_variables = self.critic.target_variables
+        main_variables = self.critic.main_variables
+        if self.actor.has_target_net:
+            target_variables += self.actor.target_variables
+            main_variables += self.actor.main_variables
+        self._target_net_ops(target_variables, main_variables)
 
     @override(OffPolicyOperation)
     def _get_feeddict(self, t):
@@ -204,7 +201,7 @@ class Agent(OffPolicyOperation):
                 with tf.name_scope('critic'):
                     stats_summary('Q1_with_actor', self.critic.Q1_with_actor, min=True, max=True)
                     stats_summary('Q2_with_actor', self.critic.Q2_with_actor, min=True, max=True)
-                    if self.buffer_type == 'proportional':
+                    if self.prioritized:
                         stats_summary('priority', self.priority, std=True, max=True, hist=True)
                     tf.compat.v1.summary.scalar('Q1_loss_', self.Q1_loss)
                     tf.compat.v1.summary.scalar('Q2_loss_', self.Q2_loss)
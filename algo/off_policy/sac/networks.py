@@ -42,8 +42,6 @@ class SoftPolicy(Module):
         else:
             self.next_action, self.next_logpi, _ = self._build_policy(self.next_state, 'main', True)
 
-        self.init_target_op, self.update_target_op = self._target_net_ops()
-
     def _build_policy(self, state, name, reuse):
         LOG_STD_MIN = -20.
         LOG_STD_MAX = 2.
@@ -98,17 +96,6 @@ class SoftPolicy(Module):
             
         return action, logpi, action_det
 
-    def _target_net_ops(self):
-        if not self.has_target_net:
-            return [], []
-        with tf.name_scope('target_net_op'):
-            polyak = self.args['polyak']
-            target_main_var_pairs = list(zip(self.target_variables, self.main_variables))
-            init_target_op = list(map(lambda v: tf.assign(v[0], v[1], name='init_target_op'), target_main_var_pairs))
-            update_target_op = list(map(lambda v: tf.assign(v[0], polyak * v[0] + (1. - polyak) * v[1], name='update_target_op'), target_main_var_pairs))
-
-        return init_target_op, update_target_op  
-
 
 class SoftQ(Module):
     """ Interface """
@@ -177,17 +164,6 @@ class SoftQ(Module):
             self.next_Q2_with_actor = Q_net(self.next_state, self.next_action_repr, False, 'Qnet2_target')
             self.next_Q_with_actor = tf.minimum(self.next_Q1_with_actor, self.next_Q2_with_actor, 'Q_with_actor')
 
-        self.init_target_op, self.update_target_op = self._target_net_ops()
-
-    def _target_net_ops(self):
-        polyak = self.args['polyak']
-        with tf.name_scope('target_net_op'):
-            target_main_var_pairs = list(zip(self.target_variables, self.main_variables))
-            init_target_op = list(map(lambda v: tf.assign(v[0], v[1], name='init_target_op'), target_main_var_pairs))
-            update_target_op = list(map(lambda v: tf.assign(v[0], polyak * v[0] + (1. - polyak) * v[1], name='update_target_op'), target_main_var_pairs))
-
-        return init_target_op, update_target_op   
-
 
 class Temperature(Module):
     def __init__(self,
@@ -9,7 +9,8 @@ import tensorflow as tf
 
 from utility.utils import set_global_seed
 from utility.display import pwc
-from utility.tf_utils import get_sess_config
+from utility.debug_tools import assert_colorize
+from utility.tf_utils import get_sess_config, enable_cpu_jit
 from utility.debug_tools import timeit
 from algo.off_policy.apex.buffer import LocalBuffer
 
@@ -82,10 +83,11 @@ def train(agent, buffer, n_epochs, render):
             epslen_mean = np.mean(epslens)
             epslen_std = np.std(epslens)
 
+            learner_stats = agent.get_learner_stats()
             if hasattr(agent, 'stats'):
-                agent.record_stats(score=score, score_mean=score_mean, score_std=score_std,
-                                    epslen_mean=epslen_mean, epslen_std=epslen_std,
-                                    steps=episode_i)
+                agent.record_stats(dict(score=score, score_mean=score_mean, score_std=score_std,
+                                        epslen_mean=epslen_mean, epslen_std=epslen_std,
+                                        steps=episode_i, **learner_stats))
             
             if hasattr(agent, 'logger'):
                 agent.rl_log(dict(Timing='Train', 
@@ -95,7 +97,8 @@ def train(agent, buffer, n_epochs, render):
                                 ScoreMean=score_mean,
                                 ScoreStd=score_std,
                                 EpsLenMean=epslen_mean,
-                                EpsLenStd=epslen_std))
+                                EpsLenStd=epslen_std,
+                                **learner_stats))
 
         if episode_i % eval_interval == 0:
             eval_step = evaluate(agent, eval_step, episode_i - eval_interval, 
@@ -117,11 +120,23 @@ def main(env_args, agent_args, buffer_args, render=False):
 
     agent_args['env_stats']['times'] = 1
     sess_config = get_sess_config(1)
+    if 'graph_optimization' in agent_args and agent_args['graph_optimization'] == 'xla':
+        # XLA flags are read once, so they're set before any session is created
+        enable_cpu_jit()
 
+    # data collection and learning run in the same thread, so a rate limiter that blocks 
+    # learning would never see the inserts it waits for
+    assert_colorize('samples_per_insert' not in buffer_args or 'spi_timeout' in buffer_args,
+                    'Rate limiting in single-process training requires spi_timeout')
+
+    restore = agent_args['restore'] if 'restore' in agent_args else False
     agent = Agent('Agent', agent_args, env_args, buffer_args, 
                   sess_config=sess_config, log=True,
                   log_tensorboard=True, log_stats=True, 
-                  save=False, device='/GPU: 0')
+                  save=restore or 'snapshot_interval' in agent_args, 
+                  device='/GPU: 0')
+    if restore:
+        agent.restore_snapshot()
 
     if agent_args['episodic_learning']:
         # local buffer, only used to store a single episode of transitions
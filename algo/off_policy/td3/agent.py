@@ -22,7 +22,6 @@ class Agent(OffPolicyOperation):
                  log_stats=False, 
                  device=None):
         self.critic_loss_type = args['critic']['loss_type']
-        self.polyak = args['polyak'] if 'polyak' in args else .995
         
         # learning rate schedule
         self.schedule_lr = 'schedule_lr' in args and args['schedule_lr']
@@ -68,7 +67,7 @@ class Agent(OffPolicyOperation):
         self.opt_op = tf.group(self.actor_opt_op, self.critic_opt_op)
 
         # target net operations
-        self.init_target_op, self.update_target_op = self._target_net_ops()
+        self._target_net_ops(self.target_variables, self.main_variables)
 
         self._log_loss()
 
@@ -141,20 +140,6 @@ class Agent(OffPolicyOperation):
         
         return priority, critic_loss
 
-    def _target_net_ops(self):
-        with tf.name_scope('target_net_op'):
-            target_main_var_pairs = list(zip(self.target_variables, self.main_variables))
-            init_target_op = list(map(lambda v: tf.assign(v[0], v[1], name='init_target_op'), target_main_var_pairs))
-            update_target_op = list(map(lambda v: tf.assign(v[0], self.polyak * v[0] + (1. - self.polyak) * v[1], name='update_target_op'), target_main_var_pairs))
-
-        return init_target_op, update_target_op
-
-    def _initialize_target_net(self):
-        self.sess.run(self.init_target_op)
-
-    def _update_target_net(self):
-        self.sess.run(self.update_target_op)
-
     def _log_loss(self):
         if self.log_tensorboard:
             with tf.name_scope('info'):
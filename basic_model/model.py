@@ -5,7 +5,7 @@ import numpy as np
 import tensorflow as tf
 
 from utility.utils import isscalar
-from utility.tf_utils import wrap_scope
+from utility.tf_utils import wrap_scope, set_graph_optimization
 from utility.display import assert_colorize, pwc, display_var_info
 from utility.logger import Logger
 from basic_model.layer import Layer
@@ -184,7 +184,8 @@ class Model(Module):
             args {dict} -- A dictionary which specifies necessary arguments for building graph
         
         Keyword Arguments:
-            sess_config {tf.ConfigProto} -- session configuration (default: {None})
+            sess_config {tf.ConfigProto} -- session configuration (default: {None}),
+                        args['graph_optimization'] optionally adds Grappler rewrites ('grappler') or XLA JIT ('xla') to a copy of it
             save {bool} -- Option for saving model (default: {True})
             log {bool} -- Option for logging info using logger (default: {False})
             log_tensorboard {bool} -- Option for logging information to tensorboard (default: {False})
@@ -204,6 +205,8 @@ class Model(Module):
                                         allow_soft_placement=True)
             # sess_config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=True)
             sess_config.gpu_options.allow_growth = True
+        graph_optimization = args['graph_optimization'] if 'graph_optimization' in args else 'none'
+        sess_config = set_graph_optimization(sess_config, graph_optimization)
         self.sess = tf.Session(graph=self.graph, config=sess_config)
         atexit.register(self.sess.close)
 
@@ -268,6 +271,8 @@ class Model(Module):
             if message:
                 message = f'\n{message}'
             pwc(f'Model saved at {path}{message}', 'magenta')
+
+            return path
         else:
             # name intention to treat name saver as an error, just print a warning message
             pwc('name saver is available', 'magenta')
@@ -0,0 +1,340 @@
+""" Microbenchmarks for performance-critical components """
+import os, sys
+import argparse
+from time import time
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utility.display import pwc
+from utility.utils import to_int
+from algo.off_policy.replay.ds.sum_tree import SumTree
+from algo.off_policy.replay.ds.kary_sum_tree import KarySumTree
+from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+from algo.off_policy.replay.rank_based_replay import RankBasedPrioritizedReplay
+from algo.off_policy.replay.uniform_replay import UniformReplay
+
+
+def parse_cmd_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', '-b',
+                        type=str,
+                        nargs='*',
+                        default=['sum_tree'],
+                        choices=['sum_tree', 'kary_sum_tree', 'prioritized_replay', 'sample_many', 
+                                 'get_samples', 'record_layout', 'input_pipeline', 'learner'])
+    parser.add_argument('--capacity', '-c',
+                        type=str,
+                        nargs='*',
+                        default=['1e6'])
+    parser.add_argument('--batch_size', '-bs',
+                        type=int,
+                        nargs='*',
+                        default=[256, 512])
+    parser.add_argument('--state_dim', '-sd',
+                        type=int,
+                        default=24)
+    parser.add_argument('--action_dim', '-ad',
+                        type=int,
+                        default=4)
+    parser.add_argument('--n_batches', '-k',
+                        type=int,
+                        nargs='*',
+                        default=[4, 16])
+    parser.add_argument('--n_pipeline_samplers', '-ps',
+                        type=int,
+                        nargs='*',
+                        default=[2, 4])
+    parser.add_argument('--algorithm', '-a',
+                        type=str,
+                        nargs='*',
+                        default=['td3'],
+                        choices=['td3', 'sac', 'rainbow-iqn'])
+    parser.add_argument('--graph_optimization', '-go',
+                        type=str,
+                        nargs='*',
+                        default=['none', 'grappler', 'xla'],
+                        choices=['none', 'grappler', 'xla'])
+    parser.add_argument('--repeats', '-n',
+                        type=int,
+                        default=100)
+    args = parser.parse_args()
+
+    return args
+
+def measure(fn, repeats):
+    """ return average duration of fn in milliseconds """
+    fn()    # warm up
+    start = time()
+    for _ in range(repeats):
+        fn()
+    return (time() - start) / repeats * 1e3
+
+def random_tree(TreeClass, capacity, **kwargs):
+    tree = TreeClass(capacity, **kwargs)
+    tree.rebuild(np.random.uniform(size=capacity))
+
+    return tree
+
+def replay_args(capacity, batch_size, **kwargs):
+    args = dict(
+        capacity=capacity,
+        min_size=batch_size,
+        batch_size=batch_size,
+        normalize_reward=False,
+        n_steps=3,
+        gamma=.99,
+        alpha=.7,
+        beta0=.4,
+        beta_steps=5e4,
+        tb_capacity=100,
+    )
+    args.update(kwargs)
+
+    return args
+
+def full_replay(ReplayClass, args, state_shape, action_dim):
+    """ Construct a replay buffer filled with random transitions """
+    replay = ReplayClass(args, state_shape, action_dim)
+    capacity = replay.capacity
+    for k, v in replay.memory.items():
+        if k == 'steps':
+            v[:] = np.random.randint(1, replay.n_steps + 1, size=v.shape)
+        elif k == 'done':
+            v[:] = np.random.uniform(size=v.shape) < .01
+        else:
+            v[:] = np.random.normal(size=v.shape)
+    if hasattr(replay, 'data_structure'):
+        replay.data_structure.rebuild(np.random.uniform(size=capacity))
+    replay.is_full = True
+
+    return replay
+
+def stratified_values(total, batch_size):
+    segment = total / batch_size
+    bounds = np.arange(batch_size + 1) * segment
+
+    return np.random.uniform(bounds[:-1], bounds[1:])
+
+def bench_sum_tree(args, capacity):
+    tree = random_tree(SumTree, capacity)
+
+    pwc(f'SumTree sampling, capacity: {capacity}', 'cyan')
+    for batch_size in args.batch_size:
+        values = stratified_values(tree.total_priorities, batch_size)
+        scalar = measure(lambda: [tree.find(v) for v in values], args.repeats)
+        batch = measure(lambda: tree.find_batch(values), args.repeats)
+        pwc(f'batch size {batch_size:4d}\t'
+            f'find: {scalar:.3f}ms\t'
+            f'find_batch: {batch:.3f}ms\t'
+            f'speedup: {scalar / batch:.1f}x', 'green')
+
+    pwc(f'SumTree update, capacity: {capacity}', 'cyan')
+    for length in [args.batch_size[0], 2000]:
+        priorities = np.random.uniform(size=length)
+        # consecutive indexes, as in merging a local buffer
+        mem_idxs = np.arange(capacity - length // 2, capacity + length - length // 2) % capacity
+        def scalar_update():
+            for p, i in zip(priorities, mem_idxs):
+                tree.update(p, i)
+        scalar = measure(scalar_update, args.repeats)
+        batch = measure(lambda: tree.update_batch(priorities, mem_idxs), args.repeats)
+        pwc(f'length {length:4d}\t'
+            f'update: {scalar:.3f}ms\t'
+            f'update_batch: {batch:.3f}ms\t'
+            f'speedup: {scalar / batch:.1f}x', 'green')
+
+def bench_kary_sum_tree(args, capacity):
+    trees = [
+        ('binary, float64', random_tree(SumTree, capacity)),
+        ('8-ary, float64', random_tree(KarySumTree, capacity, fanout=8, leaf_dtype=np.float64)),
+        ('16-ary, float32', random_tree(KarySumTree, capacity, fanout=16, leaf_dtype=np.float32)),
+    ]
+    batch_size = args.batch_size[0]
+
+    pwc(f'Sum trees with capacity: {capacity}, batch size: {batch_size}', 'cyan')
+    for name, tree in trees:
+        values = stratified_values(tree.total_priorities, batch_size)
+        priorities = np.random.uniform(size=batch_size)
+        mem_idxs = np.random.randint(0, capacity, size=batch_size)
+        find = measure(lambda: tree.find_batch(values), args.repeats)
+        update = measure(lambda: tree.update_batch(priorities, mem_idxs), args.repeats)
+        pwc(f'{name:16s}\t'
+            f'find_batch: {find:.3f}ms\t'
+            f'update_batch: {update:.3f}ms', 'green')
+
+def bench_prioritized_replay(args, capacity):
+    state_shape, action_dim = (args.state_dim, ), args.action_dim
+    batch_size = args.batch_size[0]
+
+    pwc(f'Prioritized replay with capacity: {capacity}, batch size: {batch_size}', 'cyan')
+    for name, ReplayClass in [('proportional', ProportionalPrioritizedReplay), 
+                              ('rank', RankBasedPrioritizedReplay)]:
+        replay = full_replay(ReplayClass, replay_args(capacity, batch_size), state_shape, action_dim)
+        priorities = np.random.uniform(size=batch_size)
+        def learn_step():
+            _, indexes, _ = replay.sample()
+            replay.update_priorities(priorities, indexes)
+        sample = measure(replay.sample, args.repeats)
+        step = measure(learn_step, args.repeats)
+        pwc(f'{name:16s}\t'
+            f'sample: {sample:.3f}ms\t'
+            f'sample + update_priorities: {step:.3f}ms\t'
+            f'throughput: {1e3 / step:.0f} updates/s', 'green')
+
+def bench_sample_many(args, capacity):
+    state_shape, action_dim = (args.state_dim, ), args.action_dim
+
+    for batch_size in args.batch_size:
+        replay = full_replay(ProportionalPrioritizedReplay, replay_args(capacity, batch_size), 
+                             state_shape, action_dim)
+        pwc(f'Proportional replay with capacity: {capacity}, batch size: {batch_size}', 'cyan')
+        single = measure(replay.sample, args.repeats)
+        pwc(f'sample:\t{single:.3f}ms per batch', 'green')
+        for n_batches in args.n_batches:
+            many = measure(lambda: replay.sample_many(n_batches), args.repeats) / n_batches
+            pwc(f'sample_many({n_batches}):\t{many:.3f}ms per batch\t'
+                f'speedup: {single / many:.2f}x', 'green')
+
+def bench_get_samples(args, capacity):
+    state_shape, action_dim = (args.state_dim, ), args.action_dim
+
+    pwc(f'Batch assembly with capacity: {capacity}', 'cyan')
+    for batch_size in args.batch_size:
+        replay = full_replay(ProportionalPrioritizedReplay, replay_args(capacity, batch_size, reward_scale=2.), 
+                             state_shape, action_dim)
+        indexes = np.random.randint(0, capacity, size=batch_size)
+        # samples are converted to float32 anyway before being fed to networks
+        default = measure(lambda: [v.astype(np.float32) for v in replay._get_samples(indexes)], args.repeats)
+        replay.preallocate_samples = True
+        preallocated = measure(lambda: replay._get_samples(indexes), args.repeats)
+        pwc(f'batch size {batch_size:4d}\t'
+            f'_get_samples + astype: {default:.3f}ms\t'
+            f'preallocated: {preallocated:.3f}ms\t'
+            f'speedup: {default / preallocated:.2f}x', 'green')
+
+def bench_record_layout(args, capacity):
+    state_shape, action_dim = (args.state_dim, ), args.action_dim
+    batch_size = args.batch_size[0]
+    length = 100
+    
+    pwc(f'Uniform replay with capacity: {capacity}, batch size: {batch_size}, merge length: {length}', 'cyan')
+    for storage in ['memory', 'record']:
+        replay = full_replay(UniformReplay, replay_args(capacity, batch_size, n_steps=1, storage=storage), 
+                             state_shape, action_dim)
+        # local buffers in the same layout as the replay
+        if storage == 'record':
+            records = np.zeros(length, dtype=replay.records.dtype)
+            local_buffer = dict([(k, records[k]) for k in records.dtype.names])
+        else:
+            local_buffer = dict([(k, np.zeros((length, *v.shape[1:]), dtype=v.dtype)) 
+                                for k, v in replay.memory.items()])
+        local_buffer['steps'][:] = 1
+        state = np.random.normal(size=state_shape)
+        action = np.random.normal(size=action_dim)
+        indexes = np.random.randint(0, capacity, size=batch_size)
+        add = measure(lambda: replay.add(state, action, 1., False), args.repeats)
+        merge = measure(lambda: replay.merge(local_buffer, length), args.repeats)
+        sample = measure(lambda: replay._get_samples(indexes), args.repeats)
+        pwc(f'{storage:8s}\t'
+            f'add: {add * 1e3:.1f}us\t'
+            f'merge: {merge * 1e3:.1f}us\t'
+            f'_get_samples: {sample * 1e3:.1f}us', 'green')
+
+def bench_input_pipeline(args, capacity):
+    import tensorflow as tf
+    from algo.off_policy.replay.utils import get_dtypes
+    state_shape, action_dim = (args.state_dim, ), args.action_dim
+    batch_size = args.batch_size[0]
+    replay = full_replay(ProportionalPrioritizedReplay, replay_args(capacity, batch_size), state_shape, action_dim)
+    shapes = ((None, ), (None, ), ((None, *state_shape), (None, action_dim), (None, 1),
+                                   (None, *state_shape), (None, 1), (None, 1)))
+    dtypes = get_dtypes(action_dim)
+
+    def float32_pipeline():
+        types = (tf.float32, tf.int32, (tf.float32, ) * 6)
+        return tf.data.Dataset.from_generator(replay, types, shapes)
+
+    def parallel_pipeline(n_samplers):
+        types = (tf.float64, tf.int64, (dtypes['state'], dtypes['action'], tf.float32, 
+                                        dtypes['state'], dtypes['done'], dtypes['steps']))
+        ds = tf.data.Dataset.range(n_samplers)
+        return ds.apply(tf.data.experimental.parallel_interleave(
+            lambda _: tf.data.Dataset.from_generator(replay, types, shapes), 
+            cycle_length=n_samplers, sloppy=True))
+
+    pwc(f'Input pipeline with capacity: {capacity}, batch size: {batch_size}', 'cyan')
+    pipelines = [('generator', float32_pipeline)]
+    pipelines += [(f'parallel({n})', lambda n=n: parallel_pipeline(n)) for n in args.n_pipeline_samplers]
+    for name, pipeline in pipelines:
+        with tf.Graph().as_default():
+            ds = pipeline().prefetch(tf.data.experimental.AUTOTUNE)
+            samples = ds.make_one_shot_iterator().get_next()
+            # cast in the graph, as the learner does
+            samples = tf.nest.map_structure(lambda x: tf.cast(x, tf.float32), samples)
+            with tf.Session() as sess:
+                duration = measure(lambda: sess.run(samples), args.repeats)
+        pwc(f'{name:12s}	'
+            f'{duration:.3f}ms per batch	'
+            f'throughput: {1e3 / duration:.0f} batches/s', 'green')
+
+def bench_learner(args, capacity):
+    from utility.yaml_op import load_args
+    from utility.tf_utils import get_sess_config, enable_cpu_jit
+    from run.train import get_arg_file
+    if 'xla' in args.graph_optimization:
+        # XLA flags are read once, so they're set before any session is created
+        enable_cpu_jit()
+
+    for algorithm in args.algorithm:
+        if algorithm == 'td3':
+            from algo.off_policy.td3.agent import Agent
+        elif algorithm == 'sac':
+            from algo.off_policy.sac.agent import Agent
+        elif algorithm == 'rainbow-iqn':
+            from algo.off_policy.rainbow_iqn.agent import Agent
+
+        pwc(f'Learner of {algorithm} with capacity: {capacity}', 'cyan')
+        durations = {}
+        for mode in args.graph_optimization:
+            algo_args = load_args(get_arg_file(algorithm))
+            env_args, agent_args, buffer_args = algo_args['env'], algo_args['agent'], algo_args['buffer']
+            agent_args['graph_optimization'] = mode
+            agent_args['env_stats']['times'] = 1
+            buffer_args['capacity'] = capacity
+            buffer_args['min_size'] = agent_args['batch_size']
+            agent = Agent(f'{algorithm}-{mode}', agent_args, env_args, buffer_args, 
+                          sess_config=get_sess_config(1), device='/CPU: 0')
+            while not agent.good_to_learn:
+                agent.run_trajectory(fn=agent.add_data, random_action=True)
+
+            durations[mode] = measure(agent.learn, args.repeats)
+            speedup = durations[args.graph_optimization[0]] / durations[mode]
+            pwc(f'{mode:10s}\t'
+                f'{durations[mode]:.3f}ms per step\t'
+                f'speedup: {speedup:.2f}x', 'green')
+
+
+if __name__ == '__main__':
+    cmd_args = parse_cmd_args()
+
+    for benchmark in cmd_args.benchmark:
+        for capacity in cmd_args.capacity:
+            capacity = to_int(capacity)
+            if benchmark == 'sum_tree':
+                bench_sum_tree(cmd_args, capacity)
+            elif benchmark == 'kary_sum_tree':
+                bench_kary_sum_tree(cmd_args, capacity)
+            elif benchmark == 'prioritized_replay':
+                bench_prioritized_replay(cmd_args, capacity)
+            elif benchmark == 'sample_many':
+                bench_sample_many(cmd_args, capacity)
+            elif benchmark == 'get_samples':
+                bench_get_samples(cmd_args, capacity)
+            elif benchmark == 'record_layout':
+                bench_record_layout(cmd_args, capacity)
+            elif benchmark == 'input_pipeline':
+                bench_input_pipeline(cmd_args, capacity)
+            elif benchmark == 'learner':
+                bench_learner(cmd_args, capacity)
+            else:
+                raise NotImplementedError
@@ -91,6 +91,8 @@ if __name__ == '__main__':
             agent_args['model_root_dir'], agent_args['model_name'] = os.path.split(checkpoint)
             agent_args['log_root_dir'], _ = os.path.split(agent_args['model_root_dir'])
             agent_args['log_root_dir'] += '/logs'
+            # resume training from the snapshot saved in the checkpoint directory
+            agent_args['restore'] = True
 
             main(env_args, agent_args, buffer_args, render=render)
         else:
@@ -0,0 +1,36 @@
+import numpy as np
+import ray
+
+from algo.off_policy.apex.remote_replay import RemoteReplay, get_replay_shards
+from replay_test import replay_args, local_buffer
+
+
+class TestClass:
+    def test_remote_replay(self):
+        ray.init(num_cpus=4, ignore_reinit_error=True)
+        args = replay_args(capacity=400, n_steps=3, n_replay_shards=2, n_prefetch=3, priority_batch_size=2)
+        shards = get_replay_shards(args, (3, ), 2)
+        replay = RemoteReplay(args, shards)
+        length = 50
+        # workers merge to shards directly
+        for i in range(8):
+            ray.get(shards[i % 2].merge.remote(local_buffer(i * length, length), length))
+        assert len(replay) == 400
+        assert replay.good_to_learn
+
+        generator = replay()
+        for _ in range(4):
+            IS_ratios, indexes, samples = next(generator)
+            assert IS_ratios.shape == indexes.shape == (args['batch_size'], )
+            # shard i holds merges i, i + 2, ...
+            shard_no, mem_idxs = divmod(indexes, replay.shard_capacity)
+            merge_no = 2 * (mem_idxs // length) + shard_no
+            np.testing.assert_equal(samples[0][:, 0], merge_no * length + mem_idxs % length)
+
+        # priority updates are sent to shards in batches
+        replay.update_priorities(np.full(indexes.shape, 10.), indexes)
+        assert replay.n_pending == 1
+        replay.update_priorities(np.full(indexes.shape, 10.), indexes)
+        assert replay.n_pending == 0
+        assert all([len(v) == 0 for v in replay.pending_priorities])
+        ray.shutdown()
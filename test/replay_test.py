@@ -0,0 +1,737 @@
+import itertools
+import threading
+from collections import deque
+import numpy as np
+import pytest
+
+from algo.off_policy.replay.ds.sum_tree import SumTree
+from algo.off_policy.replay.ds.kary_sum_tree import KarySumTree
+from algo.off_policy.replay.ds.binary_heap import BinaryHeap
+from algo.off_policy.replay.rank_based_replay import RankBasedPrioritizedReplay
+from algo.off_policy.replay.uniform_replay import UniformReplay
+from algo.off_policy.replay.sharded_replay import ShardedReplay
+from algo.off_policy.replay.partitioned_replay import PartitionedReplay
+from algo.off_policy.replay.process_sampler import ProcessSampler
+from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+from algo.off_policy.replay import basic_replay
+from algo.off_policy.replay.utils import init_buffer
+from algo.off_policy.apex.buffer import LocalBuffer
+
+
+def random_sum_tree(capacity):
+    tree = SumTree(capacity)
+    priorities = np.random.uniform(size=capacity)
+    for i, p in enumerate(priorities):
+        tree.update(p, i)
+
+    return tree, priorities
+
+def replay_args(**kwargs):
+    args = dict(
+        capacity=1000,
+        min_size=100,
+        batch_size=32,
+        normalize_reward=False,
+        n_steps=1,
+        gamma=.99,
+        alpha=.7,
+        beta0=.4,
+        beta_steps=1e4,
+        tb_capacity=10,
+    )
+    args.update(kwargs)
+
+    return args
+
+def fill_replays(replays, n):
+    for i in range(n):
+        state = np.random.normal(size=3)
+        action = np.random.normal(size=2)
+        reward = np.random.normal()
+        done = np.random.uniform() < .1
+        for replay in replays:
+            replay.add(state, action, reward, done)
+
+def local_buffer(start, length):
+    """ Local buffer whose states record the order in which they are generated """
+    buffer = {}
+    init_buffer(buffer, length, (3, ), 2, True, extra_state=1)
+    buffer['state'][:] = np.arange(start, start + length + 1)[:, None]
+    buffer['steps'][:] = 1
+    buffer['priority'][:] = 1.
+
+    return buffer
+
+class TestClass:
+    def test_sum_tree_find_batch(self):
+        # a non-power-of-two capacity leaves leaves at different depths
+        for capacity in [1, 2, 7, 8, 1000]:
+            tree, priorities = random_sum_tree(capacity)
+            values = np.random.uniform(0, tree.total_priorities, size=256)
+
+            batch_priorities, batch_idxes = tree.find_batch(values)
+            scalar_priorities, scalar_idxes = zip(*[tree.find(v) for v in values])
+
+            np.testing.assert_equal(batch_idxes, scalar_idxes)
+            np.testing.assert_equal(batch_priorities, scalar_priorities)
+            np.testing.assert_equal(batch_priorities, priorities[batch_idxes])
+
+            # residuals are what remain of values within the leaves found
+            _, _, residuals = tree.find_batch(values, return_residuals=True)
+            assert np.all((residuals >= 0) & (residuals <= batch_priorities + 1e-8))
+
+    def test_sum_tree_update_batch(self):
+        for capacity in [1, 2, 7, 8, 1000]:
+            tree, _ = random_sum_tree(capacity)
+            batch_tree = SumTree(capacity)
+            batch_tree.container[:] = tree.container
+
+            mem_idxs = np.random.randint(0, capacity, size=64)
+            mem_idxs = np.unique(mem_idxs)
+            priorities = np.random.uniform(size=mem_idxs.shape)
+            for p, i in zip(priorities, mem_idxs):
+                tree.update(p, i)
+            batch_tree.update_batch(priorities[:, None], mem_idxs)
+
+            np.testing.assert_allclose(batch_tree.container, tree.container)
+
+    def test_sum_tree_rebuild(self):
+        for capacity in [1, 2, 7, 8, 1000]:
+            tree, priorities = random_sum_tree(capacity)
+            rebuilt_tree = SumTree(capacity)
+            rebuilt_tree.rebuild(priorities)
+
+            np.testing.assert_allclose(rebuilt_tree.container, tree.container)
+
+    def test_kary_sum_tree(self):
+        for capacity in [1, 7, 16, 1000]:
+            for fanout in [2, 8, 16]:
+                tree = KarySumTree(capacity, fanout)
+                priorities = np.random.uniform(size=capacity)
+                for i, p in enumerate(priorities):
+                    tree.update(p, i)
+                np.testing.assert_allclose(tree.total_priorities, np.sum(priorities))
+
+                rebuilt_tree = KarySumTree(capacity, fanout)
+                rebuilt_tree.rebuild(priorities)
+                np.testing.assert_allclose(rebuilt_tree.container, tree.container)
+
+                mem_idxs = np.unique(np.random.randint(0, capacity, size=64))
+                priorities[mem_idxs] = np.random.uniform(size=mem_idxs.shape)
+                rebuilt_tree.update_batch(priorities[mem_idxs], mem_idxs)
+                tree.rebuild(priorities)
+                np.testing.assert_allclose(rebuilt_tree.container, tree.container)
+
+                # leaves are ordered by mem_idx, so find is a search over prefix sums
+                values = np.random.uniform(0, tree.total_priorities, size=256)
+                _, idxes = tree.find_batch(values)
+                _, scalar_idxes = zip(*[tree.find(v) for v in values])
+                expected_idxes = np.searchsorted(np.cumsum(priorities), values)
+                np.testing.assert_equal(idxes, scalar_idxes)
+                assert np.all(idxes < capacity)
+                assert np.mean(idxes == expected_idxes) > .95
+
+    def test_binary_heap(self):
+        capacity = 100
+        heap = BinaryHeap(capacity)
+        priorities = np.random.uniform(size=capacity)
+        heap.update_batch(priorities, np.arange(capacity))
+        for _ in range(3):
+            mem_idxs = np.random.randint(0, capacity, size=20)
+            new_priorities = np.random.uniform(size=20)
+            heap.update_batch(new_priorities, mem_idxs)
+            priorities[mem_idxs] = new_priorities
+
+            for i in range(1, len(heap)):
+                assert heap.container[(i - 1) // 2] >= heap.container[i]
+            np.testing.assert_equal(heap.container[heap.positions], priorities)
+            np.testing.assert_equal(heap.mem_idxs[heap.positions], np.arange(capacity))
+
+        heap.sort()
+        np.testing.assert_equal(heap.container, np.sort(priorities)[::-1])
+        np.testing.assert_equal(heap.mem_idxs[heap.positions], np.arange(capacity))
+
+    def test_rank_based_replay(self):
+        args = replay_args()
+        replay = RankBasedPrioritizedReplay(args, (3, ), 2)
+        for i in range(args['min_size']):
+            replay.add(np.ones(3) * i, np.zeros(2), 1., i % 10 == 9)
+        assert len(replay.data_structure) == len(replay)
+
+        IS_ratios, indexes, samples = replay.sample()
+        assert IS_ratios.shape == indexes.shape == (args['batch_size'], )
+        assert np.max(IS_ratios) == 1
+        assert np.all(np.diff(replay.boundaries) > 0)
+        np.testing.assert_allclose(np.sum(replay.segment_probabilities * np.diff(replay.boundaries)), 1)
+        np.testing.assert_equal(samples[0][:, 0], indexes)
+
+        # the transition with the highest priority is always sampled by the first segment
+        replay.update_priorities(np.arange(args['batch_size']), indexes)
+        replay.data_structure.sort()
+        _, indexes, _ = replay.sample()
+        assert indexes[0] == replay.data_structure.mem_idxs[0]
+
+        # segments are empty if min_size < batch_size
+        with pytest.raises(AssertionError):
+            RankBasedPrioritizedReplay(replay_args(min_size=16), (3, ), 2)
+        # the newest lazy n-step transitions would be sampled before their returns are complete
+        with pytest.raises(AssertionError):
+            RankBasedPrioritizedReplay(replay_args(n_steps=3, lazy_n_steps=True), (3, ), 2)
+
+    def test_lazy_n_steps(self):
+        args = replay_args(capacity=500, n_steps=3)
+        replay = UniformReplay(args, (3, ), 2)
+        lazy_replay = UniformReplay(replay_args(capacity=500, n_steps=3, lazy_n_steps=True), (3, ), 2)
+        fill_replays([replay, lazy_replay], 300)
+        assert not hasattr(lazy_replay, 'tb')
+        with pytest.raises(AssertionError):
+            lazy_replay.merge(local_buffer(0, 10), 10)
+
+        # transitions still in the temporary buffer are not in replay.memory yet,
+        # and they are the next states of the last n_steps transitions in replay.memory
+        indexes = np.arange(replay.mem_idx - args['n_steps'])
+        for v1, v2 in zip(replay._get_samples(indexes), lazy_replay._get_samples(indexes)):
+            np.testing.assert_allclose(v1, v2, rtol=1e-2, atol=1e-2)
+
+        # n-step returns stop at the newest transition
+        _, _, _, _, done, steps = lazy_replay._get_samples(np.arange(lazy_replay.mem_idx - 3, lazy_replay.mem_idx))
+        assert np.all(np.where(done, steps >= 1, steps == [[2], [1], [0]]))
+
+        # the newest transition is sampled only if it's done
+        prioritized_replay = ProportionalPrioritizedReplay(replay_args(n_steps=3, lazy_n_steps=True), (3, ), 2)
+        for i in range(200):
+            prioritized_replay.add(np.zeros(3), np.zeros(2), 1., i % 10 == 9)
+            tree = prioritized_replay.data_structure
+            newest_priority = tree.container[tree.tree_size + i]
+            assert newest_priority == (prioritized_replay.top_priority if i % 10 == 9 else 0)
+            if i > 0:
+                assert tree.container[tree.tree_size + i - 1] == prioritized_replay.top_priority
+        for i in range(10):
+            lazy_replay.add(np.zeros(3), np.zeros(2), 1., False)
+            _, _, _, _, _, steps = lazy_replay.sample()
+            assert np.all(steps > 0)
+
+    def test_add_batch(self):
+        n_envs = 4
+        n_steps = 3
+        for lazy_n_steps in [False, True]:
+            replays = [UniformReplay(replay_args(capacity=200, n_steps=n_steps), (3, ), 2) 
+                        for _ in range(n_envs)]
+            args = replay_args(capacity=800, n_steps=n_steps, lazy_n_steps=lazy_n_steps)
+            batch_replay = ProportionalPrioritizedReplay(args, (3, ), 2)
+            for _ in range(150):
+                states = np.random.normal(size=(n_envs, 3))
+                actions = np.random.normal(size=(n_envs, 2))
+                rewards = np.random.normal(size=n_envs)
+                dones = np.random.uniform(size=n_envs) < .1
+                for replay, state, action, reward, done in zip(replays, states, actions, rewards, dones):
+                    replay.add(state, action, reward, done)
+                batch_replay.add_batch(states, actions, rewards, dones)
+
+            # transitions of each environment are stored n_envs rows apart
+            n = min([replay.mem_idx for replay in replays] + [batch_replay.mem_idx // n_envs]) - n_steps
+            indexes = np.arange(n)
+            for i, replay in enumerate(replays):
+                for v1, v2 in zip(replay._get_samples(indexes), batch_replay._get_samples(indexes * n_envs + i)):
+                    np.testing.assert_allclose(v1, v2, rtol=1e-2, atol=1e-2)
+            tree = batch_replay.data_structure
+            assert np.all(tree.container[tree.tree_size: tree.tree_size + n * n_envs] == batch_replay.top_priority)
+
+    def test_sample_many(self):
+        n_batches = 4
+        for ReplayType in [UniformReplay, ProportionalPrioritizedReplay, RankBasedPrioritizedReplay]:
+            args = replay_args(capacity=400, n_steps=3)
+            replay = ReplayType(args, (3, ), 2)
+            length = 100
+            for i in range(4):
+                replay.merge(local_buffer(i * length, length), length)
+
+            samples = replay.sample_many(n_batches)
+            if ReplayType == UniformReplay:
+                state = samples[0]
+                assert state.shape == (n_batches, args['batch_size'], 3)
+            else:
+                IS_ratios, indexes, samples = samples
+                state = samples[0]
+                assert IS_ratios.shape == indexes.shape == (n_batches, args['batch_size'])
+                np.testing.assert_equal(np.max(IS_ratios, axis=1), 1)
+                np.testing.assert_equal(state[..., 0], indexes)
+                assert replay.sample_i == n_batches
+            assert all([v.shape[:2] == (n_batches, args['batch_size']) for v in samples])
+
+    def test_preallocate_samples(self):
+        args = replay_args(capacity=200, n_steps=3, reward_scale=2.)
+        replay = UniformReplay(args, (3, ), 2)
+        fill_replays([replay], 500)
+        indexes = np.random.randint(0, len(replay), size=64)
+
+        expected = replay._get_samples(indexes)
+        replay.preallocate_samples = True
+        samples = replay._get_samples(indexes)
+        for v1, v2 in zip(expected, samples):
+            assert v2.dtype == np.float32
+            np.testing.assert_allclose(v1, v2, rtol=1e-3)
+
+        # outputs are double-buffered, and smaller batches are assembled into the same buffers
+        next_samples = replay._get_samples(indexes[:32])
+        assert not any([np.shares_memory(v1, v2) for v1, v2 in zip(samples, next_samples)])
+        third_samples = replay._get_samples(indexes)
+        assert all([np.shares_memory(v1, v2) for v1, v2 in zip(samples, third_samples)])
+        assert len(replay.batch_buffers) == 1
+
+        # outputs stay valid for n_sample_slots - 1 calls
+        replay = UniformReplay(replay_args(capacity=200, n_steps=3, n_sample_slots=4), (3, ), 2)
+        replay.preallocate_samples = True
+        fill_replays([replay], 500)
+        samples = [replay._get_samples(indexes) for _ in range(5)]
+        for i in range(1, 4):
+            assert not any([np.shares_memory(v1, v2) for v1, v2 in zip(samples[0], samples[i])])
+        assert all([np.shares_memory(v1, v2) for v1, v2 in zip(samples[0], samples[4])])
+
+    def test_record_storage(self):
+        for n_steps, lazy_n_steps in [(1, False), (3, False), (3, True)]:
+            args = replay_args(capacity=200, n_steps=n_steps, lazy_n_steps=lazy_n_steps)
+            replay = ProportionalPrioritizedReplay(args, (3, ), 2)
+            record_replay = ProportionalPrioritizedReplay(dict(args, storage='record'), (3, ), 2)
+            assert all([v.base is record_replay.records for v in record_replay.memory.values()])
+            fill_replays([replay, record_replay], 300)
+            for _ in range(20):
+                states = np.random.normal(size=(1, 3))
+                actions = np.random.normal(size=(1, 2))
+                replay.add_batch(states, actions, [1.], [False])
+                record_replay.add_batch(states, actions, [1.], [False])
+
+            indexes = np.random.randint(0, len(replay), size=64)
+            for v1, v2 in zip(replay._get_samples(indexes), record_replay._get_samples(indexes)):
+                np.testing.assert_equal(v1, v2)
+            for k, v in replay.memory.items():
+                np.testing.assert_equal(v, record_replay.memory[k])
+            np.testing.assert_equal(replay.data_structure.container, record_replay.data_structure.container)
+
+        # local buffers in the layout of records are merged by a single copy
+        args = replay_args(capacity=200, n_steps=3)
+        record_replay = UniformReplay(dict(args, storage='record'), (3, ), 2)
+        records = np.zeros(50, dtype=record_replay.records.dtype)
+        records['state'] = np.arange(50)[:, None]
+        records['steps'] = 1
+        buffer = dict([(k, records[k]) for k in records.dtype.names])
+        assert record_replay._get_local_records(buffer) is records
+        for _ in range(5):
+            record_replay.merge(buffer, 50)
+        np.testing.assert_equal(record_replay.memory['state'][:, 0], np.tile(np.arange(50), 4))
+
+    def test_save_restore(self, tmp_path):
+        for ReplayType, n_steps in [(ProportionalPrioritizedReplay, 1), (RankBasedPrioritizedReplay, 3)]:
+            args = replay_args(capacity=200, n_steps=n_steps, normalize_reward=True)
+            replay = ReplayType(args, (3, ), 2)
+            fill_replays([replay], 500)
+            replay.sample()
+            replay.update_priorities(np.random.uniform(size=64), np.random.randint(0, 200, size=64))
+            directory = str(tmp_path / ReplayType.__name__)
+            replay.save(directory)
+
+            restored = ReplayType(args, (3, ), 2)
+            restored.restore(directory)
+            assert isinstance(restored.memory['state'], np.memmap)
+            assert (restored.mem_idx, restored.is_full) == (replay.mem_idx, replay.is_full)
+            assert (restored.sample_i, restored.beta) == (replay.sample_i, replay.beta)
+            assert restored.top_priority == replay.top_priority
+            assert restored.running_reward_stats.mean == replay.running_reward_stats.mean
+            for k, v in replay.memory.items():
+                np.testing.assert_equal(v, restored.memory[k])
+            for k, v in replay.data_structure.get_state().items():
+                np.testing.assert_equal(v, restored.data_structure.get_state()[k])
+
+            # restored replays behave the same as the original ones, without touching the saved files
+            np.random.seed(0)
+            samples = replay.sample()
+            np.random.seed(0)
+            restored_samples = restored.sample()
+            np.testing.assert_equal(samples[1], restored_samples[1])
+            fill_replays([replay, restored], 100)
+            for k, v in replay.memory.items():
+                np.testing.assert_equal(v, restored.memory[k])
+            assert not np.array_equal(np.load(f'{directory}/state.npy'), restored.memory['state'])
+
+    def test_tiered_storage(self, tmp_path):
+        for Replay, n_steps, lazy_n_steps in [(UniformReplay, 1, False), (UniformReplay, 3, False), 
+                                              (ProportionalPrioritizedReplay, 3, True)]:
+            args = replay_args(capacity=200, n_steps=n_steps, lazy_n_steps=lazy_n_steps)
+            replay = Replay(args, (3, ), 2)
+            tiered_args = replay_args(capacity=200, n_steps=n_steps, lazy_n_steps=lazy_n_steps,
+                                      storage='tiered', storage_dir=str(tmp_path), 
+                                      hot_capacity=32, chunk_size=16)
+            tiered_replay = Replay(tiered_args, (3, ), 2)
+            # fill more than the capacity so that the memory is recycled
+            fill_replays([replay, tiered_replay], 500)
+
+            indexes = np.random.randint(0, len(replay), size=64)
+            for v1, v2 in zip(replay._get_samples(indexes), tiered_replay._get_samples(indexes)):
+                np.testing.assert_equal(v1, v2)
+            for k, v in replay.memory.items():
+                np.testing.assert_equal(v, tiered_replay.memory[k][:])
+            stats = tiered_replay.get_stats()
+            assert stats['state_ColdReads'] > 0
+
+    def test_save_restore_tiered_storage(self, tmp_path, monkeypatch):
+        # fields are copied a few rows at a time, never loaded as a whole
+        monkeypatch.setattr(basic_replay, 'COPY_CHUNK_BYTES', 100)
+        tiered_args = replay_args(capacity=200, n_steps=3,
+                                  storage='tiered', storage_dir=str(tmp_path / 'storage'), 
+                                  hot_capacity=32, chunk_size=16)
+        replay = UniformReplay(tiered_args, (3, ), 2)
+        fill_replays([replay], 300)
+        directory = str(tmp_path / 'snapshot')
+        replay.save(directory)
+        np.testing.assert_equal(np.load(f'{directory}/state.npy'), replay.memory['state'][:])
+
+        tiered_args['storage_dir'] = str(tmp_path / 'restored_storage')
+        restored = UniformReplay(tiered_args, (3, ), 2)
+        restored.restore(directory)
+        for k, v in replay.memory.items():
+            np.testing.assert_equal(v[:], restored.memory[k][:])
+
+    def test_compressed_storage(self):
+        for (Replay, lazy_n_steps), codec in itertools.product(
+                [(UniformReplay, False), (ProportionalPrioritizedReplay, True)], ['zlib', 'lzma', 'delta']):
+            args = replay_args(capacity=200, n_steps=3, lazy_n_steps=lazy_n_steps)
+            replay = Replay(args, (3, ), 2)
+            compressed_args = replay_args(capacity=200, n_steps=3, lazy_n_steps=lazy_n_steps,
+                                          storage='compressed', codec=codec, 
+                                          chunk_size=16, lru_size=4)
+            compressed_replay = Replay(compressed_args, (3, ), 2)
+            fill_replays([replay, compressed_replay], 500)
+
+            indexes = np.random.randint(0, len(replay), size=64)
+            for v1, v2 in zip(replay._get_samples(indexes), compressed_replay._get_samples(indexes)):
+                np.testing.assert_equal(v1, v2)
+            np.testing.assert_equal(replay.memory['state'], compressed_replay.memory['state'][:])
+            assert compressed_replay.get_stats()['state_CompressionRatio'] > 0
+
+    def test_sharded_replay(self):
+        args = replay_args(capacity=400, n_shards=4, n_steps=3)
+        replay = ShardedReplay(args, (3, ), 2)
+        length = 50
+        for i in range(8):
+            replay.merge(local_buffer(i * length, length), length)
+        assert len(replay) == 400
+        assert all([len(shard) == 100 for shard in replay.shards])
+
+        IS_ratios, indexes, samples = replay.sample()
+        assert IS_ratios.shape == indexes.shape == (args['batch_size'], )
+        state = samples[0]
+        for idx, s in zip(indexes, state):
+            shard_no, mem_idx = divmod(idx, replay.shard_capacity)
+            np.testing.assert_equal(replay.shards[shard_no].memory['state'][mem_idx], s)
+
+        # priorities are routed back to the shards they are sampled from
+        replay.update_priorities(np.full(indexes.shape, 10.), indexes)
+        for idx in indexes:
+            shard_no, mem_idx = divmod(idx, replay.shard_capacity)
+            tree = replay.shards[shard_no].data_structure
+            assert tree.container[tree.tree_size + mem_idx] == 10.
+
+        IS_ratios, indexes, samples = replay.sample_many(4)
+        assert IS_ratios.shape == indexes.shape == (4, args['batch_size'])
+        assert samples[0].shape == (4, args['batch_size'], 3)
+        np.testing.assert_equal(np.max(IS_ratios, axis=1), 1)
+        for idx, s in zip(indexes.reshape(-1), samples[0].reshape(-1, 3)):
+            shard_no, mem_idx = divmod(idx, replay.shard_capacity)
+            np.testing.assert_equal(replay.shards[shard_no].memory['state'][mem_idx], s)
+
+        # transitions of an episode are added to the same shard
+        replay = ShardedReplay(replay_args(capacity=400, n_shards=4, n_steps=3), (3, ), 2)
+        for i in range(40):
+            replay.add(np.ones(3) * i, np.zeros(2), 1., i % 10 == 9)
+        assert all([len(shard) == 10 for shard in replay.shards])
+        np.testing.assert_equal(replay.shards[1].memory['state'][:10, 0], np.arange(10, 20))
+
+        # shards of equal capacity are required to map global indexes
+        with pytest.raises(AssertionError):
+            ShardedReplay(replay_args(capacity=400, n_shards=3), (3, ), 2)
+
+    def test_rate_limiter(self):
+        args = replay_args(capacity=1000, n_steps=3, samples_per_insert=1, spi_tolerance=80)
+        replay = ProportionalPrioritizedReplay(args, (3, ), 2)
+        length = 100
+        # inserts are not limited until min_size transitions are inserted
+        replay.merge(local_buffer(0, length), length)
+        assert replay.get_stats()['Inserted'] == length
+
+        # diff = 100 exceeds the tolerance, so the next merge waits for samples
+        merge_thread = threading.Thread(target=replay.merge, args=(local_buffer(length, length), length))
+        merge_thread.start()
+        merge_thread.join(.1)
+        assert merge_thread.is_alive()
+        replay.sample()
+        merge_thread.join()
+        stats = replay.get_stats()
+        assert stats['Inserted'] == 2 * length
+        assert stats['Sampled'] == args['batch_size']
+        assert stats['InsertWaitTime'] > 0
+
+        # samples get ahead of inserts by at most the tolerance plus a batch
+        for _ in range(8):
+            replay.sample()
+        sample_thread = threading.Thread(target=replay.sample)
+        sample_thread.start()
+        sample_thread.join(.1)
+        assert sample_thread.is_alive()
+        replay.merge(local_buffer(2 * length, length), length)
+        sample_thread.join()
+        assert replay.get_stats()['Sampled'] == 10 * args['batch_size']
+
+    def test_episode_index(self):
+        # returns sum one-step rewards, no matter how n-step rewards are computed
+        for evict_episodes, n_steps, mode in [(False, 1, 'add'), (True, 1, 'add'), (False, 3, 'add'), 
+                                               (True, 3, 'add'), (False, 3, 'add_batch'), (True, 3, 'merge')]:
+            args = replay_args(capacity=100, min_size=10, n_steps=n_steps, 
+                               episode_index=True, evict_episodes=evict_episodes)
+            replay = ProportionalPrioritizedReplay(args, (3, ), 2)
+            # episodes of lengths 1, 2, ..., 15, whose rewards are all 1
+            lengths = np.arange(1, 16)
+            local = LocalBuffer(dict(local_capacity=20, n_steps=n_steps, gamma=.99, normalize_reward=False), 
+                                (3, ), 2)
+            for l in lengths:
+                for i in range(l):
+                    if mode == 'add_batch':
+                        replay.add_batch([np.full(3, l)], [np.zeros(2)], [1.], [i == l - 1])
+                    elif mode == 'merge':
+                        # local buffers carry n-step rewards
+                        local.add_data(np.full(3, l), np.zeros(2), 1., i == l - 1)
+                    else:
+                        replay.add(np.full(3, l), np.zeros(2), 1., i == l - 1)
+                if mode == 'merge':
+                    local['priority'][:local.idx] = 1.
+                    replay.merge(local, local.idx)
+                    local.reset()
+            # 120 transitions are added, the first 20 rows, i.e., episodes 0-4 and a head of episode 5, are overwritten
+            index = replay.episode_index
+            live_ids = index.live_episodes()
+            # the last n_steps - 1 blocks of add_batch are still pending
+            n_pending = len(replay.pending)
+            if evict_episodes:
+                np.testing.assert_equal(live_ids, np.arange(6, 15))
+            else:
+                np.testing.assert_equal(live_ids, np.arange(5, 15))
+                assert index.get(5) == (20 - n_pending, 1 + n_pending, 1 + n_pending)
+            assert index.n_episodes == len(live_ids)
+
+            for episode_id in live_ids:
+                start, length, ret = index.get(episode_id)
+                if episode_id > 5:
+                    assert length == ret == lengths[episode_id] - (n_pending if episode_id == 14 else 0)
+                rows = index.rows(episode_id)
+                np.testing.assert_equal(index.find(rows), episode_id)
+                episode = replay.get_episode(episode_id)
+                np.testing.assert_equal(episode['state'][:, 0], lengths[episode_id])
+                # done flags are also set for the last n_steps - 1 transitions
+                if episode_id < 14 or not n_pending:
+                    assert np.all(episode['done'][-n_steps:]) and not np.any(episode['done'][:-n_steps])
+
+            tree = replay.data_structure
+            # the rest of episode 5
+            priority = tree.container[tree.tree_size + 20]
+            assert priority == 0 if evict_episodes else priority > 0
+            rows = index.rows(6)
+            replay.evict_episode(6)
+            assert np.all(tree.container[tree.tree_size + rows] == 0)
+            replay.update_priorities(np.ones(rows.shape), rows)
+            assert np.all(tree.container[tree.tree_size + rows] == 0)
+            np.testing.assert_equal(index.find(rows), -1)
+            assert 6 not in index.live_episodes()
+
+    def test_eviction(self):
+        args = replay_args(capacity=400, n_steps=3, eviction='priority', segment_size=100)
+        replay = ProportionalPrioritizedReplay(args, (3, ), 2)
+        length = 50
+        for i in range(8):
+            replay.merge(local_buffer(i * length, length), length)
+        assert replay.is_full and replay.mem_idx == 0
+
+        # segment 2 has the lowest priority
+        tree = replay.data_structure
+        replay.update_priorities(np.full(100, .1), np.arange(200, 300))
+        replay.merge(local_buffer(400, length), length)
+        assert replay.segment == 2 and replay.mem_idx == 250
+        np.testing.assert_equal(replay.memory['state'][200:250, 0], np.arange(400, 450))
+        leaves = tree.container[tree.tree_size:]
+        np.testing.assert_equal(leaves[200:250], 1)
+        # rows left from the evicted segment and rows whose next states are overwritten are not sampled
+        np.testing.assert_equal(leaves[250:300], 0)
+        np.testing.assert_equal(leaves[197:200], 0)
+        np.testing.assert_equal(leaves[397:400], 0)
+        np.testing.assert_allclose(tree.segment_priorities, [100, 97, 50, 97])
+        _, indexes, _ = replay.sample()
+        assert not np.any((indexes >= 250) & (indexes < 300))
+        # late priority updates of evicted rows do not bring them back
+        replay.update_priorities(np.full(53, 5.), np.concatenate([np.arange(250, 300), np.arange(197, 200)]))
+        np.testing.assert_equal(leaves[250:300], 0)
+        np.testing.assert_equal(leaves[197:200], 0)
+
+        # segment 2 is filled before another segment is evicted,
+        # and it's not evicted even though it has the lowest priority
+        replay.update_priorities(np.full(200, 10.), np.concatenate([np.arange(100), np.arange(300, 400)]))
+        replay.merge(local_buffer(450, 2 * length), 2 * length)
+        np.testing.assert_equal(replay.memory['state'][250:300, 0], np.arange(450, 500))
+        assert replay.segment in [1, 3] and replay.mem_idx == replay.segment * 100 + 50
+
+        # with equal priorities, the oldest segment is evicted first
+        args = replay_args(capacity=400, n_steps=3, eviction='age_priority', segment_size=100)
+        replay = ProportionalPrioritizedReplay(args, (3, ), 2)
+        for i in range(10):
+            replay.merge(local_buffer(i * length, length), length)
+        assert replay.segment == 0 and replay.mem_idx == 100
+
+    def test_eviction_next_states(self):
+        args = replay_args(capacity=1000, n_steps=3, eviction='priority', segment_size=100, n_evictions=2)
+        replay = ProportionalPrioritizedReplay(args, (3, ), 2)
+        start = 0
+        for _ in range(200):
+            # states record the order in which they are generated, and each merge is an episode
+            length = np.random.randint(20, 150)
+            buffer = local_buffer(start, length)
+            buffer['state'][:] = (np.arange(start, start + length + 1) % 1000)[:, None]
+            buffer['done'][length - 1] = True
+            replay.merge(buffer, length)
+            start += length
+            if replay.good_to_learn:
+                _, indexes, (state, _, _, next_state, done, steps) = replay.sample()
+                replay.update_priorities(np.random.uniform(size=indexes.shape), indexes)
+                # next states of sampled transitions are never taken from other episodes
+                not_done = ~done[:, 0]
+                np.testing.assert_equal(next_state[not_done, 0], (state[not_done, 0] + steps[not_done, 0]) % 1000)
+
+    def test_partitioned_replay(self):
+        args = replay_args(capacity=400, n_partitions=2, n_steps=3, partition_weights=[0, 1])
+        replay = PartitionedReplay(args, (3, ), 2)
+        length = 50
+        for i in range(4):
+            replay.merge(local_buffer(i * length, length), length, i % 2)
+        assert len(replay) == 200
+
+        # partition 0 is never sampled with zero weight
+        IS_ratios, indexes, samples = replay.sample()
+        assert IS_ratios.shape == indexes.shape == (args['batch_size'], )
+        assert np.all(indexes >= replay.partition_capacity)
+        for idx, s in zip(indexes, samples[0]):
+            partition_no, mem_idx = divmod(idx, replay.partition_capacity)
+            np.testing.assert_equal(replay.partitions[partition_no].memory['state'][mem_idx], s)
+
+        # the top tree holds weighted totals
+        replay.set_weights([3, 1])
+        replay.update_priorities(np.full(indexes.shape, 10.), indexes)
+        for i, partition in enumerate(replay.partitions):
+            total = partition.data_structure.total_priorities
+            assert replay.top_tree.container[replay.top_tree.tree_size + i] == replay.weights[i] * total
+        partition_nos = np.concatenate([replay.sample()[1] // replay.partition_capacity for _ in range(20)])
+        assert np.any(partition_nos == 0) and np.any(partition_nos == 1)
+
+        with pytest.raises(AssertionError):
+            PartitionedReplay(replay_args(capacity=400, n_partitions=3), (3, ), 2)
+
+    def test_partitioned_replay_rate_limiter(self):
+        args = replay_args(capacity=400, n_partitions=2, n_steps=3, samples_per_insert=1, spi_tolerance=80)
+        replay = PartitionedReplay(args, (3, ), 2)
+        assert all([partition.rate_limiter is None for partition in replay.partitions])
+        length = 100
+        replay.merge(local_buffer(0, length), length, 0)
+        assert replay.get_stats()['Inserted'] == length
+
+        # inserts to any partition wait for samples from the whole replay
+        merge_thread = threading.Thread(target=replay.merge, args=(local_buffer(length, length), length, 1))
+        merge_thread.start()
+        merge_thread.join(.1)
+        assert merge_thread.is_alive()
+        replay.sample()
+        merge_thread.join()
+        stats = replay.get_stats()
+        assert stats['Inserted'] == 2 * length
+        assert stats['Sampled'] == args['batch_size']
+
+    def test_partitioned_replay_uneven_top_tree(self):
+        # leaves of the top tree sit at different depths with three partitions
+        args = replay_args(capacity=300, n_partitions=3, min_size=30)
+        replay = PartitionedReplay(args, (3, ), 2)
+        length = 50
+        for i in range(3):
+            replay.merge(local_buffer(i * length, length), length, i)
+
+        indexes = np.concatenate([replay.sample()[1] for _ in range(200)])
+        partition_nos, mem_idxs = np.divmod(indexes, replay.partition_capacity)
+        for i in range(3):
+            # all rows are sampled, and partitions of equal total priority about equally often
+            counts = np.bincount(mem_idxs[partition_nos == i], minlength=length)
+            assert counts.size == length and np.all(counts > 0)
+            assert abs(np.mean(partition_nos == i) - 1 / 3) < .05
+
+
+        args = replay_args(capacity=400, n_steps=3)
+        replay = ProportionalPrioritizedReplay(args, (3, ), 2)
+        length = 50
+        for i in range(4):
+            replay.merge(local_buffer(i * length, length), length)
+        tree = replay.data_structure
+
+        chunk, samples = replay.get_refresh_chunk(150)
+        np.testing.assert_equal(chunk[0], np.arange(150))
+        np.testing.assert_equal(samples[0][:, 0], np.arange(150))
+        replay.refresh_priorities(np.full(150, 5.), chunk)
+        np.testing.assert_equal(tree.get_batch(np.arange(150)), 5.)
+        assert replay.get_stats()['RefreshCoverage'] == .75
+
+        # the chunk stops at the end of memory, and the next one wraps around
+        chunk, _ = replay.get_refresh_chunk(150)
+        np.testing.assert_equal(chunk[0], np.arange(150, 200))
+        chunk, _ = replay.get_refresh_chunk(150)
+        np.testing.assert_equal(chunk[0], np.arange(150))
+
+        # rows overwritten after the chunk is taken are not refreshed
+        for i in range(4, 9):
+            replay.merge(local_buffer(i * length, length), length)
+        replay.refresh_priorities(np.full(150, 7.), chunk)
+        np.testing.assert_equal(tree.get_batch(np.arange(50)), 1.)
+        np.testing.assert_equal(tree.get_batch(np.arange(50, 150)), 7.)
+        assert replay.get_stats()['RefreshedTransitions'] == 250
+
+    def test_process_sampler(self):
+        args = replay_args(capacity=400, n_steps=3, storage='shared')
+        replay = ProportionalPrioritizedReplay(args, (3, ), 2)
+        sampler = ProcessSampler(replay, 2, 4)
+        length = 50
+        for i in range(4):
+            sampler.merge(local_buffer(i * length, length), length)
+        assert sampler.good_to_learn
+
+        generator = sampler()
+        for _ in range(5):
+            IS_ratios, indexes, samples = next(generator)
+            assert IS_ratios.shape == indexes.shape == (args['batch_size'], )
+            np.testing.assert_equal(samples[0][:, 0], indexes)
+        
+        # priority updates are applied by sampler processes
+        # yielded arrays are views of the ring, which are reused once the next batch is requested
+        indexes = np.copy(indexes)
+        sampler.update_priorities(np.full(indexes.shape, 100.), indexes)
+        for _ in range(2 * sampler.ring_size):
+            next(generator)
+        tree = replay.data_structure
+        assert np.all(tree.container[tree.tree_size + indexes] == 100.)
+
+    def test_process_sampler_held_batches(self):
+        args = replay_args(capacity=400, n_steps=3, storage='shared')
+        replay = ProportionalPrioritizedReplay(args, (3, ), 2)
+        sampler = ProcessSampler(replay, 2, 6, n_held=3)
+        length = 50
+        for i in range(4):
+            sampler.merge(local_buffer(i * length, length), length)
+
+        # the last n_held batches are not overwritten by sampler processes
+        generator = sampler()
+        batches = deque(maxlen=sampler.n_held)
+        for _ in range(50):
+            IS_ratios, indexes, samples = next(generator)
+            batches.append(((IS_ratios, indexes, samples), (np.copy(indexes), np.copy(samples[0]))))
+            for (_, indexes, samples), (saved_indexes, saved_states) in batches:
+                np.testing.assert_equal(indexes, saved_indexes)
+                np.testing.assert_equal(samples[0], saved_states)
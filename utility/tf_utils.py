@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import tensorflow as tf
 import tensorflow.contrib as tc
@@ -111,6 +112,27 @@ def n_step_target(reward, done, nth_value, gamma, steps):
 
     return n_step_target
 
+def target_update_op(target_variables, main_variables, polyak, dependencies=None, name='target_update_op'):
+    """ Return a single op setting target variables to polyak * target + (1 - polyak) * main,
+    which copies main variables if polyak is 0. Variables are flattened and concatenated 
+    so that the moving average is computed by one op for all variables, and the op only 
+    runs after dependencies if any """
+    assert_colorize(len(target_variables) == len(main_variables), 
+                    f'Target and main variables do not match: {len(target_variables)} vs {len(main_variables)}')
+    if not target_variables:
+        return tf.no_op(name=name)
+    with tf.control_dependencies(dependencies):
+        if polyak == 0:
+            values = [tf.identity(v) for v in main_variables]
+        else:
+            sizes = [np.prod(v.shape.as_list()) for v in target_variables]
+            target = tf.concat([tf.reshape(v, [-1]) for v in target_variables], 0)
+            main = tf.concat([tf.reshape(v, [-1]) for v in main_variables], 0)
+            values = tf.split(polyak * target + (1. - polyak) * main, sizes)
+        assigns = [tf.assign(t, tf.reshape(v, t.shape)) for t, v in zip(target_variables, values)]
+
+    return tf.group(*assigns, name=name)
+
 def stats_summary(name, data, mean=True, std=False, max=False, min=False, hist=False):
     if mean:
         tf.compat.v1.summary.scalar(f'{name}_mean_', tf.reduce_mean(data))
@@ -207,6 +229,78 @@ def get_norm(name):
     else:
         raise NotImplementedError
 
+_xla_available = None
+
+def xla_available():
+    """ Return whether XLA can compile graphs in this process, by running a tiny 
+    graph on the XLA CPU device in a throwaway session. The result is cached """
+    global _xla_available
+    if _xla_available is None:
+        if hasattr(tf.test, 'is_built_with_xla') and not tf.test.is_built_with_xla():
+            _xla_available = False
+            return _xla_available
+        graph = tf.Graph()
+        with graph.as_default():
+            with tf.device('/device:XLA_CPU:0'):
+                x = tf.constant([1.])
+                y = x * x + x
+        # without soft placement, running fails if there is no XLA device
+        config = tf.ConfigProto(allow_soft_placement=False, device_count={'GPU': 0})
+        try:
+            with tf.Session(graph=graph, config=config) as sess:
+                _xla_available = sess.run(y)[0] == 2.
+        except tf.errors.OpError:
+            _xla_available = False
+
+    return _xla_available
+
+def enable_cpu_jit():
+    """ Let the session JIT level apply to CPU, which XLA flags only read
+    the first time they're used, i.e., before any session is compiled with XLA """
+    flags = os.environ.get('TF_XLA_FLAGS', '')
+    if '--tf_xla_cpu_global_jit' not in flags:
+        os.environ['TF_XLA_FLAGS'] = f'{flags} --tf_xla_cpu_global_jit'.strip()
+
+def set_graph_optimization(sess_config, mode):
+    """ Return a copy of sess_config with graph optimizations configured, mode is one of
+        none: keep the default configuration
+        grappler: run Grappler rewrites that fuse and simplify the many small ops of MLPs
+        xla: grappler plus XLA JIT compilation, falling back to grappler if XLA is unavailable
+    XLA only compiles for CPU if the process calls enable_cpu_jit before creating any session
+    """
+    if mode == 'none':
+        return sess_config
+    elif mode not in ['grappler', 'xla']:
+        raise NotImplementedError(f'Invalid graph optimization: {mode}')
+
+    # sess_config may be shared by several models
+    config = tf.ConfigProto()
+    config.CopyFrom(sess_config)
+    sess_config = config
+
+    from tensorflow.core.protobuf import rewriter_config_pb2
+    RewriterConfig = rewriter_config_pb2.RewriterConfig
+    rewrite_options = sess_config.graph_options.rewrite_options
+    rewrite_options.constant_folding = RewriterConfig.ON
+    rewrite_options.arithmetic_optimization = RewriterConfig.AGGRESSIVE
+    rewrite_options.dependency_optimization = RewriterConfig.ON
+    rewrite_options.shape_optimization = RewriterConfig.ON
+    rewrite_options.loop_optimization = RewriterConfig.ON
+    # fuse matmul, bias add and activation
+    rewrite_options.remapping = RewriterConfig.ON
+
+    from utility.display import pwc
+    if mode == 'xla':
+        if xla_available():
+            sess_config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+            pwc('Graph optimization: Grappler rewrites and XLA JIT', 'magenta')
+        else:
+            pwc('XLA is not available, only Grappler rewrites are applied', 'magenta')
+    else:
+        pwc('Graph optimization: Grappler rewrites', 'magenta')
+
+    return sess_config
+
 def get_sess_config(parallelism_threads):
     sess_config = tf.ConfigProto(intra_op_parallelism_threads=parallelism_threads,
                                  inter_op_parallelism_threads=parallelism_threads,